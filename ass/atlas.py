@@ -0,0 +1,164 @@
+""" Export of rendered subtitles as a deduplicated glyph atlas plus a
+placement timeline, for clients that draw subtitles as sprites.
+"""
+
+import ctypes
+import json
+import struct
+import zlib
+
+
+def write_png(f, width, height, data):
+    """ Write an 8-bit grayscale image to a file object as a PNG. """
+    def chunk(tag, payload):
+        f.write(struct.pack(">I", len(payload)))
+        f.write(tag + payload)
+        f.write(struct.pack(">I", zlib.crc32(tag + payload) & 0xffffffff))
+
+    raw = b"".join(b"\0" + bytes(data[y * width:(y + 1) * width])
+                   for y in range(height))
+
+    f.write(b"\x89PNG\r\n\x1a\n")
+    chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+    chunk(b"IDAT", zlib.compress(raw))
+    chunk(b"IEND", b"")
+
+
+class _Page(object):
+    """ An atlas page, filled shelf by shelf. """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.data = bytearray(width * height)
+
+        self._x = 0
+        self._y = 0
+        self._shelf_height = 0
+
+    def place(self, w, h, padding):
+        """ Find room for a ``w`` by ``h`` bitmap, returning its position or
+        ``None`` if the page is full.
+        """
+        if self._x + w > self.width:
+            self._x = 0
+            self._y += self._shelf_height + padding
+            self._shelf_height = 0
+
+        if self._x + w > self.width or self._y + h > self.height:
+            return None
+
+        pos = (self._x, self._y)
+        self._x += w + padding
+        self._shelf_height = max(self._shelf_height, h)
+        return pos
+
+    def blit(self, x, y, w, h, data):
+        for row in range(h):
+            start = (y + row) * self.width + x
+            self.data[start:start + w] = data[row * w:(row + 1) * w]
+
+
+class AtlasExporter(object):
+    """ Collects the images of rendered frames into atlas pages, storing each
+    distinct bitmap only once, and records which bitmaps are placed where
+    over time.
+
+    The timeline only gets an entry when the placements change, and frames
+    that libass reports as unchanged are not even looked at, so the cost
+    scales with the amount of distinct content rather than the number of
+    frames.
+    """
+
+    def __init__(self, page_size=1024, padding=1):
+        self.page_size = page_size
+        self.padding = padding
+
+        self.pages = []
+
+        # (page, x, y, w, h) for each atlas ID.
+        self.sprites = []
+
+        # (time in ms, ((atlas ID, dst_x, dst_y, color), ...)) whenever the
+        # placements change; each entry holds until the next one.
+        self.timeline = []
+
+        self._ids = {}
+        self._placements = None
+
+    def add_bitmap(self, w, h, data):
+        """ Add a tightly packed ``w`` by ``h`` alpha bitmap to the atlas, if
+        it is not in there already, and get its atlas ID.
+        """
+        key = (w, h, data)
+        try:
+            return self._ids[key]
+        except KeyError:
+            pass
+
+        pos = None
+        if self.pages and w <= self.page_size and h <= self.page_size:
+            pos = self.pages[-1].place(w, h, self.padding)
+
+        if pos is None:
+            page = _Page(max(self.page_size, w), max(self.page_size, h))
+            self.pages.append(page)
+            pos = page.place(w, h, self.padding)
+
+        x, y = pos
+        page_index = len(self.pages) - 1
+        self.pages[page_index].blit(x, y, w, h, data)
+
+        atlas_id = len(self.sprites)
+        self.sprites.append((page_index, x, y, w, h))
+        self._ids[key] = atlas_id
+        return atlas_id
+
+    @staticmethod
+    def _bitmap_bytes(img):
+        data = ctypes.string_at(img.bitmap, img.stride * img.h)
+        if img.stride == img.w:
+            return data
+        return b"".join(data[y * img.stride:y * img.stride + img.w]
+                        for y in range(img.h))
+
+    def add_frame(self, now_ms, images):
+        """ Add the images of a frame rendered at the given time. Must be
+        called before the next frame is rendered.
+        """
+        if self._placements is None or getattr(images, "changed", None) != 0:
+            self._placements = tuple(
+                (self.add_bitmap(img.w, img.h, self._bitmap_bytes(img)),
+                 img.dst_x, img.dst_y, img.color)
+                for img in images
+                if img.w > 0 and img.h > 0)
+
+        if not self.timeline or self.timeline[-1][1] != self._placements:
+            self.timeline.append((now_ms, self._placements))
+
+    def render(self, renderer, track, times):
+        """ Render a track at each of the given times and add the frames. """
+        for now in times:
+            self.add_frame(renderer.timedelta_to_ms(now),
+                           renderer.render_frame(track, now))
+
+    def to_dict(self):
+        """ Get the atlas layout and timeline as JSON-serializable data. """
+        return {
+            "pages": [{"width": page.width, "height": page.height}
+                      for page in self.pages],
+            "sprites": [list(sprite) for sprite in self.sprites],
+            "timeline": [[now_ms, [list(p) for p in placements]]
+                         for now_ms, placements in self.timeline]
+        }
+
+    def save(self, prefix):
+        """ Write the atlas pages to ``<prefix>-<n>.png`` and the layout and
+        timeline to ``<prefix>.json``.
+        """
+        for i, page in enumerate(self.pages):
+            with open("{}-{}.png".format(prefix, i), "wb") as f:
+                write_png(f, page.width, page.height, page.data)
+
+        with open(prefix + ".json", "w") as f:
+            json.dump(self.to_dict(), f, separators=(",", ":"))
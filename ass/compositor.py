@@ -0,0 +1,275 @@
+""" Compositing of rendered libass images into frame buffers.
+
+This needs NumPy, which is not otherwise required by python-ass.
+"""
+
+import ctypes
+
+import numpy as np
+
+from .ycbcr import MATRICES, MATRIX_BT601_TV, rgb_to_yuv
+
+
+def bitmap_array(img):
+    """ Get a ``(h, w)`` array of an image's alpha bitmap. The array points
+    into libass memory, so it is only valid until the next ``render_frame``.
+    """
+    if img.w <= 0 or img.h <= 0:
+        return np.zeros((max(img.h, 0), max(img.w, 0)), np.uint8)
+
+    ptr = ctypes.cast(img.bitmap, ctypes.POINTER(ctypes.c_uint8))
+    return np.ctypeslib.as_array(ptr, shape=(img.h, img.stride))[:, :img.w]
+
+
+def clip(img, size):
+    """ Clip an image to a frame of the given size. Returns the
+    ``(dst_y, dst_x)`` slices of the frame and ``(y, x)`` slices of the
+    bitmap to blend, or ``None`` if the image is entirely off-frame.
+    """
+    width, height = size
+
+    x0 = max(img.dst_x, 0)
+    y0 = max(img.dst_y, 0)
+    x1 = min(img.dst_x + img.w, width)
+    y1 = min(img.dst_y + img.h, height)
+
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    return ((slice(y0, y1), slice(x0, x1)),
+            (slice(y0 - img.dst_y, y1 - img.dst_y),
+             slice(x0 - img.dst_x, x1 - img.dst_x)))
+
+
+def image_alpha(img, bitmap):
+    """ Combine an image's bitmap with the alpha of its color (which libass
+    stores inverted, as transparency) into a 0-255 coverage array.
+    """
+    transparency = img.color & 0xff
+    alpha = bitmap.astype(np.uint32)
+    if transparency:
+        alpha *= 255 - transparency
+        alpha += 127
+        alpha //= 255
+    return alpha
+
+
+class Compositor(object):
+    """ Blends libass images into packed RGBA or BGRA frames, with straight
+    (non-premultiplied) alpha, as expected by e.g. ffmpeg's ``rawvideo``
+    demuxer.
+    """
+    FORMATS = {
+        "rgba": (0, 1, 2),
+        "bgra": (2, 1, 0)
+    }
+
+    def __init__(self, size, format="rgba"):
+        if format not in Compositor.FORMATS:
+            raise ValueError("unsupported format: " + format)
+
+        self.size = size
+        self.format = format
+        self._order = Compositor.FORMATS[format]
+
+        width, height = size
+        self.frame_bytes = width * height * 4
+
+    def make_buffer(self):
+        """ Allocate a cleared frame buffer for ``composite``. """
+        width, height = self.size
+        return np.zeros((height, width, 4), np.uint8)
+
+    def clear(self, buf):
+        buf.fill(0)
+
+    def blend(self, img, buf):
+        """ Blend a single image onto a frame buffer. """
+        clipped = clip(img, self.size)
+        if clipped is None:
+            return
+
+        dst_slices, src_slices = clipped
+        alpha = image_alpha(img, bitmap_array(img)[src_slices])
+
+        rgba = img.rgba
+        color = np.array([rgba[i] for i in self._order], np.uint32)
+
+        dst = buf[dst_slices]
+        dst_alpha = dst[..., 3].astype(np.uint32)
+        dst_weight = dst_alpha * (255 - alpha)
+
+        # everything below is scaled by 255, to stay in integers.
+        src_weight = alpha * 255
+        out_alpha = src_weight + dst_weight
+
+        color_out = color * src_weight[..., None] + \
+                    dst[..., :3] * dst_weight[..., None]
+        color_out //= np.maximum(out_alpha, 1)[..., None]
+
+        dst[..., :3] = color_out
+        dst[..., 3] = (out_alpha + 127) // 255
+
+    def composite(self, images, buf, clear=True):
+        """ Blend all the images of a rendered frame onto a frame buffer,
+        clearing it first unless told otherwise.
+        """
+        if clear:
+            self.clear(buf)
+
+        for img in images:
+            self.blend(img, buf)
+
+        return buf
+
+
+class YUVCompositor(object):
+    """ Blends libass images directly into 4:2:0 YCbCr planes, either
+    planar (``yuv420p``, separate U and V planes) or semi-planar (``nv12``,
+    interleaved UV plane).
+
+    Colors are converted once per distinct image color, and chroma is
+    blended with the alpha averaged over each 2x2 block. The planes can be
+    a frame buffer from ``make_buffer`` or the planes of a decoded video
+    frame, to overlay subtitles on it in place.
+    """
+    FORMATS = ("yuv420p", "nv12")
+
+    def __init__(self, size, format="yuv420p", matrix=MATRIX_BT601_TV):
+        if format not in YUVCompositor.FORMATS:
+            raise ValueError("unsupported format: " + format)
+
+        if matrix not in MATRICES:
+            raise ValueError("unsupported matrix: " + str(matrix))
+
+        self.size = size
+        self.format = format
+        self.matrix = matrix
+        self._colors = {}
+
+        width, height = size
+        self.chroma_size = ((width + 1) // 2, (height + 1) // 2)
+        chroma_width, chroma_height = self.chroma_size
+        self.frame_bytes = width * height + 2 * chroma_width * chroma_height
+
+    @classmethod
+    def for_track(cls, track, size, format="yuv420p",
+                  default=MATRIX_BT601_TV):
+        """ Make a compositor using the YCbCr matrix a track asks for, or the
+        given default if the track does not specify one.
+        """
+        matrix = track.ycbcr_matrix
+        if matrix not in MATRICES:
+            matrix = default
+        return cls(size, format, matrix)
+
+    def make_buffer(self):
+        """ Allocate a cleared frame buffer, holding all planes back to back.
+        """
+        buf = np.empty(self.frame_bytes, np.uint8)
+        self.clear(buf)
+        return buf
+
+    def planes(self, buf):
+        """ Split a frame buffer into ``(y, u, v)`` or ``(y, uv)`` plane
+        views. Tuples of planes are passed through as they are.
+        """
+        if isinstance(buf, tuple):
+            return buf
+
+        width, height = self.size
+        chroma_width, chroma_height = self.chroma_size
+        luma_bytes = width * height
+        chroma_bytes = chroma_width * chroma_height
+
+        y = buf[:luma_bytes].reshape(height, width)
+
+        if self.format == "nv12":
+            uv = buf[luma_bytes:].reshape(chroma_height, chroma_width, 2)
+            return (y, uv)
+
+        u = buf[luma_bytes:luma_bytes + chroma_bytes] \
+            .reshape(chroma_height, chroma_width)
+        v = buf[luma_bytes + chroma_bytes:] \
+            .reshape(chroma_height, chroma_width)
+        return (y, u, v)
+
+    def clear(self, buf):
+        """ Clear a frame to black. """
+        planes = self.planes(buf)
+        black, neutral, _ = rgb_to_yuv(0, 0, 0, self.matrix)
+
+        planes[0].fill(black)
+        for plane in planes[1:]:
+            plane.fill(neutral)
+
+    def _color(self, img):
+        rgb = img.color >> 8
+        try:
+            return self._colors[rgb]
+        except KeyError:
+            color = rgb_to_yuv(rgb >> 16, (rgb >> 8) & 0xff, rgb & 0xff,
+                               self.matrix)
+            self._colors[rgb] = color
+            return color
+
+    @staticmethod
+    def _blend_plane(plane, alpha, value):
+        out = plane * (255 - alpha)
+        out += value * alpha
+        out += 127
+        out //= 255
+        plane[...] = out
+
+    def blend(self, img, planes):
+        """ Blend a single image onto a set of planes. """
+        clipped = clip(img, self.size)
+        if clipped is None:
+            return
+
+        (dst_ys, dst_xs), src_slices = clipped
+        alpha = image_alpha(img, bitmap_array(img)[src_slices])
+        y, u, v = self._color(img)
+
+        YUVCompositor._blend_plane(planes[0][dst_ys, dst_xs], alpha, y)
+
+        # average the alpha over the 2x2 blocks covered by the chroma
+        # samples, padding the image out to even coordinates.
+        cy0 = dst_ys.start // 2
+        cx0 = dst_xs.start // 2
+        cy1 = (dst_ys.stop + 1) // 2
+        cx1 = (dst_xs.stop + 1) // 2
+
+        padded = np.zeros(((cy1 - cy0) * 2, (cx1 - cx0) * 2), np.uint32)
+        oy = dst_ys.start - cy0 * 2
+        ox = dst_xs.start - cx0 * 2
+        padded[oy:oy + alpha.shape[0], ox:ox + alpha.shape[1]] = alpha
+
+        chroma_alpha = padded.reshape(cy1 - cy0, 2, cx1 - cx0, 2) \
+            .sum(axis=(1, 3))
+        chroma_alpha += 2
+        chroma_alpha //= 4
+
+        if len(planes) == 2:
+            YUVCompositor._blend_plane(planes[1][cy0:cy1, cx0:cx1],
+                                       chroma_alpha[..., None],
+                                       np.array([u, v], np.uint32))
+        else:
+            YUVCompositor._blend_plane(planes[1][cy0:cy1, cx0:cx1],
+                                       chroma_alpha, u)
+            YUVCompositor._blend_plane(planes[2][cy0:cy1, cx0:cx1],
+                                       chroma_alpha, v)
+
+    def composite(self, images, buf, clear=True):
+        """ Blend all the images of a rendered frame onto a frame buffer or
+        tuple of planes, clearing it to black first unless told otherwise
+        (e.g. when overlaying onto a video frame).
+        """
+        if clear:
+            self.clear(buf)
+
+        planes = self.planes(buf)
+        for img in images:
+            self.blend(img, planes)
+
+        return buf
@@ -0,0 +1,409 @@
+""" Streaming conversion between ASS and SRT or WebVTT.
+
+Conversions are built as generator pipelines: a reader yields events (or
+cues) one at a time as it reads its file, and a writer formats and writes
+each one as it arrives, so only the current event is held in memory no
+matter how large the input is. Output is written in chunks (see
+``document._WriteBuffer``).
+
+    >>> with open("in.ass") as src, open("out.srt", "w") as dst:
+    ...     write_srt(read_events(src), dst)
+    ...
+
+Events are converted in the order they appear in, as sorting them would
+mean holding all of them.
+"""
+
+import collections
+import copy
+from datetime import timedelta
+import re
+
+from . import document
+
+
+class Cue(collections.namedtuple("Cue", ["start", "end", "text"])):
+    """ An SRT or WebVTT cue, with its text as it appears in the file. """
+    __slots__ = ()
+
+
+def read_events(f):
+    """ Read the events of an ASS file one at a time, skipping every other
+    section.
+    """
+    in_events = False
+    field_order = None
+
+    for i, line in enumerate(f):
+        line = line.rstrip("\r\n")
+        if i == 0:
+            line = line.lstrip(u"\ufeff")
+
+        if not line or line[0] == ";":
+            continue
+
+        if line[0] == "[" and line.rstrip()[-1:] == "]":
+            in_events = line.rstrip().lower() == \
+                document.Document.EVENTS_HEADER.lower()
+            field_order = None
+            continue
+
+        if not in_events:
+            continue
+
+        type_name, line = line.split(":", 1)
+        line = line.lstrip()
+
+        if field_order is None:
+            if type_name.lower() != document.Document.FORMAT_TYPE.lower():
+                raise ValueError("expected format line in events")
+            field_order = [x.strip() for x in line.split(",")]
+            continue
+
+        yield document.EVENT_TYPES[type_name].parse(line, field_order)
+
+
+_TIME = r"(?:(\d+):)?(\d+):(\d+)[,.](\d+)"
+_TIMING_RE = re.compile(r"^\s*" + _TIME + r"\s*-->\s*" + _TIME)
+
+
+def _time(hours, mins, secs, frac):
+    return timedelta(hours=int(hours or 0), minutes=int(mins),
+                     seconds=int(secs), milliseconds=int((frac + "00")[:3]))
+
+
+def _cue(block):
+    for i, line in enumerate(block):
+        m = _TIMING_RE.match(line)
+        if m is not None:
+            return Cue(_time(*m.group(1, 2, 3, 4)), _time(*m.group(5, 6, 7, 8)),
+                       "\n".join(block[i + 1:]))
+
+    # the WEBVTT header, and NOTE, STYLE and REGION blocks.
+    return None
+
+
+def read_cues(f):
+    """ Read the cues of an SRT or WebVTT file one at a time. """
+    block = []
+
+    for i, line in enumerate(f):
+        line = line.rstrip("\r\n")
+        if i == 0:
+            line = line.lstrip(u"\ufeff")
+
+        if line.strip():
+            block.append(line)
+            continue
+
+        if block:
+            cue = _cue(block)
+            if cue is not None:
+                yield cue
+            block = []
+
+    if block:
+        cue = _cue(block)
+        if cue is not None:
+            yield cue
+
+
+_conversion_cache = {}
+_CONVERSION_CACHE_SIZE = 65536
+
+
+def _cached(kind, convert, text):
+    key = (kind, text)
+    try:
+        return _conversion_cache[key]
+    except KeyError:
+        pass
+
+    if len(_conversion_cache) >= _CONVERSION_CACHE_SIZE:
+        _conversion_cache.clear()
+
+    v = _conversion_cache[key] = convert(text)
+    return v
+
+
+# override blocks and the escapes in ASS text.
+_ASS_TOKEN_RE = re.compile(r"\{([^}]*)\}|\\([Nnh])")
+_ASS_STYLE_TAG_RE = re.compile(r"\\(?:([ibu])(\d+)|(r)|(p)(\d+)|"
+                               r"(1?c)(?:&H([0-9a-fA-F]{1,8})&?)?(?![a-z]))")
+
+_HTML_ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;"}
+_HTML_ESCAPE_RE = re.compile(r"[&<>]")
+
+
+def _ass_to_html(text, escape, colors):
+    """ Convert ASS event text to SRT/WebVTT text: line breaks become new
+    lines, italic, bold and underline tags become HTML tags, primary color
+    tags become ``<font color>`` tags if ``colors`` is set, drawings are
+    dropped and every other tag is stripped.
+    """
+    out = []
+    stack = []
+    drawing = [False]
+
+    def is_open(tag):
+        return any(t == tag for t, _ in stack)
+
+    def open_tag(tag, markup):
+        out.append(markup)
+        stack.append((tag, markup))
+
+    def close_tag(tag):
+        # close the tags opened after this one, then reopen them.
+        reopen = []
+        while True:
+            t, markup = stack.pop()
+            out.append("</" + t + ">")
+            if t == tag:
+                break
+            reopen.append((t, markup))
+
+        for t, markup in reversed(reopen):
+            open_tag(t, markup)
+
+    def set_tag(tag, on):
+        if on == is_open(tag):
+            return
+
+        if on:
+            open_tag(tag, "<" + tag + ">")
+        else:
+            close_tag(tag)
+
+    def set_color(bgr):
+        if is_open("font"):
+            close_tag("font")
+
+        # a bare \c goes back to the style's color.
+        if bgr is not None:
+            bgr = bgr.upper().zfill(6)[-6:]
+            open_tag("font", '<font color="#' + bgr[4:6] + bgr[2:4] +
+                     bgr[0:2] + '">')
+
+    def add_text(s):
+        if s and not drawing[0]:
+            out.append(_HTML_ESCAPE_RE.sub(
+                lambda m: _HTML_ESCAPES[m.group(0)], s) if escape else s)
+
+    pos = 0
+    for m in _ASS_TOKEN_RE.finditer(text):
+        add_text(text[pos:m.start()])
+        pos = m.end()
+
+        escape_char = m.group(2)
+        if escape_char == "N":
+            out.append("\n")
+        elif escape_char == "n":
+            add_text(" ")
+        elif escape_char == "h":
+            add_text(u"\u00a0")
+        else:
+            for tag in _ASS_STYLE_TAG_RE.finditer(m.group(1)):
+                if tag.group(1):
+                    set_tag(tag.group(1), int(tag.group(2)) != 0)
+                elif tag.group(3):
+                    while stack:
+                        close_tag(stack[-1][0])
+                elif tag.group(6):
+                    if colors:
+                        set_color(tag.group(7))
+                else:
+                    drawing[0] = int(tag.group(5)) > 0
+
+    add_text(text[pos:])
+
+    for t, _ in reversed(stack):
+        out.append("</" + t + ">")
+
+    return "".join(out).strip("\n")
+
+
+def _srt_text(text):
+    return _ass_to_html(text, False, True)
+
+
+def _vtt_text(text):
+    # WebVTT has no font tag, and colors there need a style sheet.
+    return _ass_to_html(text, True, False)
+
+
+_HTML_TOKEN_RE = re.compile(r"<(/?)([a-zA-Z]+)([^>]*)>|<[^>]*>|"
+                            r"&(amp|lt|gt|nbsp|lrm|rlm);|\n")
+_FONT_COLOR_RE = re.compile(r"color\s*=\s*[\"']?#([0-9a-fA-F]{6})", re.I)
+
+_HTML_ENTITIES = {
+    "amp": "&",
+    "lt": "<",
+    "gt": ">",
+    "nbsp": "\\h",
+    "lrm": u"\u200e",
+    "rlm": u"\u200f"
+}
+
+
+def _html_to_ass(text):
+    """ Convert SRT/WebVTT cue text to ASS event text: new lines become
+    ``\\N``, ``<i>``, ``<b>``, ``<u>`` and ``<font color>`` become override
+    tags, entities are decoded and every other tag is stripped.
+    """
+    def token(m):
+        if m.group(0) == "\n":
+            return "\\N"
+
+        entity = m.group(4)
+        if entity is not None:
+            return _HTML_ENTITIES[entity]
+
+        closing, tag = m.group(1), (m.group(2) or "").lower()
+        if tag in ("i", "b", "u"):
+            return "{\\" + tag + ("0" if closing else "1") + "}"
+
+        if tag == "font":
+            if closing:
+                return "{\\c}"
+            color = _FONT_COLOR_RE.search(m.group(3))
+            if color is not None:
+                rgb = color.group(1).upper()
+                return "{\\c&H" + rgb[4:6] + rgb[2:4] + rgb[0:2] + "&}"
+
+        return ""
+
+    return _HTML_TOKEN_RE.sub(token, text)
+
+
+def _ms(td):
+    return (td.days * 86400 + td.seconds) * 1000 + td.microseconds // 1000
+
+
+def _cue_time(td, separator):
+    ms = max(_ms(td), 0)
+    secs, ms = divmod(ms, 1000)
+    mins, secs = divmod(secs, 60)
+    hours, mins = divmod(mins, 60)
+    return "{:02}:{:02}:{:02}{}{:03}".format(hours, mins, secs, separator, ms)
+
+
+def _write_cues(events, f, convert, separator, numbered):
+    f = document._WriteBuffer(f)
+    n = 0
+
+    # an event often starts when the previous one ends.
+    times = {}
+
+    def cue_time(td):
+        try:
+            return times[td]
+        except KeyError:
+            if len(times) >= 1024:
+                times.clear()
+            v = times[td] = _cue_time(td, separator)
+            return v
+
+    for event in events:
+        if event.TYPE != "Dialogue":
+            continue
+
+        text = _cached(convert.__name__, convert, event.text)
+        if not text.strip():
+            continue
+
+        n += 1
+        f.write((str(n) + "\n" if numbered else "") +
+                cue_time(event.start) + " --> " + cue_time(event.end) + "\n" +
+                text + "\n\n")
+
+    f.flush()
+    return n
+
+
+def write_srt(events, f):
+    """ Write dialogue events to a file as SRT, and return the number of
+    cues written. Events with no text left after conversion (e.g. only a
+    drawing) are skipped.
+    """
+    return _write_cues(events, f, _srt_text, ",", True)
+
+
+def write_vtt(events, f):
+    """ Write dialogue events to a file as WebVTT, like ``write_srt``. """
+    f.write("WEBVTT\n\n")
+    return _write_cues(events, f, _vtt_text, ".", False)
+
+
+def events_from_cues(cues, style="Default"):
+    """ Convert SRT or WebVTT cues to dialogue events one at a time. """
+    for cue in cues:
+        event = document.Dialogue()
+        event.fields.update({
+            "Start": cue.start,
+            "End": cue.end,
+            "Style": style,
+            "Text": _cached("html", _html_to_ass, cue.text)
+        })
+        yield event
+
+
+def write_ass(events, f, header=None):
+    """ Write events to a file as ASS, after the script info, styles and
+    such of ``header`` (by default, an empty document with a default
+    style), and before its sections that come after [Events]. Returns the
+    number of events written.
+    """
+    if header is None:
+        header = document.Document()
+        header.styles.append(document.Style())
+    else:
+        header = copy.copy(header)
+    header.events = []
+
+    # sections that go after [Events] are held back until the events have
+    # been streamed in.
+    trailer = document.Document()
+    trailer.raw_sections = [
+        section for section in header.raw_sections
+        if section.after in (document.Document.EVENTS_HEADER, None)
+    ]
+    header.raw_sections = [
+        section for section in header.raw_sections
+        if section.after not in (document.Document.EVENTS_HEADER, None)
+    ]
+
+    f = document._WriteBuffer(f)
+    # the events go straight after the format line of the [Events] section.
+    f.write(header.dumps().rstrip("\n") + "\n")
+
+    field_order = header.events_field_order
+    n = 0
+    for event in events:
+        f.write(event.dump_with_type(field_order) + "\n")
+        n += 1
+
+    if trailer.raw_sections:
+        f.write("\n")
+        trailer._dump_raw_sections(f, document.Document.EVENTS_HEADER)
+        trailer._dump_raw_sections(f, None)
+
+    f.flush()
+    return n
+
+
+def ass_to_srt(src, dst):
+    """ Convert an ASS file to SRT. """
+    return write_srt(read_events(src), dst)
+
+
+def ass_to_vtt(src, dst):
+    """ Convert an ASS file to WebVTT. """
+    return write_vtt(read_events(src), dst)
+
+
+def srt_to_ass(src, dst, header=None):
+    """ Convert an SRT file to ASS; see ``write_ass``. """
+    return write_ass(events_from_cues(read_cues(src)), dst, header)
+
+
+vtt_to_ass = srt_to_ass
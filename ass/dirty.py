@@ -0,0 +1,108 @@
+""" Tracking of the regions that changed between consecutive rendered frames,
+so that compositors only need to update those.
+"""
+
+import collections
+import ctypes
+
+
+def image_signature(img):
+    """ Identify an image by its placement, color and bitmap contents. """
+    bitmap = ctypes.string_at(img.bitmap, img.stride * img.h) \
+        if img.w > 0 and img.h > 0 else b""
+    return (img.dst_x, img.dst_y, img.w, img.h, img.color, img.type,
+            hash(bitmap))
+
+
+def merge_rects(rects):
+    """ Merge overlapping or touching ``(x, y, w, h)`` rectangles, until none
+    of the remaining ones overlap.
+    """
+    boxes = [[x, y, x + w, y + h] for x, y, w, h in rects if w > 0 and h > 0]
+
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for box in boxes:
+            for other in out:
+                if box[0] <= other[2] and other[0] <= box[2] and \
+                   box[1] <= other[3] and other[1] <= box[3]:
+                    other[0] = min(other[0], box[0])
+                    other[1] = min(other[1], box[1])
+                    other[2] = max(other[2], box[2])
+                    other[3] = max(other[3], box[3])
+                    merged = True
+                    break
+            else:
+                out.append(box)
+        boxes = out
+
+    return sorted((x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in boxes)
+
+
+class DirtyRegions(object):
+    """ Computes the regions of the frame that changed since the previously
+    rendered frame.
+
+    libass' own change detection is used to skip frames that are known to be
+    identical; otherwise images are matched against the previous frame by
+    placement, color and bitmap, and the bounding boxes of the images that
+    appeared or disappeared make up the dirty regions.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self._previous = collections.Counter()
+        self._primed = False
+
+    def reset(self):
+        """ Forget the previous frame, e.g. after seeking, so the next frame
+        is reported as changed wherever it has images.
+        """
+        self._previous = collections.Counter()
+        self._primed = False
+
+    def update(self, images):
+        """ Feed the next rendered frame and get the list of changed
+        ``(x, y, w, h)`` regions, which is empty if nothing changed. Must be
+        called before the next frame is rendered.
+        """
+        if self._primed and getattr(images, "changed", None) == 0:
+            return []
+        self._primed = True
+
+        current = collections.Counter(image_signature(img) for img in images)
+
+        rects = [sig[:4] for sig in (current - self._previous)]
+        rects.extend(sig[:4] for sig in (self._previous - current))
+        self._previous = current
+
+        if self.size is not None:
+            rects = [self._clip(rect) for rect in rects]
+
+        return merge_rects(rects)
+
+    def _clip(self, rect):
+        width, height = self.size
+        x, y, w, h = rect
+
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + w, width)
+        y1 = min(y + h, height)
+
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    @staticmethod
+    def union(rects):
+        """ Get the bounding box of a list of regions, or ``None``. """
+        if not rects:
+            return None
+
+        x0 = min(x for x, y, w, h in rects)
+        y0 = min(y for x, y, w, h in rects)
+        x1 = max(x + w for x, y, w, h in rects)
+        y1 = max(y + h for x, y, w, h in rects)
+
+        return (x0, y0, x1 - x0, y1 - y0)
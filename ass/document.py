@@ -1,5 +1,13 @@
 from datetime import timedelta
+import base64
+import collections
+import copy
 import itertools
+import re
+
+from . import query
+from . import resample as _resample
+from . import timeline
 
 
 class Color(object):
@@ -75,7 +83,27 @@ class _Field(object):
         return obj.fields.get(self.name, self.default)
 
     def __set__(self, obj, v):
+        # the line no longer matches the text it was parsed from.
+        obj.__dict__.pop("_source", None)
+
+        shared = obj.__dict__.get("_shared_fields")
+        if shared is not None:
+            # copy on write, see _Line.fork. the last line left sharing the
+            # dict can write to it in place.
+            del obj._shared_fields
+            shared[0] -= 1
+            if shared[0] > 0:
+                obj.fields = dict(obj.fields)
+
+        observers = obj.__dict__.get("_observers")
+        if not observers:
+            obj.fields[self.name] = v
+            return
+
+        old = obj.fields.get(self.name, self.default)
         obj.fields[self.name] = v
+        for observer in list(observers):
+            observer.field_changed(obj, self.name, old, v)
 
     @staticmethod
     def dump(v):
@@ -158,6 +186,7 @@ class _WithFieldMeta(type):
         newcls._field_mappings = field_mappings
 
         newcls.DEFAULT_FIELD_ORDER = tuple(f.name for f in field_defs)
+        newcls._field_defaults = dict((f.name, f.default) for f in field_defs)
         return newcls
 
 
@@ -203,6 +232,100 @@ def add_metaclass(metaclass):
     return wrapper
 
 
+_UU_ALPHABET = bytes(bytearray(range(33, 97)))
+_B64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+_UU_TO_B64 = bytes.maketrans(_UU_ALPHABET, _B64_ALPHABET)
+_B64_TO_UU = bytes.maketrans(_B64_ALPHABET, _UU_ALPHABET)
+
+
+class EmbeddedFile(object):
+    """ A font or graphic embedded in a [Fonts] or [Graphics] section.
+
+    Embedded files are stored with SSA's own flavor of uuencoding, which is
+    base64 with a different alphabet and no padding. The encoded text is
+    kept as it was read and only decoded when ``data`` is first accessed,
+    which raises ``ValueError`` if it is not valid.
+    """
+    LINE_LENGTH = 80
+
+    def __init__(self, name, data=None, encoded=None):
+        self.name = name
+        self._data = data
+        self._encoded = encoded
+
+    @property
+    def data(self):
+        if self._data is None:
+            encoded = "".join(self._encoded.split()).encode("ascii")
+            if encoded.translate(None, _UU_ALPHABET):
+                raise ValueError("invalid character in embedded file " +
+                                 self.name)
+            encoded = encoded.translate(_UU_TO_B64)
+            self._data = base64.b64decode(encoded + b"=" * (-len(encoded) % 4))
+        return self._data
+
+    @data.setter
+    def data(self, v):
+        self._data = v
+        self._encoded = None
+
+    def encoded_lines(self):
+        """ Get the uuencoded lines of the file. """
+        if self._encoded is None:
+            encoded = base64.b64encode(self._data).rstrip(b"=") \
+                .translate(_B64_TO_UU).decode("ascii")
+            return [encoded[i:i + EmbeddedFile.LINE_LENGTH]
+                    for i in range(0, len(encoded), EmbeddedFile.LINE_LENGTH)]
+        return self._encoded.split()
+
+    def __repr__(self):
+        return "{name}({filename!r})".format(name=self.__class__.__name__,
+                                             filename=self.name)
+
+
+class RawSection(object):
+    """ A section python-ass does not know about, such as
+    [Aegisub Project Garbage], kept as unparsed text and written back
+    verbatim.
+
+    ``after`` is the header of the known section it followed, which is
+    where it is written back to; sections with no ``after`` go at the end.
+    ``newline`` is the line break it was read with, which it is written back
+    with too.
+    """
+
+    def __init__(self, name, text, after=None, newline="\n"):
+        self.name = name
+        self.text = text
+        self.after = after
+        self.newline = newline
+
+    def __repr__(self):
+        return "{name}({section!r})".format(name=self.__class__.__name__,
+                                            section=self.name)
+
+
+class Changes(collections.namedtuple("Changes",
+                                     ["fields", "styles_added",
+                                      "styles_removed", "events_added",
+                                      "events_removed", "events_reordered",
+                                      "sections"])):
+    """ What ``Document.reparse_string`` changed: the names of the script
+    info fields that changed, the styles and events that were added and
+    removed, whether the events that were kept changed order, and the names
+    of the other sections ([Fonts], [Graphics] and unknown ones) that
+    changed.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.fields or self.styles_added or self.styles_removed or
+                    self.events_added or self.events_removed or
+                    self.events_reordered or self.sections)
+
+    __nonzero__ = __bool__
+
+
 class Tag(object):
     """ A tag in ASS, e.g. {\\b1}. Multiple can be used like {\\b1\\i1}. """
 
@@ -249,6 +372,274 @@ class Tag(object):
         raise NotImplementedError
 
 
+_timedelta_cache = {}
+_TIMEDELTA_CACHE_SIZE = 65536
+
+
+def _dump_timedelta(td):
+    try:
+        return _timedelta_cache[td]
+    except KeyError:
+        pass
+
+    if len(_timedelta_cache) >= _TIMEDELTA_CACHE_SIZE:
+        _timedelta_cache.clear()
+
+    v = _timedelta_cache[td] = _Field.timedelta_to_ass(td)
+    return v
+
+
+# how to format a value of a field's declared type, as a fast path for
+# _Field.dump; values of any other type still go through _Field.dump.
+_TYPE_FORMATS = {
+    str: "{v}",
+    int: "str({v})",
+    float: "format({v}, 'g')",
+    bool: "('-1' if {v} else '0')",
+    timedelta: "_dump_timedelta({v})",
+    Color: "{v}.to_ass()"
+}
+
+_formatters = {}
+
+
+def _formatter(cls, field_order):
+    """ Get a function that dumps the fields dict of a line of the given
+    class, in the given field order, to text (without its type). The
+    function is generated on first use, with the formatting of each field
+    specialized to the field's declared type.
+    """
+    key = (cls, tuple(field_order))
+    try:
+        return _formatters[key]
+    except KeyError:
+        pass
+
+    namespace = {
+        "_dump": _Field.dump,
+        "_dump_timedelta": _dump_timedelta,
+        "Color": Color,
+        "timedelta": timedelta
+    }
+
+    lines = ["def dump(fields):"]
+    names = []
+
+    for i, field_name in enumerate(field_order):
+        name = "v{}".format(i)
+        names.append(name)
+
+        lines.append("    {} = fields[{!r}]".format(name, field_name))
+
+        field = cls._field_mappings.get(field_name)
+        fmt = _TYPE_FORMATS.get(field.type) if field is not None else None
+        if fmt is None:
+            lines.append("    {0} = _dump({0})".format(name))
+            continue
+
+        namespace["T{}".format(i)] = field.type
+        lines.append("    {0} = {1} if {0}.__class__ is T{2} else _dump({0})"
+                     .format(name, fmt.format(v=name), i))
+
+    lines.append("    return " + (" + ',' + ".join(names) or "''"))
+
+    exec("\n".join(lines), namespace)
+    dump = _formatters[key] = namespace["dump"]
+    return dump
+
+
+_timedelta_parse_cache = {}
+
+
+def _parse_timedelta(v):
+    try:
+        return _timedelta_parse_cache[v]
+    except KeyError:
+        pass
+
+    if len(_timedelta_parse_cache) >= _TIMEDELTA_CACHE_SIZE:
+        _timedelta_parse_cache.clear()
+
+    td = _timedelta_parse_cache[v] = _Field.timedelta_from_ass(v)
+    return td
+
+
+# like _TYPE_FORMATS, how to parse a field of a given declared type.
+_TYPE_PARSES = {
+    str: "{v}",
+    int: "int({v})",
+    float: "float({v})",
+    bool: "bool(-int({v}))",
+    timedelta: "_parse_timedelta({v})",
+    Color: "Color.from_ass({v})"
+}
+
+_parsers = {}
+
+
+def _parser(cls, field_order):
+    """ Get a function that parses the text of a line of the given class
+    (without its type) in the given field order to a fields dict. Like
+    ``_formatter``, it is generated on first use.
+    """
+    key = (cls, tuple(field_order))
+    try:
+        return _parsers[key]
+    except KeyError:
+        pass
+
+    namespace = {
+        "_parse_timedelta": _parse_timedelta,
+        "Color": Color
+    }
+
+    n = len(field_order)
+    names = ["v{}".format(i) for i in range(n)]
+    items = []
+
+    for i, field_name in enumerate(field_order):
+        field = cls._field_mappings.get(field_name)
+        if field is None:
+            value = names[i]
+        elif field.type in _TYPE_PARSES:
+            value = _TYPE_PARSES[field.type].format(v=names[i])
+        else:
+            namespace["F{}".format(i)] = field
+            value = "F{}.parse({})".format(i, names[i])
+        items.append("{!r}: {}".format(field_name, value))
+
+    lines = [
+        "def parse(line):",
+        "    parts = line.split(',', {})".format(n - 1),
+        "    if len(parts) != {}:".format(n),
+        "        raise ValueError('arity of line does not match arity of "
+        "field order')",
+        "    {}, = parts".format(", ".join(names)),
+        "    return {{{}}}".format(", ".join(items))
+    ]
+
+    exec("\n".join(lines), namespace)
+    parse = _parsers[key] = namespace["parse"]
+    return parse
+
+
+class _WriteBuffer(object):
+    """ Collects writes into large chunks, passing them on to a file object
+    once they grow past ``CHUNK_SIZE`` characters, or keeping all of them if
+    there is no file.
+    """
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, f=None):
+        self._f = f
+        self._parts = []
+        self._size = 0
+
+    def write(self, s):
+        self._parts.append(s)
+        self._size += len(s)
+        if self._f is not None and self._size >= self.CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self._f.write("".join(self._parts))
+            self._parts = []
+            self._size = 0
+
+    def getvalue(self):
+        return "".join(self._parts)
+
+
+class _EventList(list):
+    """ The list of events of a document, which keeps the document's event
+    index (if it has one) up to date as it is modified.
+    """
+
+    def __init__(self, doc, events=()):
+        list.__init__(self, events)
+        self._doc = doc
+
+    def __reduce_ex__(self, protocol):
+        return (list, (list(self),))
+
+    def _index(self):
+        return self._doc._event_index
+
+    def append(self, event):
+        list.append(self, event)
+        index = self._index()
+        if index is not None:
+            index.added([event])
+
+    def extend(self, events):
+        events = list(events)
+        list.extend(self, events)
+        index = self._index()
+        if index is not None:
+            index.added(events)
+
+    def __iadd__(self, events):
+        self.extend(events)
+        return self
+
+    def insert(self, i, event):
+        list.insert(self, i, event)
+        index = self._index()
+        if index is not None:
+            index.added([event], ordered=False)
+
+    def __setitem__(self, i, v):
+        removed = self[i] if isinstance(i, slice) else [self[i]]
+        if isinstance(i, slice):
+            v = list(v)
+        list.__setitem__(self, i, v)
+
+        index = self._index()
+        if index is not None:
+            index.removed(removed)
+            index.added(v if isinstance(i, slice) else [v], ordered=False)
+
+    def __delitem__(self, i):
+        removed = self[i] if isinstance(i, slice) else [self[i]]
+        list.__delitem__(self, i)
+        index = self._index()
+        if index is not None:
+            index.removed(removed)
+
+    def remove(self, event):
+        list.remove(self, event)
+        index = self._index()
+        if index is not None:
+            index.removed([event])
+
+    def pop(self, i=-1):
+        event = list.pop(self, i)
+        index = self._index()
+        if index is not None:
+            index.removed([event])
+        return event
+
+    def clear(self):
+        # __delitem__ tells the index.
+        del self[:]
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        index = self._index()
+        if index is not None:
+            index.reordered()
+
+    def reverse(self):
+        list.reverse(self)
+        index = self._index()
+        if index is not None:
+            index.reordered()
+
+    def __imul__(self, n):
+        raise TypeError("cannot repeat the events of a document in place")
+
+
 @add_metaclass(_WithFieldMeta)
 class Document(object):
     """ An ASS document. """
@@ -256,6 +647,8 @@ class Document(object):
     STYLE_SSA_HEADER = "[V4 Styles]"
     STYLE_ASS_HEADER = "[V4+ Styles]"
     EVENTS_HEADER = "[Events]"
+    FONTS_HEADER = "[Fonts]"
+    GRAPHICS_HEADER = "[Graphics]"
 
     FORMAT_TYPE = "Format"
 
@@ -277,112 +670,513 @@ class Document(object):
         self.styles = []
         self.styles_field_order = Style.DEFAULT_FIELD_ORDER
 
+        self._event_index = None
         self.events = []
         self.events_field_order = _Event.DEFAULT_FIELD_ORDER
 
+        self.fonts = []
+        self.graphics = []
+
+        self.raw_sections = []
+
+    def __getstate__(self):
+        # copies get their own event list, and build their own index.
+        state = self.__dict__.copy()
+        state["_events"] = list(self._events)
+        state["_event_index"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._events = _EventList(self, self._events)
+
+    def __copy__(self):
+        doc = self.__class__.__new__(self.__class__)
+        doc.__setstate__(self.__getstate__())
+        return doc
+
+    def __deepcopy__(self, memo):
+        # a plain copy of the state, so that the memo keeps lines shared
+        # with the rest of what is being copied.
+        doc = self.__class__.__new__(self.__class__)
+        memo[id(self)] = doc
+        doc.__setstate__(copy.deepcopy(self.__getstate__(), memo))
+        return doc
+
+    def __reduce__(self):
+        # pickles go through the compact packed format, see the packed
+        # module.
+        from . import packed
+        return (packed.unpack, (packed.pack(self), self.__class__))
+
+    def share(self, name=None):
+        """ Put a packed copy of this document in shared memory, for other
+        processes to attach to with ``packed.SharedDocument.attach`` and
+        read without copying it. See ``packed.SharedDocument``.
+        """
+        from . import packed
+        return packed.SharedDocument.share(self, name)
+
+    @property
+    def events(self):
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        if self._event_index is not None:
+            self._event_index.detach()
+            self._event_index = None
+        self._events = _EventList(self, events)
+
+    def fork(self):
+        """ Make a cheap copy of this document, for making variants of it.
+
+        Styles and events are forked (see ``_Line.fork``) rather than
+        copied, so they share their fields with the originals until one side
+        sets a field, and only then is that line's field dict copied. Making
+        a fork costs a small object per line, rather than a full copy of
+        every line and its values. Embedded files and raw sections are
+        copied shallowly, so their data and text are shared until replaced.
+        """
+        doc = copy.copy(self)
+        doc.fields = dict(self.fields)
+
+        doc.styles = [style.fork() for style in self.styles]
+        doc.styles_field_order = list(self.styles_field_order)
+
+        doc.events = [event.fork() for event in self.events]
+        doc.events_field_order = list(self.events_field_order)
+
+        doc.fonts = [copy.copy(embedded) for embedded in self.fonts]
+        doc.graphics = [copy.copy(embedded) for embedded in self.graphics]
+        doc.raw_sections = [copy.copy(section)
+                            for section in self.raw_sections]
+        return doc
+
+    def select(self, type=None, style=None, name=None, layer=None,
+               effect=None, text=None, word=None):
+        """ Find the events matching all of the given criteria, in document
+        order. Each of ``type`` (an event class or its type name, e.g.
+        ``"Dialogue"``), ``style``, ``name``, ``layer`` and ``effect`` can be
+        a single value or a list of values to match any of. ``text`` matches
+        a substring and ``word`` a whole word of the event text, ignoring
+        case, override tags and line breaks.
+
+        Indexes are built on first use and kept up to date as events are
+        added, removed or have their fields set. Changes made directly to an
+        event's ``fields`` dict are not tracked.
+        """
+        if self._event_index is None:
+            self._event_index = query.EventIndex(self._events)
+
+        return self._event_index.select(type=type, style=style, name=name,
+                                        layer=layer, effect=effect,
+                                        text=text, word=word)
+
+    def resample(self, x, y):
+        """ Change the script resolution to ``x`` by ``y``, rescaling the
+        styles (font size, spacing, outline, shadow and margins), the event
+        margins and the positional and size override tags in event texts
+        (``\\pos``, ``\\move``, ``\\org``, ``\\clip``, ``\\fs``,
+        ``\\bord``, ``\\shad`` and the like, as well as drawings) to match.
+
+        Borders and shadows are only rescaled if ``ScaledBorderAndShadow``
+        is on, as otherwise they are in video pixels. Resampled texts are
+        cached, so texts repeated across events and documents are only
+        rewritten once.
+        """
+        _resample.resample(self, x, y)
+
+    def to_records(self):
+        """ Convert the events to ``records.EventRecords``, a NumPy
+        structured array with times in milliseconds and interned style,
+        actor name and effect ids. This needs NumPy.
+        """
+        from . import records
+        return records.to_records(self.events)
+
     @classmethod
-    def parse_file(cls, f):
-        """ Parse an ASS document from a file object.
+    def from_records(cls, table):
+        """ Make a document with the events of ``records.EventRecords``, e.g.
+        ones loaded with ``records.load``. This needs NumPy.
         """
+        from . import records
+
         doc = cls()
+        doc.events = records.from_records(table)
+        return doc
 
-        lines = ((i, line)
-                 for i, line in ((i, line.rstrip("\r\n"))
-                                 for i, line in enumerate(f))
-                 if line and line[0] != ";")
+    # a section header, e.g. [Events], on a line of its own.
+    _SECTION_RE = re.compile(r"^\[([^\r\n]*)\][ \t]*\r?$", re.M)
 
-        # [Script Info]
-        for i, line in lines:
-            if i == 0 and line[:3] == "\xef\xbb\xbf":
-                line = line[3:]
+    # the headers that can end a [Fonts] or [Graphics] section, whose
+    # uuencoded lines can look like section headers themselves.
+    _KNOWN_HEADERS = frozenset(header.lower() for header in (
+        SCRIPT_INFO_HEADER, STYLE_SSA_HEADER, STYLE_ASS_HEADER,
+        EVENTS_HEADER, FONTS_HEADER, GRAPHICS_HEADER))
+
+    _EMBEDDED_FILE_RES = {
+        "fonts": re.compile(r"^fontname:[ \t]*(.*?)[ \t]*\r?$", re.M | re.I),
+        "graphics": re.compile(r"^filename:[ \t]*(.*?)[ \t]*\r?$", re.M | re.I)
+    }
+
+    @classmethod
+    def parse_file(cls, f, track_source=False):
+        """ Parse an ASS document from a file object. See ``parse_string``
+        for ``track_source``.
+        """
+        return cls.parse_string(f.read(), track_source)
+
+    def reparse_file(self, f):
+        """ Update this document to match an edited version of the file it
+        was parsed from; see ``reparse_string``.
+        """
+        return self.reparse_string(f.read())
+
+    def reparse_string(self, text):
+        """ Update this document to match an edited version of the text it
+        was parsed from, and return the ``Changes`` made.
+
+        Styles and events whose line is unchanged (under the same format
+        line) are kept as they are rather than parsed again, so only the
+        edited lines cost anything, and the kept lines stay the same
+        objects. A line that has had a field set since it was parsed is
+        replaced by a fresh one; changes made directly to its ``fields``
+        dict, or to field values in place, go unnoticed.
+
+        Lines are only kept if the document was parsed with
+        ``track_source``; otherwise the first reparse parses everything
+        again. Lines parsed here always keep their source, so the next
+        reparse can reuse them.
+        """
+        # lines that appear more than once map to a list of them, last first.
+        reuse = {}
+        for lines, field_order in ((self.styles, self.styles_field_order),
+                                   (self.events, self.events_field_order)):
+            key = tuple(field_order)
+            for line in reversed(lines):
+                source = line.__dict__.get("_source")
+                if source is None:
+                    continue
+
+                k = (key, source)
+                prev = reuse.get(k)
+                if prev is None:
+                    reuse[k] = line
+                elif isinstance(prev, list):
+                    prev.append(line)
+                else:
+                    reuse[k] = [prev, line]
+
+        new = self.__class__()
+        new._parse_sections(text, reuse, True)
+
+        fields = set(name for name in set(self.fields) | set(new.fields)
+                     if self.fields.get(name) != new.fields.get(name))
+        self.fields = new.fields
+
+        old_styles = set(self.styles)
+        new_styles = set(new.styles)
+        styles_removed = [style for style in self.styles
+                          if style not in new_styles]
+        styles_added = [style for style in new.styles
+                        if style not in old_styles]
+        self.styles = new.styles
+        self.styles_field_order = new.styles_field_order
+
+        old_events = list(self.events)
+        new_events = list(new.events)
+        old_positions = dict(zip(old_events, itertools.count()))
+        new_set = set(new_events)
+
+        events_removed = [event for event in old_events
+                          if event not in new_set]
+        events_added = [event for event in new_events
+                        if event not in old_positions]
+
+        kept = [old_positions[event] for event in new_events
+                if event in old_positions]
+        events_reordered = any(a > b for a, b in zip(kept, kept[1:]))
+
+        # replace only the run of events between the unchanged head and
+        # tail, so that the event index is updated for just that run.
+        limit = min(len(old_events), len(new_events))
+        head = 0
+        while head < limit and old_events[head] is new_events[head]:
+            head += 1
+        tail = 0
+        while tail < limit - head and \
+                old_events[-tail - 1] is new_events[-tail - 1]:
+            tail += 1
+        if head + tail < max(len(old_events), len(new_events)):
+            self.events[head:len(old_events) - tail] = \
+                new_events[head:len(new_events) - tail]
+        self.events_field_order = new.events_field_order
+
+        sections = set()
+        for name, kind in ((Document.FONTS_HEADER, "fonts"),
+                           (Document.GRAPHICS_HEADER, "graphics")):
+            old_files = getattr(self, kind)
+            new_files = getattr(new, kind)
+            if [(f.name, f._encoded) for f in old_files] != \
+               [(f.name, f._encoded) for f in new_files]:
+                sections.add(name)
+                setattr(self, kind, new_files)
+
+        old_raw = dict((section.name, (section.text, section.after))
+                       for section in self.raw_sections)
+        new_raw = dict((section.name, (section.text, section.after))
+                       for section in new.raw_sections)
+        sections.update("[" + name + "]"
+                        for name in set(old_raw) | set(new_raw)
+                        if old_raw.get(name) != new_raw.get(name))
+        self.raw_sections = new.raw_sections
+
+        return Changes(fields, styles_added, styles_removed, events_added,
+                       events_removed, events_reordered, sections)
+
+    @staticmethod
+    def _lines(body):
+        """ Iterate over the non-empty, non-comment lines of a section. """
+        for line in body.split("\n"):
+            line = line.rstrip("\r")
+            if line and line[0] != ";":
+                yield line
 
-            if i == 0 and line[0] == u"\ufeff":
-                line = line.strip(u"\ufeff")
+    @classmethod
+    def parse_string(cls, text, track_source=False):
+        """ Parse an ASS document from a string. With ``track_source``, each
+        style and event keeps the line it was parsed from, which lets
+        ``reparse_string`` reuse unchanged lines at the cost of that memory.
+        """
+        doc = cls()
+        doc._parse_sections(text, track_source=track_source)
+        return doc
 
-            if line[0] == ";":
+    @staticmethod
+    def _sections(text):
+        """ Find the section headers of a string. Like libass, only a known
+        header ends a [Fonts] or [Graphics] section.
+        """
+        embedded = (Document.FONTS_HEADER.lower(),
+                    Document.GRAPHICS_HEADER.lower())
+        sections = []
+        in_embedded = False
+
+        for section in Document._SECTION_RE.finditer(text):
+            header = "[" + section.group(1).lower() + "]"
+            if in_embedded and header not in Document._KNOWN_HEADERS:
                 continue
+            in_embedded = header in embedded
+            sections.append(section)
+
+        return sections
+
+    def _parse_sections(self, text, reuse=None, track_source=False):
+        """ Parse the sections of a string into this (empty) document. If
+        given, ``reuse`` maps ``(field order, line)`` to a list of lines
+        previously parsed from that line, to take instead of parsing again.
+        With ``track_source``, new lines keep the line they were parsed from.
+        """
+        doc = self
 
-            if line.lower() == Document.SCRIPT_INFO_HEADER.lower():
-                break
+        if text[:3] == "\xef\xbb\xbf":
+            text = text[3:]
 
+        text = text.lstrip(u"\ufeff")
+
+        sections = Document._sections(text)
+
+        # [Script Info]
+        if not sections or \
+           any(Document._lines(text[:sections[0].start()])) or \
+           "[" + sections[0].group(1).lower() + "]" != \
+           Document.SCRIPT_INFO_HEADER.lower():
             raise ValueError("expected script info header")
 
+        after = None
+
+        for i, section in enumerate(sections):
+            end = sections[i + 1].start() if i + 1 < len(sections) \
+                else len(text)
+            body = text[section.end():end]
+
+            header = "[" + section.group(1).lower() + "]"
+
+            if header == Document.SCRIPT_INFO_HEADER.lower():
+                doc._parse_script_info(body)
+                after = Document.SCRIPT_INFO_HEADER
+            elif header in (Document.STYLE_ASS_HEADER.lower(),
+                            Document.STYLE_SSA_HEADER.lower()):
+                doc._parse_styles(body, reuse, track_source)
+                after = Document.STYLE_ASS_HEADER
+            elif header == Document.EVENTS_HEADER.lower():
+                doc._parse_events(body, reuse, track_source)
+                after = Document.EVENTS_HEADER
+            elif header == Document.FONTS_HEADER.lower():
+                doc.fonts.extend(Document._parse_embedded(body, "fonts"))
+                after = Document.FONTS_HEADER
+            elif header == Document.GRAPHICS_HEADER.lower():
+                doc.graphics.extend(Document._parse_embedded(body,
+                                                             "graphics"))
+                after = Document.GRAPHICS_HEADER
+            else:
+                # keep the section as one slice of the input, without the
+                # line break after the header and the blank lines at the end.
+                # the header match takes the \r of a \r\n with it.
+                newline = "\r\n" if section.group(0).endswith("\r") \
+                    else "\n"
+                if body[:1] == "\n":
+                    body = body[1:]
+
+                doc.raw_sections.append(RawSection(section.group(1),
+                                                   body.rstrip("\r\n"),
+                                                   after, newline))
+
+    def _parse_script_info(self, body):
         # field_name: field
-        for i, line in lines:
-            if (doc.script_type.lower() == doc.VERSION_ASS.lower() and
-                line.lower() == Document.STYLE_ASS_HEADER.lower()) or \
-               (doc.script_type.lower() == doc.VERSION_SSA.lower() and
-                line.lower() == Document.STYLE_SSA_HEADER.lower()):
-               break
-
+        for line in Document._lines(body):
             field_name, field = line.split(":", 1)
             field = field.lstrip()
 
             if field_name in Document._field_mappings:
                 field = Document._field_mappings[field_name].parse(field)
 
-            doc.fields[field_name] = field
+            self.fields[field_name] = field
 
-        # [V4 Styles]
-        i, line = next(lines)
+    def _parse_styles(self, body, reuse=None, track_source=False):
+        field_order = None
 
-        type_name, line = line.split(":", 1)
-        line = line.lstrip()
+        for source in Document._lines(body):
+            type_name, line = source.split(":", 1)
+            line = line.lstrip()
+
+            # Format: ...
+            if field_order is None:
+                if type_name.lower() != Document.FORMAT_TYPE.lower():
+                    raise ValueError("expected format line in styles")
+
+                field_order = [x.strip() for x in line.split(",")]
+                self.styles_field_order = field_order
+                key = tuple(field_order)
+                continue
 
-        # Format: ...
-        if type_name.lower() != Document.FORMAT_TYPE.lower():
-            raise ValueError("expected format line in styles")
+            # Style: ...
+            if type_name.lower() != Style.TYPE.lower():
+                raise ValueError("expected style line in styles")
 
-        field_order = [x.strip() for x in line.split(",")]
-        doc.styles_field_order = field_order
+            style = Document._reused(reuse, key, source)
+            if style is None:
+                style = Style.parse(line, field_order)
+                if track_source:
+                    style._source = source
+            self.styles.append(style)
 
-        # Style: ...
-        for i, line in lines:
-            if line.lower() == Document.EVENTS_HEADER.lower():
-                break
+    def _parse_events(self, body, reuse=None, track_source=False):
+        field_order = None
+        events = []
 
-            type_name, line = line.split(":", 1)
+        for source in Document._lines(body):
+            type_name, line = source.split(":", 1)
             line = line.lstrip()
 
-            if type_name.lower() != Style.TYPE.lower():
-                raise ValueError("expected style line in styles")
+            # Format: ...
+            if field_order is None:
+                if type_name.lower() != Document.FORMAT_TYPE.lower():
+                    raise ValueError("expected format line in events")
 
-            doc.styles.append(Style.parse(line, field_order))
+                field_order = [x.strip() for x in line.split(",")]
+                self.events_field_order = field_order
+                key = tuple(field_order)
+                continue
 
-        # [Events]
-        i, line = next(lines)
+            event = Document._reused(reuse, key, source)
+            if event is None:
+                # Dialogue: ...
+                # Comment: ...
+                # etc.
+                event = EVENT_TYPES[type_name].parse(line, field_order)
+                if track_source:
+                    event._source = source
+            events.append(event)
 
-        type_name, line = line.split(":", 1)
-        line = line.lstrip()
+        self.events.extend(events)
 
-        # Format: ...
-        if type_name.lower() != Document.FORMAT_TYPE.lower():
-            raise ValueError("expected format line in events")
+    @staticmethod
+    def _reused(reuse, key, source):
+        if not reuse:
+            return None
 
-        field_order = [x.strip() for x in line.split(",")]
-        doc.events_field_order = field_order
+        line = reuse.pop((key, source), None)
+        if isinstance(line, list):
+            lines = line
+            line = lines.pop()
+            if lines:
+                reuse[(key, source)] = lines
+        return line
 
-        # Dialogue: ...
-        # Comment: ...
-        # etc.
-        for i, line in lines:
-            type_name, line = line.split(":", 1)
-            line = line.lstrip()
+    @staticmethod
+    def _parse_embedded(body, kind):
+        """ Split a [Fonts] or [Graphics] section into its files, without
+        decoding them.
+        """
+        names = list(Document._EMBEDDED_FILE_RES[kind].finditer(body))
 
-            doc.events.append(({
-                "Dialogue": Dialogue,
-                "Comment":  Comment,
-                "Picture":  Picture,
-                "Sound":    Sound,
-                "Movie":    Movie,
-                "Command":  Command
-            })[type_name].parse(line, field_order))
+        for i, name in enumerate(names):
+            end = names[i + 1].start() if i + 1 < len(names) else len(body)
+            yield EmbeddedFile(name.group(1), encoded=body[name.end():end])
 
-        return doc
+    def segments(self):
+        """ Split the dialogue events into segments between event boundaries,
+        each a ``timeline.Segment`` of ``(start, end, events, static)``.
+        Nothing can change on screen within a static segment.
+        """
+        return timeline.segments((event.start, event.end,
+                                  timeline.is_animated(event.text,
+                                                       event.effect),
+                                  event)
+                                 for event in self.events
+                                 if event.TYPE == "Dialogue")
 
     def dump_file(self, f):
-        """ Dump this ASS document to a file object.
+        """ Dump this ASS document to a file object. Output is collected
+        into large chunks before being written to the file.
+        """
+        f = _WriteBuffer(f)
+        self._dump_sections(f)
+        f.flush()
+
+    def dumps(self):
+        """ Dump this ASS document to a string. """
+        f = _WriteBuffer()
+        self._dump_sections(f)
+        return f.getvalue()
+
+    def dump_bytes(self, encoding="utf-8"):
+        """ Dump this ASS document to encoded bytes, e.g. for
+        ``Context.parse_to_track``.
         """
+        return self.dumps().encode(encoding)
+
+    def _dump_sections(self, f):
+        self._dump_script_info(f)
+        self._dump_raw_sections(f, Document.SCRIPT_INFO_HEADER)
+
+        self._dump_styles(f)
+        self._dump_raw_sections(f, Document.STYLE_ASS_HEADER)
+
+        self._dump_embedded(f, Document.FONTS_HEADER, "fontname", self.fonts)
+        self._dump_raw_sections(f, Document.FONTS_HEADER)
+
+        self._dump_embedded(f, Document.GRAPHICS_HEADER, "filename",
+                            self.graphics)
+        self._dump_raw_sections(f, Document.GRAPHICS_HEADER)
+
+        self._dump_events(f)
+        self._dump_raw_sections(f, Document.EVENTS_HEADER)
+        self._dump_raw_sections(f, None)
+
+    def _dump_script_info(self, f):
         f.write(Document.SCRIPT_INFO_HEADER + "\n")
         for k in itertools.chain((field for field in self.DEFAULT_FIELD_ORDER
                                   if field in self.fields),
@@ -391,20 +1185,62 @@ class Document(object):
             f.write(k + ": " + _Field.dump(self.fields[k]) + "\n")
         f.write("\n")
 
+    def _dump_styles(self, f):
         f.write(Document.STYLE_ASS_HEADER + "\n")
         f.write(Document.FORMAT_TYPE +  ": " +
                 ", ".join(self.styles_field_order) + "\n")
-        for style in self.styles:
-            f.write(style.dump_with_type(self.styles_field_order) + "\n")
+        self._dump_lines(f, self.styles, self.styles_field_order)
         f.write("\n")
 
+    @staticmethod
+    def _dump_lines(f, lines, field_order):
+        formatters = {}
+        out = []
+
+        for line in lines:
+            cls = line.__class__
+            try:
+                prefix, dump = formatters[cls]
+            except KeyError:
+                prefix, dump = formatters[cls] = \
+                    (line.TYPE + ": ", _formatter(cls, field_order))
+
+            out.append(prefix + dump(line.fields) + "\n")
+            if len(out) >= 4096:
+                f.write("".join(out))
+                out = []
+
+        f.write("".join(out))
+
+    @staticmethod
+    def _dump_embedded(f, header, key, files):
+        if not files:
+            return
+
+        f.write(header + "\n")
+        for embedded in files:
+            f.write(key + ": " + embedded.name + "\n")
+            f.write("\n".join(embedded.encoded_lines()) + "\n")
+        f.write("\n")
+
+    def _dump_events(self, f):
         f.write(Document.EVENTS_HEADER + "\n")
         f.write(Document.FORMAT_TYPE +  ": " +
                 ", ".join(self.events_field_order) + "\n")
-        for event in self.events:
-            f.write(event.dump_with_type(self.events_field_order) + "\n")
+        self._dump_lines(f, self.events, self.events_field_order)
         f.write("\n")
 
+    def _dump_raw_sections(self, f, after):
+        for section in self.raw_sections:
+            if section.after != after:
+                continue
+
+            newline = section.newline
+            f.write("[" + section.name + "]" + newline)
+            if section.text:
+                f.write(section.text + newline)
+            f.write(newline)
+
 
 @add_metaclass(_WithFieldMeta)
 class _Line(object):
@@ -420,6 +1256,32 @@ class _Line(object):
             else:
                 self.fields[k] = v
 
+    def fork(self):
+        """ Make a copy of this line that shares its fields with it until
+        either of them has a field set. Field values themselves are never
+        copied, so mutable ones (e.g. ``Color``) should be replaced rather
+        than modified in place.
+        """
+        # the lines sharing a dict share a count of them, too.
+        shared = self.__dict__.get("_shared_fields")
+        if shared is None:
+            shared = self._shared_fields = [1]
+        shared[0] += 1
+
+        line = self.__class__.__new__(self.__class__)
+        line.fields = self.fields
+        line._shared_fields = shared
+        if "_source" in self.__dict__:
+            line._source = self._source
+        return line
+
+    def __getstate__(self):
+        # observers are indexes of whatever document the line is in, which
+        # copies and pickles should not drag along.
+        state = self.__dict__.copy()
+        state.pop("_observers", None)
+        return state
+
     def dump(self, field_order=None):
         """ Dump an ASS line into text format. Has an optional field order
         parameter in case you have some wonky format.
@@ -427,8 +1289,7 @@ class _Line(object):
         if field_order is None:
             field_order = self.DEFAULT_FIELD_ORDER
 
-        return ",".join(_Field.dump(self.fields[field])
-                        for field in field_order)
+        return _formatter(self.__class__, field_order)(self.fields)
 
     def dump_with_type(self, field_order=None):
         """ Dump an ASS line into text format, with its type prepended. """
@@ -442,19 +1303,12 @@ class _Line(object):
         if field_order is None:
             field_order = cls.DEFAULT_FIELD_ORDER
 
-        parts = line.split(",", len(field_order) - 1)
-
-        if len(parts) != len(field_order):
-            raise ValueError("arity of line does not match arity of field order")
-
-        fields = {}
-
-        for field_name, field in zip(field_order, parts):
-            if field_name in cls._field_mappings:
-                field = cls._field_mappings[field_name].parse(field)
-            fields[field_name] = field
-
-        return cls(**fields)
+        # this is what __init__ would do with the fields as keyword
+        # arguments, minus going through their descriptors.
+        self = cls.__new__(cls)
+        self.fields = dict(cls._field_defaults)
+        self.fields.update(_parser(cls, field_order)(line))
+        return self
 
 
 class Style(_Line):
@@ -464,7 +1318,7 @@ class Style(_Line):
 
     name = _Field("Name", str, default="Default")
     fontname = _Field("Fontname", str, default="Arial")
-    fontsize = _Field("Fontsize", float, default=20)
+    fontsize = _Field("Fontsize", float, default=20.0)
     primary_color = _Field("PrimaryColour", Color, default=Color.WHITE)
     secondary_color = _Field("SecondaryColour", Color, default=Color.RED)
     outline_color = _Field("OutlineColour", Color, default=Color.BLACK)
@@ -473,13 +1327,13 @@ class Style(_Line):
     italic = _Field("Italic", bool, default=False)
     underline = _Field("Underline", bool, default=False)
     strike_out = _Field("StrikeOut", bool, default=False)
-    scale_x = _Field("ScaleX", float, default=100)
-    scale_y = _Field("ScaleY", float, default=100)
-    spacing = _Field("Spacing", float, default=0)
-    angle = _Field("Angle", float, default=0)
+    scale_x = _Field("ScaleX", float, default=100.0)
+    scale_y = _Field("ScaleY", float, default=100.0)
+    spacing = _Field("Spacing", float, default=0.0)
+    angle = _Field("Angle", float, default=0.0)
     border_style = _Field("BorderStyle", int, default=1)
-    outline = _Field("Outline", float, default=2)
-    shadow = _Field("Shadow", float, default=2)
+    outline = _Field("Outline", float, default=2.0)
+    shadow = _Field("Shadow", float, default=2.0)
     alignment = _Field("Alignment", int, default=2)
     margin_l = _Field("MarginL", int, default=10)
     margin_r = _Field("MarginR", int, default=10)
@@ -534,3 +1388,13 @@ class Command(_Event):
     """ A command event. Not widely supported.
     """
     TYPE = "Command"
+
+
+EVENT_TYPES = {
+    "Dialogue": Dialogue,
+    "Comment":  Comment,
+    "Picture":  Picture,
+    "Sound":    Sound,
+    "Movie":    Movie,
+    "Command":  Command
+}
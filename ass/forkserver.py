@@ -0,0 +1,158 @@
+""" A fork server for render jobs.
+
+Setting up fonts (``Renderer.set_fonts``) can take seconds on a cold
+fontconfig cache. A fork server does that once in a parent process, then
+forks a worker for every job submitted over a local Unix socket; each worker
+inherits the warmed-up renderer and only needs to load its track.
+
+This relies on ``os.fork``, so it is only available on Unix.
+"""
+
+import json
+import os
+import select
+import socket
+
+
+def warm_renderer(size=(640, 480), ctx=None, **fonts):
+    """ Make a context and a renderer with its fonts set up, ready to be
+    shared with forked workers. Keyword arguments go to ``set_fonts``.
+    A context can be passed in, e.g. one with a script's embedded fonts
+    already added, as those must be added before the fonts are set up.
+    """
+    from . import renderer
+
+    if ctx is None:
+        ctx = renderer.Context()
+    r = ctx.make_renderer()
+    r.set_fonts(**fonts)
+    r.set_all_sizes(size)
+    return ctx, r
+
+
+def _error(e):
+    return {"error": "{}: {}".format(type(e).__name__, e)}
+
+
+def _send(sock, obj):
+    sock.sendall(json.dumps(obj).encode("utf-8") + b"\n")
+
+
+def _recv(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            break
+    return json.loads(b"".join(chunks).decode("utf-8"))
+
+
+class ForkServer(object):
+    """ Serves jobs on a Unix socket by forking a worker per job.
+
+    ``handler(state, request)`` runs in the worker with the state prepared
+    in the parent (e.g. the ``(ctx, renderer)`` pair from
+    ``warm_renderer``) and the JSON request sent by the client; its return
+    value is sent back as JSON. If it raises, or returns something that
+    cannot be sent as JSON, the client gets an ``{"error": ...}`` response
+    instead.
+
+    Workers are forked from whichever thread calls ``serve_one``, and only
+    that thread survives in them. Serve from the main thread, or from one
+    that holds no locks the handler may need, so that a worker cannot
+    inherit a lock held by a thread that no longer exists.
+    """
+
+    def __init__(self, address, handler, state):
+        self.address = address
+        self.handler = handler
+        self.state = state
+
+        if os.path.exists(address):
+            os.unlink(address)
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(address)
+        self._sock.listen(64)
+
+        self._children = set()
+        self._closed = False
+
+    def _reap(self):
+        for pid in list(self._children):
+            done, _ = os.waitpid(pid, os.WNOHANG)
+            if done:
+                self._children.discard(pid)
+
+    def _work(self, conn):
+        status = 0
+        try:
+            try:
+                response = json.dumps(self.handler(self.state, _recv(conn)))
+            except Exception as e:
+                status = 1
+                response = json.dumps(_error(e))
+            conn.sendall(response.encode("utf-8") + b"\n")
+        finally:
+            os._exit(status)
+
+    def serve_one(self, timeout=None):
+        """ Wait for a single job and fork a worker for it. Returns whether a
+        job was accepted before the timeout.
+        """
+        self._reap()
+
+        ready, _, _ = select.select([self._sock], [], [], timeout)
+        if not ready:
+            return False
+
+        conn, _ = self._sock.accept()
+
+        pid = os.fork()
+        if pid == 0:
+            self._sock.close()
+            self._work(conn)
+
+        conn.close()
+        self._children.add(pid)
+        return True
+
+    def serve_forever(self, poll_interval=0.5):
+        """ Serve jobs until ``close`` is called. """
+        while not self._closed:
+            try:
+                self.serve_one(poll_interval)
+            except (OSError, ValueError):
+                if self._closed:
+                    break
+                raise
+
+    def close(self):
+        """ Stop serving and wait for the running workers to finish. """
+        self._closed = True
+        self._sock.close()
+
+        for pid in list(self._children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self._children.clear()
+
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+def submit(address, request, timeout=None):
+    """ Submit a job to a fork server and wait for its response. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        _send(sock, request)
+        return _recv(sock)
+    finally:
+        sock.close()
@@ -0,0 +1,200 @@
+""" Reusable buffers for rendered frames.
+
+The images ``Renderer.render_frame`` returns point into memory libass
+reuses on the next render, so keeping a frame around means copying it.
+Copying into fresh objects every frame churns memory; the pools here hand
+out buffers that are reused once released, so that once they have grown to
+fit the largest frame, rendering allocates no new buffers.
+"""
+
+import ctypes
+import itertools
+import threading
+
+
+class PooledImage(object):
+    """ A copied image, with the same attributes as ``renderer.Image``. Its
+    bitmap points into the ``PooledFrame`` it belongs to.
+    """
+    __slots__ = ("w", "h", "stride", "bitmap", "color", "dst_x", "dst_y",
+                 "type", "_offset", "_address")
+
+    def __init__(self):
+        self._address = None
+
+    @property
+    def rgba(self):
+        color = self.color
+        return (color >> 24 & 0xff, color >> 16 & 0xff, color >> 8 & 0xff,
+                color & 0xff)
+
+
+class PooledFrame(object):
+    """ A copy of the images of a rendered frame, which stays valid after
+    later renders until it is released back to its pool. Iterate over it
+    like over an ``ImageSequence``; it can be used as a context manager to
+    release it at the end of the block. Releasing it again does nothing.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._data = None
+        self._capacity = 0
+        self._images = []
+        self._n = 0
+        self._released = True
+
+    def _reserve(self, size, keep):
+        """ Make room for ``size`` bytes, keeping the first ``keep``. """
+        if size <= self._capacity:
+            return
+        capacity = max(size, self._capacity * 2, 4096)
+        data = (ctypes.c_char * capacity)()
+        if keep:
+            ctypes.memmove(data, self._data, keep)
+        self._data = data
+        self._capacity = capacity
+
+    def fill(self, images):
+        """ Copy the given images into this frame, in a single pass over
+        them. Once the frame has grown to fit, refilling it with a frame of
+        the same layout allocates nothing.
+        """
+        copies = self._images
+        offset = 0
+        n = 0
+
+        for img in images:
+            size = img.stride * img.h if img.w > 0 and img.h > 0 else 0
+            if size:
+                self._reserve(offset + size, offset)
+                ctypes.memmove(ctypes.addressof(self._data) + offset,
+                               img.bitmap, size)
+
+            if n == len(copies):
+                copies.append(PooledImage())
+            copy = copies[n]
+            copy.w = img.w
+            copy.h = img.h
+            copy.stride = img.stride
+            copy.color = img.color
+            copy.dst_x = img.dst_x
+            copy.dst_y = img.dst_y
+            copy.type = img.type
+            copy._offset = offset
+
+            offset += size
+            n += 1
+
+        # the data can move as it grows, so the bitmaps are only pointed
+        # into it at the end, reusing the pointers that are still right.
+        base = ctypes.addressof(self._data) if self._data is not None else 0
+        for copy in itertools.islice(copies, n):
+            address = base + copy._offset
+            if copy._address != address:
+                copy.bitmap = ctypes.cast(address,
+                                          ctypes.POINTER(ctypes.c_char))
+                copy._address = address
+
+        self._n = n
+        self._released = False
+        return self
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        return itertools.islice(self._images, self._n)
+
+    def release(self):
+        """ Hand this frame back to its pool for reuse. """
+        if self._released:
+            return
+        self._released = True
+        self._n = 0
+        self._pool._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class _Pool(object):
+    def __init__(self, count, factory):
+        self._lock = threading.Lock()
+        self._free = [factory() for _ in range(count)]
+        self._factory = factory
+        self.allocated = count
+
+    def acquire(self):
+        """ Take a free item from the pool, making a new one if there is
+        none left.
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.allocated += 1
+        return self._factory()
+
+    def _release(self, item):
+        with self._lock:
+            self._free.append(item)
+
+
+class FramePool(_Pool):
+    """ A pool of ``PooledFrame`` copies of rendered frames. ``frames`` are
+    preallocated, and more are made if they are all in use at once.
+    """
+
+    def __init__(self, frames=2):
+        _Pool.__init__(self, frames, lambda: PooledFrame(self))
+
+    def copy(self, images):
+        """ Copy the images of a frame into a frame from the pool. """
+        return self.acquire().fill(images)
+
+
+class _PooledBuffer(object):
+    def __init__(self, pool, buf):
+        self._pool = pool
+        self.buf = buf
+
+    def __enter__(self):
+        return self.buf
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._pool.release(self.buf)
+
+
+class BufferPool(_Pool):
+    """ A pool of output buffers, e.g. frame buffers for a compositor:
+
+        >>> pool = BufferPool(compositor.make_buffer)
+        >>> with pool.buffer() as buf:
+        ...     compositor.composite(images, buf)
+        ...
+
+    ``make_buffer`` is called for the ``buffers`` preallocated ones, and
+    whenever all of them are in use at once.
+    """
+
+    def __init__(self, make_buffer, buffers=2):
+        _Pool.__init__(self, buffers, make_buffer)
+
+    def release(self, buf):
+        """ Hand a buffer taken with ``acquire`` back to the pool. Raises
+        ``ValueError`` if it is already back in the pool.
+        """
+        with self._lock:
+            # by identity, as buffers such as arrays do not compare as bools.
+            if any(free is buf for free in self._free):
+                raise ValueError("buffer released twice")
+            self._free.append(buf)
+
+    def buffer(self):
+        """ Take a buffer from the pool for the duration of a ``with``
+        block.
+        """
+        return _PooledBuffer(self, self.acquire())
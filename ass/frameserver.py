@@ -0,0 +1,348 @@
+""" An asyncio server for composited subtitle overlays.
+
+Clients connect over a local TCP or Unix socket and ask for the overlay of a
+script at a given time. Scripts are loaded into tracks the first time they
+are asked for, and the most recently used tracks and frames are kept.
+Concurrent requests for the same frame are coalesced into a single render.
+Rendering runs in a pool of worker threads, each with its own renderer, so
+the event loop is never blocked on libass.
+
+The protocol is line-based JSON, like that of ``forkserver``. A request is a
+line such as ``{"track": "ep01.ass", "time": 1500}``, with the time in
+milliseconds. The response is a JSON line with the ``x``, ``y``, ``w`` and
+``h`` of the overlay in the frame and the ``length`` of its data, followed
+by that many bytes of straight-alpha RGBA pixels. If the request fails, the
+response is an ``{"error": ...}`` line with no data. A connection can make
+any number of requests, answered in order.
+
+Compositing needs NumPy, which is not otherwise required by python-ass.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import socket
+import threading
+
+
+class Overlay(collections.namedtuple("Overlay",
+                                     ["x", "y", "w", "h", "data"])):
+    """ The part of a frame covered by subtitles, as ``w * h * 4`` bytes of
+    RGBA at ``(x, y)`` in the frame. Empty if nothing is on screen.
+    """
+    __slots__ = ()
+
+
+EMPTY_OVERLAY = Overlay(0, 0, 0, 0, b"")
+
+
+def _error(e):
+    return {"error": "{}: {}".format(type(e).__name__, e)}
+
+
+class FrameServer(object):
+    """ Serves overlays of the scripts under ``root``, which requests refer
+    to by their path relative to it, rendered at ``size``. Keyword arguments
+    go to ``Renderer.set_fonts`` for each worker's renderer.
+
+    Up to ``max_tracks`` tracks and ``max_frames`` overlays are kept, least
+    recently used first out. Renders for the same track are serialized, as a
+    libass track cannot be rendered by two renderers at once; different
+    tracks render in parallel on up to ``workers`` threads.
+
+    ``load_track`` and ``render`` run on the worker threads and can be
+    overridden to serve something other than files rendered by libass.
+    """
+
+    def __init__(self, root, size=(640, 480), workers=4, max_tracks=8,
+                 max_frames=256, **fonts):
+        self.root = os.path.realpath(root)
+        self.size = size
+        self.fonts = fonts
+        self.max_tracks = max_tracks
+        self.max_frames = max_frames
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._local = threading.local()
+        self._ctx = None
+        self._ctx_lock = threading.Lock()
+
+        # name -> (track, lock), and (name, ms) -> Overlay.
+        self._tracks = collections.OrderedDict()
+        self._frames = collections.OrderedDict()
+
+        # loads and renders in progress, which later requests wait on.
+        self._loading = {}
+        self._rendering = {}
+
+        self._server = None
+        self.address = None
+
+        self.renders = 0
+        self.coalesced = 0
+        self.frame_hits = 0
+        self.track_loads = 0
+
+    def _context(self):
+        with self._ctx_lock:
+            if self._ctx is None:
+                from . import renderer
+                self._ctx = renderer.Context()
+            return self._ctx
+
+    def path(self, name):
+        """ Get the path of a script, which must be under ``root``. """
+        path = os.path.realpath(os.path.join(self.root, name))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError("track outside of root: " + name)
+        return path
+
+    def load_track(self, name):
+        """ Load a script into a track. Runs on a worker thread. """
+        from . import document
+
+        with open(self.path(name), encoding="utf_8_sig") as f:
+            doc = document.Document.parse_file(f)
+
+        ctx = self._context()
+        with self._ctx_lock:
+            return ctx.track_from_document(doc)
+
+    def _renderer(self):
+        local = self._local
+        if getattr(local, "renderer", None) is None:
+            from .compositor import Compositor
+
+            ctx = self._context()
+            with self._ctx_lock:
+                local.renderer = ctx.make_renderer()
+            local.renderer.set_fonts(**self.fonts)
+            local.renderer.set_all_sizes(self.size)
+            local.compositor = Compositor(self.size, "rgba")
+            local.buf = local.compositor.make_buffer()
+        return local.renderer, local.compositor, local.buf
+
+    def render(self, track, ms):
+        """ Render a track at a time in milliseconds into an ``Overlay``.
+        Runs on a worker thread.
+        """
+        from datetime import timedelta
+
+        renderer, compositor, buf = self._renderer()
+        width, height = self.size
+
+        with renderer.render_frame(track,
+                                   timedelta(milliseconds=ms)) as images:
+            x0, y0, x1, y1 = width, height, 0, 0
+            for img in images:
+                if img.w <= 0 or img.h <= 0:
+                    continue
+                x0 = min(x0, img.dst_x)
+                y0 = min(y0, img.dst_y)
+                x1 = max(x1, img.dst_x + img.w)
+                y1 = max(y1, img.dst_y + img.h)
+
+            x0, y0 = max(x0, 0), max(y0, 0)
+            x1, y1 = min(x1, width), min(y1, height)
+            if x0 >= x1 or y0 >= y1:
+                return EMPTY_OVERLAY
+
+            compositor.composite(images, buf)
+
+        return Overlay(x0, y0, x1 - x0, y1 - y0, buf[y0:y1, x0:x1].tobytes())
+
+    def _render_locked(self, entry, ms):
+        track, lock = entry
+        with lock:
+            return self.render(track, ms)
+
+    @staticmethod
+    def _put(cache, key, value, limit):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+    async def _shared(self, pending, key, make):
+        """ Await the result of ``make()``, or of the call already in
+        progress for ``key``. Cancelling one waiter leaves the others.
+        """
+        future = pending.get(key)
+        if future is None:
+            future = pending[key] = asyncio.ensure_future(make())
+            future.add_done_callback(lambda _: pending.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    async def _load(self, name):
+        loop = asyncio.get_running_loop()
+        track = await loop.run_in_executor(self._executor, self.load_track,
+                                           name)
+        self.track_loads += 1
+        entry = (track, threading.Lock())
+        self._put(self._tracks, name, entry, self.max_tracks)
+        return entry
+
+    async def track(self, name):
+        """ Get the ``(track, lock)`` of a script, loading it if needed. """
+        entry = self._tracks.get(name)
+        if entry is not None:
+            self._tracks.move_to_end(name)
+            return entry
+        return await self._shared(self._loading, name,
+                                  lambda: self._load(name))
+
+    async def _render(self, name, ms):
+        entry = await self.track(name)
+        loop = asyncio.get_running_loop()
+        overlay = await loop.run_in_executor(self._executor,
+                                             self._render_locked, entry, ms)
+        self.renders += 1
+        self._put(self._frames, (name, ms), overlay, self.max_frames)
+        return overlay
+
+    async def frame(self, name, ms):
+        """ Get the ``Overlay`` of a script at a time in milliseconds. """
+        key = (name, ms)
+        overlay = self._frames.get(key)
+        if overlay is not None:
+            self._frames.move_to_end(key)
+            self.frame_hits += 1
+            return overlay
+        return await self._shared(self._rendering, key,
+                                  lambda: self._render(name, ms))
+
+    def invalidate(self, name):
+        """ Forget the track and overlays of a script, e.g. after it has been
+        edited, so that it is loaded again on the next request.
+        """
+        self._tracks.pop(name, None)
+        for key in [key for key in self._frames if key[0] == name]:
+            del self._frames[key]
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    overlay = await self.frame(request["track"],
+                                               int(request["time"]))
+                except Exception as e:
+                    writer.write(json.dumps(_error(e)).encode("utf-8") +
+                                 b"\n")
+                else:
+                    header = {"x": overlay.x, "y": overlay.y,
+                              "w": overlay.w, "h": overlay.h,
+                              "length": len(overlay.data)}
+                    writer.write(json.dumps(header).encode("utf-8") + b"\n")
+                    writer.write(overlay.data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, address=("127.0.0.1", 0)):
+        """ Start serving on a ``(host, port)`` TCP address, or the path of a
+        Unix socket. The address actually bound to (e.g. the port picked for
+        port 0) is kept as ``address``.
+        """
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self._server = await asyncio.start_unix_server(self._handle,
+                                                           address)
+            self.address = address
+        else:
+            host, port = address
+            self._server = await asyncio.start_server(self._handle, host,
+                                                      port)
+            self.address = self._server.sockets[0].getsockname()[:2]
+        return self._server
+
+    async def serve_forever(self, address=("127.0.0.1", 0)):
+        """ Serve until cancelled. """
+        await self.start(address)
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """ Stop serving and shut down the worker threads. """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+            if isinstance(self.address, str) and \
+                    os.path.exists(self.address):
+                os.unlink(self.address)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
+
+    def stats(self):
+        return {
+            "renders": self.renders,
+            "coalesced": self.coalesced,
+            "frame_hits": self.frame_hits,
+            "track_loads": self.track_loads,
+            "tracks": len(self._tracks),
+            "frames": len(self._frames)
+        }
+
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ConnectionError("connection closed")
+    return data
+
+
+class FrameClient(object):
+    """ A blocking client for a ``FrameServer``, over one connection. """
+
+    def __init__(self, address, timeout=None):
+        family = socket.AF_UNIX if isinstance(address, str) \
+            else socket.AF_INET
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(tuple(address) if family == socket.AF_INET
+                           else address)
+        self._f = self._sock.makefile("rb")
+
+    def frame(self, name, ms):
+        """ Get the ``Overlay`` of a script at a time in milliseconds. Raises
+        ``RuntimeError`` with the server's message if the request failed.
+        """
+        self._sock.sendall(json.dumps({"track": name, "time": ms})
+                           .encode("utf-8") + b"\n")
+
+        line = self._f.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+
+        header = json.loads(line.decode("utf-8"))
+        if "error" in header:
+            raise RuntimeError(header["error"])
+
+        return Overlay(header["x"], header["y"], header["w"], header["h"],
+                       _read_exactly(self._f, header["length"]))
+
+    def close(self):
+        self._f.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,498 @@
+""" A compact binary encoding of documents, for pickling them and for
+sharing them between processes through shared memory.
+
+A packed document is one contiguous buffer: a header, a table of sections,
+and the sections themselves. The events and styles are stored a column per
+field, as flat arrays of numbers; strings are ids into a string table, which
+is stored as one UTF-8 blob plus the offsets of each string in it. Times are
+in microseconds and colors as ``Color.to_int``. Everything else about the
+document (script info, field orders, embedded files, raw sections), and any
+line that does not fit the columns (e.g. one with extra fields or values of
+unexpected types), is pickled into a small metadata section.
+
+``PackedDocument`` reads a packed buffer in place, so a process that
+attaches to a ``SharedDocument`` can look at the columns and strings without
+copying them, and only builds line objects for what it asks for.
+"""
+
+from array import array
+from datetime import timedelta
+import itertools
+import operator
+import pickle
+import struct
+import sys
+
+from . import document
+
+VERSION = 1
+MAGIC = b"ASSD"
+
+# magic, version, byte order of the columns (0 little, 1 big), number of
+# sections. The header and section table are always little-endian.
+_HEADER = struct.Struct("<4sHBxI")
+_SECTION = struct.Struct("<QQ")
+
+_BYTE_ORDER = 0 if sys.byteorder == "little" else 1
+
+# the array typecode each field type is stored as.
+_TYPECODES = {
+    str: "i",
+    int: "q",
+    float: "d",
+    bool: "B",
+    timedelta: "q",
+    document.Color: "I"
+}
+
+_I32_MIN = -2 ** 31
+_I32_MAX = 2 ** 31 - 1
+_I64_MIN = -2 ** 63
+_I64_MAX = 2 ** 63 - 1
+
+_ONE_US = timedelta(microseconds=1)
+
+# attributes of a line besides its fields that do not need to be kept.
+_LINE_ATTRS = frozenset(["fields", "_shared_fields", "_source", "_observers"])
+
+_MISSING = object()
+
+_EVENT_CLASSES = (document.Dialogue, document.Comment, document.Picture,
+                  document.Sound, document.Movie, document.Command)
+
+
+def _us(td):
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+
+
+def _valid(v, type):
+    cls = v.__class__
+    if type is str:
+        return cls is str
+    if type is bool:
+        return cls is bool
+    if type is int:
+        return cls is int and _I64_MIN <= v <= _I64_MAX
+    if type is float:
+        # an int would come back as a float, so it goes with the odd lines.
+        return cls is float
+    if type is timedelta:
+        return cls is timedelta and _I64_MIN <= _us(v) <= _I64_MAX
+    if type is document.Color:
+        return cls is document.Color and all(
+            c.__class__ is int and 0 <= c <= 255
+            for c in (v.r, v.g, v.b, v.a))
+    return False
+
+
+def _bad_rows(values, type):
+    """ Get the indices of the values that cannot be stored in a column of
+    the given type, checking whole columns at once where possible.
+    """
+    if not values:
+        return []
+
+    classes = set(map(operator.attrgetter("__class__"), values))
+
+    if classes <= set([type]):
+        if type in (str, bool, float):
+            return []
+        if type in (int, timedelta) and \
+                _valid(min(values), type) and _valid(max(values), type):
+            return []
+
+    return [i for i, v in enumerate(values) if not _valid(v, type)]
+
+
+def _columns(lines, classes, field_defs):
+    """ Get the values of each field of the lines that fit the columns, as
+    a list of ``(field, values)``, and the ``(index, line)`` of those that do
+    not.
+    """
+    n = len(field_defs)
+    bad = set(i for i, line in enumerate(lines)
+              if line.__class__ not in classes or
+              len(line.fields) != n or
+              not _LINE_ATTRS.issuperset(line.__dict__))
+
+    fields = [line.fields for line in lines]
+    columns = []
+    for field in field_defs:
+        values = list(map(operator.methodcaller("get", field.name, _MISSING),
+                          fields))
+        bad.update(_bad_rows(values, field.type))
+        columns.append((field, values))
+
+    if not bad:
+        return columns, []
+
+    return ([(field, [v for i, v in enumerate(values) if i not in bad])
+             for field, values in columns],
+            [(i, line) for i, line in enumerate(lines) if i in bad])
+
+
+def _typecode(type, values):
+    if type is int and values and \
+            min(values) >= _I32_MIN and max(values) <= _I32_MAX:
+        return "i"
+    return _TYPECODES[type]
+
+
+class _Writer(object):
+    def __init__(self):
+        self.strings = {}
+        self.sections = []
+
+    def intern(self, values):
+        """ Get the string ids of a list of strings. """
+        strings = self.strings
+        for v in dict.fromkeys(values):
+            if v not in strings:
+                strings[v] = len(strings)
+        return list(map(strings.__getitem__, values))
+
+    def columns(self, columns):
+        """ Add a section per column, and return their ``(field name,
+        typecode)``.
+        """
+        layout = []
+        for field, values in columns:
+            if field.type is str:
+                values = self.intern(values)
+            elif field.type is timedelta:
+                values = list(map(operator.floordiv, values,
+                                  itertools.repeat(_ONE_US)))
+            elif field.type is document.Color:
+                values = [v.to_int() for v in values]
+
+            typecode = _typecode(field.type, values)
+            self.sections.append(array(typecode, values))
+            layout.append((field.name, typecode))
+        return layout
+
+    def string_table(self):
+        encoded = [s.encode("utf-8", "surrogatepass") for s in self.strings]
+        offsets = array("q", [0])
+        offsets.extend(itertools.accumulate(map(len, encoded)))
+        return b"".join(encoded), offsets
+
+
+def pack(doc):
+    """ Pack a document into ``bytes``. """
+    events = list(doc.events)
+    event_columns, odd_events = _columns(events, _EVENT_CLASSES,
+                                         document._Event._field_defs)
+    style_columns, odd_styles = _columns(list(doc.styles), (document.Style,),
+                                         document.Style._field_defs)
+
+    writer = _Writer()
+
+    odd = set(i for i, _ in odd_events)
+    type_ids = dict((cls, i) for i, cls in enumerate(_EVENT_CLASSES))
+    writer.sections.append(array("B", [type_ids[event.__class__]
+                                       for i, event in enumerate(events)
+                                       if i not in odd]))
+    n_events = len(events) - len(odd_events)
+    n_styles = len(doc.styles) - len(odd_styles)
+    event_columns = writer.columns(event_columns)
+    style_columns = writer.columns(style_columns)
+
+    data, offsets = writer.string_table()
+
+    state = doc.__getstate__()
+    del state["_events"], state["_event_index"], state["styles"]
+
+    meta = pickle.dumps({
+        "events": (n_events, event_columns, odd_events),
+        "styles": (n_styles, style_columns, odd_styles),
+        "event_types": [cls.TYPE for cls in _EVENT_CLASSES],
+        "strings": len(writer.strings),
+        "state": state
+    }, pickle.HIGHEST_PROTOCOL)
+
+    sections = [meta, data, offsets] + writer.sections
+
+    # sections are 8-byte aligned, for the widest columns.
+    layout = []
+    pos = _HEADER.size + _SECTION.size * len(sections)
+    for section in sections:
+        pos += -pos % 8
+        size = len(section) * getattr(section, "itemsize", 1)
+        layout.append((pos, size))
+        pos += size
+
+    buf = bytearray(pos)
+    _HEADER.pack_into(buf, 0, MAGIC, VERSION, _BYTE_ORDER, len(sections))
+    for i, (offset, size) in enumerate(layout):
+        _SECTION.pack_into(buf, _HEADER.size + _SECTION.size * i, offset, size)
+        section = sections[i]
+        buf[offset:offset + size] = \
+            section.tobytes() if isinstance(section, array) else section
+
+    return bytes(buf)
+
+
+class PackedDocument(object):
+    """ A packed document, read in place from any buffer (``bytes``, an
+    ``mmap``, the buffer of a ``SharedMemory``...).
+
+    Columns are ``memoryview`` objects into the buffer; call ``release``
+    when done with them, or use the packed document as a context manager,
+    as some buffers (e.g. shared memory) cannot be closed while views into
+    them exist.
+    """
+
+    def __init__(self, buf):
+        self._buf = memoryview(buf).cast("B")
+        self._views = [self._buf]
+
+        magic, version, byte_order, n = _HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            raise ValueError("not a packed document")
+        if version != VERSION:
+            raise ValueError("unsupported packed document version: {}"
+                             .format(version))
+        self._swapped = byte_order != _BYTE_ORDER
+
+        self._sections = [
+            _SECTION.unpack_from(self._buf, _HEADER.size + _SECTION.size * i)
+            for i in range(n)
+        ]
+
+        meta = self._meta()
+        self._event_types = [document.EVENT_TYPES[name]
+                             for name in meta["event_types"]]
+
+        self.n_strings = meta["strings"]
+        self._string_data = self._section(1)
+        self._string_offsets = self._array(2, "q")
+
+        self._columns = {}
+        self._lengths = {}
+        self._n_odd = {}
+
+        i = 3
+        self._type_section = i
+        i += 1
+        for kind in ("events", "styles"):
+            n, columns, odd = meta[kind]
+            self._lengths[kind] = n
+            self._n_odd[kind] = len(odd)
+            for name, typecode in columns:
+                self._columns[kind, name] = (i, typecode)
+                i += 1
+
+        self._strings = None
+
+    def _meta(self):
+        # loaded afresh whenever lines are built, so that every document
+        # built gets its own copies of what was pickled.
+        return pickle.loads(self._section(0))
+
+    def _section(self, i):
+        offset, size = self._sections[i]
+        view = self._buf[offset:offset + size]
+        self._views.append(view)
+        return view
+
+    def _array(self, i, typecode):
+        view = self._section(i)
+        if not self._swapped:
+            view = view.cast(typecode)
+            self._views.append(view)
+            return view
+
+        # columns from a machine of the other byte order are copied.
+        a = array(typecode)
+        a.frombytes(view)
+        a.byteswap()
+        return a
+
+    @property
+    def n_events(self):
+        """ The number of events, including those that did not fit the
+        columns.
+        """
+        return self._lengths["events"] + self._n_odd["events"]
+
+    @property
+    def n_styles(self):
+        return self._lengths["styles"] + self._n_odd["styles"]
+
+    def string(self, i):
+        """ Decode a single string of the string table. """
+        offsets = self._string_offsets
+        return str(self._string_data[offsets[i]:offsets[i + 1]], "utf-8",
+                   "surrogatepass")
+
+    def strings(self):
+        """ Decode the whole string table. """
+        if self._strings is None:
+            data = self._string_data.tobytes()
+            offsets = self._string_offsets.tolist()
+            self._strings = [data[a:b].decode("utf-8", "surrogatepass")
+                             for a, b in zip(offsets, offsets[1:])]
+        return self._strings
+
+    def column(self, kind, name):
+        """ Get the column of a field (e.g. ``"Start"``) of the ``"events"``
+        or ``"styles"`` that fit the columns, as stored: string ids, times in
+        microseconds, colors as integers.
+        """
+        i, typecode = self._columns[kind, name]
+        return self._array(i, typecode)
+
+    def event_types(self):
+        """ Get the event classes of the events that fit the columns. """
+        types = self._event_types
+        return [types[i] for i in self._array(self._type_section, "B")]
+
+    def _lines(self, kind, classes, odd):
+        strings = self.strings()
+
+        field_defs = document.Style._field_defs if kind == "styles" \
+            else document._Event._field_defs
+
+        names = []
+        columns = []
+        for field in field_defs:
+            values = self.column(kind, field.name).tolist()
+            if field.type is str:
+                values = list(map(strings.__getitem__, values))
+            elif field.type is timedelta:
+                # events often start when others end, so times repeat.
+                unique = list(set(values))
+                times = dict(zip(unique, map(timedelta, itertools.repeat(0),
+                                             itertools.repeat(0), unique)))
+                values = list(map(times.__getitem__, values))
+            elif field.type is bool:
+                values = list(map(bool, values))
+            elif field.type is document.Color:
+                values = [document.Color(v >> 24, v >> 16 & 0xff,
+                                         v >> 8 & 0xff, v & 0xff)
+                          for v in values]
+            names.append(field.name)
+            columns.append(values)
+
+        # skip __init__, which would go through every field's descriptor.
+        lines = list(map(object.__new__, classes))
+        for line, values in zip(lines, zip(*columns)):
+            line.fields = dict(zip(names, values))
+
+        for i, line in odd:
+            lines.insert(i, line)
+
+        return lines
+
+    def events(self, meta=None):
+        """ Build all of the events. """
+        if meta is None:
+            meta = self._meta()
+        return self._lines("events", self.event_types(), meta["events"][2])
+
+    def styles(self, meta=None):
+        """ Build all of the styles. """
+        if meta is None:
+            meta = self._meta()
+        return self._lines("styles",
+                           [document.Style] * self._lengths["styles"],
+                           meta["styles"][2])
+
+    def document(self, cls=document.Document):
+        """ Build the whole document. """
+        meta = self._meta()
+
+        doc = cls.__new__(cls)
+        doc.__dict__.update(meta["state"])
+        doc.styles = self.styles(meta)
+        doc._event_index = None
+        doc.events = self.events(meta)
+        return doc
+
+    def release(self):
+        """ Release the views into the buffer. """
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def unpack(data, cls=document.Document):
+    """ Unpack a document packed with ``pack``. """
+    with PackedDocument(data) as packed:
+        return packed.document(cls)
+
+
+def _attach(name):
+    from multiprocessing import shared_memory
+
+    try:
+        # the process that made the segment owns it, so attaching must not
+        # register it for cleanup (Python 3.13+).
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name)
+
+
+class SharedDocument(object):
+    """ A packed document in a ``multiprocessing.shared_memory`` segment.
+
+    The process that shares a document keeps the ``SharedDocument`` made by
+    ``share`` and passes its ``name`` to workers, which ``attach`` to it and
+    read it through ``packed`` without copying it. The segment is freed
+    when the sharing process calls ``unlink`` (or leaves a ``with`` block),
+    once every process has closed it.
+    """
+
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self._owner = owner
+        self.packed = PackedDocument(shm.buf)
+
+    @classmethod
+    def share(cls, doc, name=None):
+        """ Pack a document into a new shared memory segment. """
+        from multiprocessing import shared_memory
+
+        data = pack(doc)
+        shm = shared_memory.SharedMemory(name, create=True,
+                                         size=max(len(data), 1))
+        shm.buf[:len(data)] = data
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, name):
+        """ Attach to a document shared by another process. """
+        return cls(_attach(name), False)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def document(self, cls=document.Document):
+        """ Build a copy of the whole document in this process. """
+        return self.packed.document(cls)
+
+    def close(self):
+        """ Detach from the segment. """
+        if self.packed is not None:
+            self.packed.release()
+            self.packed = None
+            self._shm.close()
+
+    def unlink(self):
+        """ Free the segment once every process has closed it. """
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if self._owner:
+            self.unlink()
@@ -0,0 +1,335 @@
+""" Encoding of rendered subtitles as Blu-ray PGS (``.sup``) bitmap subtitles.
+
+This needs NumPy, which is not otherwise required by python-ass.
+"""
+
+import struct
+
+import numpy as np
+
+from .compositor import Compositor
+from .ycbcr import MATRIX_BT601_TV, MATRIX_BT709_TV, rgb_to_yuv
+
+SEGMENT_PDS = 0x14
+SEGMENT_ODS = 0x15
+SEGMENT_PCS = 0x16
+SEGMENT_WDS = 0x17
+SEGMENT_END = 0x80
+
+STATE_NORMAL = 0x00
+STATE_ACQUISITION_POINT = 0x40
+STATE_EPOCH_START = 0x80
+
+_MAGIC = b"PG"
+_HEADER = struct.Struct(">2sIIBH")
+_MAX_SEGMENT = 0xffff
+
+
+def rle_encode(indices):
+    """ Run-length encode a ``(h, w)`` array of palette indices as PGS object
+    data. Runs are found and their codes laid out with array operations.
+    """
+    h, w = indices.shape
+    if not h or not w:
+        return b""
+
+    flat = np.ascontiguousarray(indices, np.uint8).reshape(-1)
+
+    is_start = np.ones(flat.size, bool)
+    is_start[1:] = flat[1:] != flat[:-1]
+    is_start[::w] = True
+
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, flat.size))
+    values = flat[starts]
+
+    rows = starts // w
+    ends_row = np.append(rows[1:] != rows[:-1], True)
+
+    colored = values != 0
+    short = lengths < 64
+
+    one = colored & (lengths == 1)
+    two = colored & (lengths == 2)
+    zero_short = ~colored & short
+    zero_long = ~colored & ~short
+    color_short = colored & short & (lengths > 2)
+    color_long = colored & ~short
+
+    sizes = np.full(starts.size, 4, np.int64)
+    sizes[one] = 1
+    sizes[two] = 2
+    sizes[zero_short] = 2
+    sizes[zero_long] = 3
+    sizes[color_short] = 3
+
+    # every row ends with a 00 00 end of line code.
+    sizes += ends_row * 2
+
+    offsets = np.zeros(starts.size, np.int64)
+    np.cumsum(sizes[:-1], out=offsets[1:])
+
+    out = np.zeros(int(sizes.sum()), np.uint8)
+    lo = (lengths & 0xff).astype(np.uint8)
+    hi = (lengths >> 8).astype(np.uint8)
+
+    out[offsets[one]] = values[one]
+
+    out[offsets[two]] = values[two]
+    out[offsets[two] + 1] = values[two]
+
+    out[offsets[zero_short] + 1] = lo[zero_short]
+
+    out[offsets[zero_long] + 1] = 0x40 | hi[zero_long]
+    out[offsets[zero_long] + 2] = lo[zero_long]
+
+    out[offsets[color_short] + 1] = 0x80 | lo[color_short]
+    out[offsets[color_short] + 2] = values[color_short]
+
+    out[offsets[color_long] + 1] = 0xc0 | hi[color_long]
+    out[offsets[color_long] + 2] = lo[color_long]
+    out[offsets[color_long] + 3] = values[color_long]
+
+    return out.tobytes()
+
+
+def quantize(rgba):
+    """ Reduce a ``(h, w, 4)`` RGBA array to at most 255 colors. Returns the
+    ``(h, w)`` palette indices, with 0 for fully transparent pixels, and the
+    list of RGBA colors for indices 1 and up.
+
+    Subtitles rarely have more colors than that, but if they do, low bits
+    are dropped from every channel until they fit.
+    """
+    packed = rgba.astype(np.uint32)
+    packed = (packed[..., 0] << 24) | (packed[..., 1] << 16) | \
+             (packed[..., 2] << 8) | packed[..., 3]
+    visible = rgba[..., 3] != 0
+
+    for shift in range(8):
+        mask = (0xff >> shift << shift) * 0x01010101
+        keys = packed[visible] & mask
+        colors, inverse = np.unique(keys, return_inverse=True)
+        if len(colors) <= 255:
+            break
+
+    indices = np.zeros(visible.shape, np.uint8)
+    indices[visible] = inverse.reshape(-1) + 1
+
+    # use the middle of each bucket we rounded to.
+    fill = (1 << shift >> 1) * 0x01010101
+    palette = [((c | fill) >> 24 & 0xff, (c | fill) >> 16 & 0xff,
+                (c | fill) >> 8 & 0xff, (c | fill) & 0xff)
+               for c in colors.tolist()]
+
+    return indices, palette
+
+
+def segment(segment_type, payload, pts, dts=0):
+    """ Build a PGS segment. Times are in 90kHz ticks. """
+    return _HEADER.pack(_MAGIC, pts, dts, segment_type, len(payload)) + payload
+
+
+def read_segments(f):
+    """ Read a ``.sup`` stream, yielding ``(pts, dts, segment_type,
+    payload)``. Raises ``ValueError`` if the stream is malformed.
+    """
+    while True:
+        header = f.read(_HEADER.size)
+        if not header:
+            return
+
+        if len(header) != _HEADER.size:
+            raise ValueError("truncated segment header")
+
+        magic, pts, dts, segment_type, size = _HEADER.unpack(header)
+        if magic != _MAGIC:
+            raise ValueError("bad segment magic")
+
+        if segment_type not in (SEGMENT_PDS, SEGMENT_ODS, SEGMENT_PCS,
+                                SEGMENT_WDS, SEGMENT_END):
+            raise ValueError("unknown segment type: 0x{:02x}".format(
+                segment_type))
+
+        payload = f.read(size)
+        if len(payload) != size:
+            raise ValueError("truncated segment payload")
+
+        yield pts, dts, segment_type, payload
+
+
+class PGSEncoder(object):
+    """ Encodes rendered frames as PGS display sets written to a file object.
+
+    A display set is only emitted when the rendered output changes: frames
+    libass reports as unchanged are skipped outright, and otherwise the
+    frame is composited and compared against the previous one. Each display
+    set starts a new epoch with a single object covering the bounding box of
+    the subtitles, so it can be decoded on its own.
+    """
+
+    # PGS frame rate codes; players generally ignore this.
+    FRAME_RATE_23_976 = 0x10
+
+    def __init__(self, f, size, frame_rate=FRAME_RATE_23_976, matrix=None):
+        self.f = f
+        self.size = size
+        self.frame_rate = frame_rate
+
+        if matrix is None:
+            matrix = MATRIX_BT709_TV if size[1] > 576 else MATRIX_BT601_TV
+        self.matrix = matrix
+
+        self._compositor = Compositor(size, "rgba")
+        self._buf = self._compositor.make_buffer()
+
+        self._composition = 0
+        self._shown = None
+        self._window = None
+
+        self.display_sets = 0
+
+    def _bounds(self, images):
+        width, height = self.size
+        x0 = y0 = None
+
+        for img in images:
+            if img.w <= 0 or img.h <= 0:
+                continue
+
+            ix0 = max(img.dst_x, 0)
+            iy0 = max(img.dst_y, 0)
+            ix1 = min(img.dst_x + img.w, width)
+            iy1 = min(img.dst_y + img.h, height)
+
+            if ix0 >= ix1 or iy0 >= iy1:
+                continue
+
+            if x0 is None:
+                x0, y0, x1, y1 = ix0, iy0, ix1, iy1
+            else:
+                x0, y0 = min(x0, ix0), min(y0, iy0)
+                x1, y1 = max(x1, ix1), max(y1, iy1)
+
+        if x0 is None:
+            return None
+
+        # objects must be at least 8x8.
+        x1 = min(max(x1, x0 + 8), width)
+        y1 = min(max(y1, y0 + 8), height)
+        x0 = max(min(x0, x1 - 8), 0)
+        y0 = max(min(y0, y1 - 8), 0)
+
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def _pcs(self, pts, state, objects):
+        width, height = self.size
+        payload = struct.pack(">HHBHBBBB", width, height, self.frame_rate,
+                              self._composition, state, 0, 0, len(objects))
+        for x, y in objects:
+            payload += struct.pack(">HBBHH", 0, 0, 0, x, y)
+
+        self._composition = (self._composition + 1) & 0xffff
+        return segment(SEGMENT_PCS, payload, pts)
+
+    def _wds(self, pts, window):
+        x, y, w, h = window
+        return segment(SEGMENT_WDS, struct.pack(">BBHHHH", 1, 0, x, y, w, h),
+                       pts)
+
+    def _pds(self, pts, palette):
+        payload = bytearray(struct.pack(">BB", 0, 0))
+        payload.extend(struct.pack(">BBBBB", 0, 16, 128, 128, 0))
+        for i, (r, g, b, a) in enumerate(palette):
+            y, u, v = rgb_to_yuv(r, g, b, self.matrix)
+            payload.extend(struct.pack(">BBBBB", i + 1, y, v, u, a))
+        return segment(SEGMENT_PDS, bytes(payload), pts)
+
+    def _ods(self, pts, w, h, data):
+        segments = []
+
+        first = struct.pack(">HBB", 0, 0, 0) + \
+            struct.pack(">I", len(data) + 4)[1:] + struct.pack(">HH", w, h)
+        room = _MAX_SEGMENT - len(first)
+        chunks = [data[:room]]
+        rest = data[room:]
+
+        room = _MAX_SEGMENT - 4
+        while rest:
+            chunks.append(rest[:room])
+            rest = rest[room:]
+
+        for i, chunk in enumerate(chunks):
+            flags = (0x80 if i == 0 else 0) | \
+                    (0x40 if i == len(chunks) - 1 else 0)
+            if i == 0:
+                header = first[:3] + bytes(bytearray([flags])) + first[4:]
+            else:
+                header = struct.pack(">HBB", 0, 0, flags)
+            segments.append(segment(SEGMENT_ODS, header + chunk, pts))
+
+        return b"".join(segments)
+
+    def _show(self, pts, window, rgba):
+        indices, palette = quantize(rgba)
+        h, w = indices.shape
+
+        self.f.write(self._pcs(pts, STATE_EPOCH_START, [window[:2]]) +
+                     self._wds(pts, window) +
+                     self._pds(pts, palette) +
+                     self._ods(pts, w, h, rle_encode(indices)) +
+                     segment(SEGMENT_END, b"", pts))
+        self.display_sets += 1
+
+    def _clear(self, pts):
+        self.f.write(self._pcs(pts, STATE_NORMAL, []) +
+                     self._wds(pts, self._window) +
+                     segment(SEGMENT_END, b"", pts))
+        self.display_sets += 1
+
+    def add_frame(self, now_ms, images):
+        """ Add a frame rendered at the given time, writing a display set if
+        it differs from the previous one. Must be called before the next
+        frame is rendered.
+        """
+        if self._shown is not None and getattr(images, "changed", None) == 0:
+            return
+
+        pts = now_ms * 90
+        window = self._bounds(images)
+
+        if window is None:
+            shown = ()
+        else:
+            # every image lies within the window, so only it needs to be
+            # cleared and blended into.
+            x, y, w, h = window
+            rgba = self._buf[y:y + h, x:x + w]
+            self._compositor.clear(rgba)
+            self._compositor.composite(images, self._buf, clear=False)
+            shown = (window, rgba.tobytes())
+
+        if shown == self._shown:
+            return
+
+        if window is None:
+            if self._shown:
+                self._clear(pts)
+        else:
+            self._show(pts, window, rgba)
+            self._window = window
+
+        self._shown = shown
+
+    def encode(self, renderer, track, times):
+        """ Render a track at each of the given times and encode the frames.
+        """
+        for now in times:
+            self.add_frame(renderer.timedelta_to_ms(now),
+                           renderer.render_frame(track, now))
+
+    def close(self, end_ms):
+        """ Clear whatever is still on screen at the given time. """
+        if self._shown:
+            self._clear(end_ms * 90)
+        self._shown = ()
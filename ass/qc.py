@@ -0,0 +1,272 @@
+""" Quality checks on where events end up on screen: text that runs out of
+the safe area of the frame, and simultaneous events that overlap.
+
+Rather than compositing anything, events are rendered and their bounding
+boxes are taken from the placement of their images (``dst_x``, ``dst_y``,
+``w`` and ``h``). To tell which images belong to which event without
+rendering every event on its own, each event is rendered in a color that
+encodes its index: the events are rendered from a copy of the document in
+which every color override is replaced with the event's own color.
+
+Each static segment of the timeline (see ``Document.segments``) is
+rendered once; animated segments are sampled a few times.
+"""
+
+import collections
+from datetime import timedelta
+import multiprocessing
+import re
+
+try:
+    from .renderer import Image
+    _TYPE_SHADOW = Image.TYPE_SHADOW
+except Exception:
+    # libass' value, so that images can be checked without libass loaded.
+    _TYPE_SHADOW = 2
+
+OVERFLOW = "overflow"
+OVERLAP = "overlap"
+
+
+class Issue(collections.namedtuple("Issue",
+                                   ["kind", "time", "events", "rects"])):
+    """ A problem found at a given time: an event (``OVERFLOW``) or a pair of
+    events (``OVERLAP``), with their ``(x, y, w, h)`` bounding boxes then.
+    """
+    __slots__ = ()
+
+
+_BLOCK_RE = re.compile(r"\{([^}]*)\}")
+# \c, \1c to \4c, with or without a color, but not \clip.
+_COLOR_TAG_RE = re.compile(r"\\[1-4]?c(?:&H[0-9a-fA-F]+&?)?(?![a-zA-Z])")
+
+
+def tag_text(text, code):
+    """ Replace the colors in an event's text with the color for ``code``,
+    including after ``\\r`` resets to the style.
+    """
+    colors = "\\1c&H{b:02X}{g:02X}{r:02X}&\\2c&H{b:02X}{g:02X}{r:02X}&" \
+             "\\3c&H{b:02X}{g:02X}{r:02X}&\\4c&H{b:02X}{g:02X}{r:02X}&".format(
+                 r=code >> 16 & 0xff, g=code >> 8 & 0xff, b=code & 0xff)
+
+    return "{" + colors + "}" + _BLOCK_RE.sub(
+        lambda m: "{" + _COLOR_TAG_RE.sub("", m.group(1)) + colors + "}",
+        text)
+
+
+def event_boxes(images, include_shadow=False):
+    """ Get the bounding box of each event in a rendered frame, as a dict of
+    the event codes (see ``tag_text``) to ``(x, y, w, h)``.
+    """
+    boxes = {}
+
+    for img in images:
+        if img.w <= 0 or img.h <= 0:
+            continue
+        if img.type == _TYPE_SHADOW and not include_shadow:
+            continue
+
+        code = img.color >> 8
+        box = boxes.get(code)
+        if box is None:
+            boxes[code] = [img.dst_x, img.dst_y,
+                           img.dst_x + img.w, img.dst_y + img.h]
+        else:
+            box[0] = min(box[0], img.dst_x)
+            box[1] = min(box[1], img.dst_y)
+            box[2] = max(box[2], img.dst_x + img.w)
+            box[3] = max(box[3], img.dst_y + img.h)
+
+    return dict((code, (x0, y0, x1 - x0, y1 - y0))
+                for code, (x0, y0, x1, y1) in boxes.items())
+
+
+def _overlap_area(a, b):
+    w = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    h = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    return w * h if w > 0 and h > 0 else 0
+
+
+def check_boxes(boxes, safe_area, min_overlap=1):
+    """ Check the boxes of one frame. Returns the codes of the events that
+    leave the ``(x, y, w, h)`` safe area, and the pairs of codes of the
+    events whose boxes share at least ``min_overlap`` pixels.
+    """
+    sx, sy, sw, sh = safe_area
+
+    overflows = [code for code, (x, y, w, h) in sorted(boxes.items())
+                 if x < sx or y < sy or x + w > sx + sw or y + h > sy + sh]
+
+    # sweep over the boxes by left edge, so only boxes that overlap
+    # horizontally get compared.
+    items = sorted(boxes.items(), key=lambda item: item[1][0])
+    overlaps = []
+    for i, (code, box) in enumerate(items):
+        for other_code, other in items[i + 1:]:
+            if other[0] >= box[0] + box[2]:
+                break
+            if _overlap_area(box, other) >= min_overlap:
+                overlaps.append(tuple(sorted((code, other_code))))
+
+    return overflows, sorted(overlaps)
+
+
+def _ms(td):
+    return (td.days * 86400 + td.seconds) * 1000 + td.microseconds // 1000
+
+
+# the scanner, renderer and track that forked workers inherit.
+_worker_state = None
+
+
+def _scan_worker(jobs):
+    scanner, renderer, track = _worker_state
+    return scanner.scan_jobs(renderer, track, jobs)
+
+
+class Scanner(object):
+    """ Checks the placement of a document's dialogue at a given frame size.
+
+    The safe area is given as ``(x, y, w, h)``, or else is the frame minus
+    ``margin`` (a fraction of its width and height) on every side; the
+    default of 5% is the usual title-safe area. Animated segments are
+    rendered at ``samples`` evenly spaced times. Shadows are left out of the
+    bounding boxes unless ``include_shadow`` is set.
+    """
+
+    def __init__(self, doc, size, safe_area=None, margin=0.05, samples=3,
+                 include_shadow=False, min_overlap=1):
+        self.doc = doc
+        self.size = size
+
+        if safe_area is None:
+            w, h = size
+            mx = int(round(w * margin))
+            my = int(round(h * margin))
+            safe_area = (mx, my, w - 2 * mx, h - 2 * my)
+        self.safe_area = safe_area
+
+        self.samples = samples
+        self.include_shadow = include_shadow
+        self.min_overlap = min_overlap
+
+        # events are identified by their index among the dialogue, plus one
+        # so that no event is black.
+        self._dialogue = [event for event in doc.events
+                          if event.TYPE == "Dialogue"]
+        self._codes = dict((event, i + 1)
+                           for i, event in enumerate(self._dialogue))
+
+    def tagged_document(self):
+        """ Make the copy of the document that gets rendered, with every
+        event in its own color.
+        """
+        doc = self.doc.fork()
+        events = []
+        for i, event in enumerate(self._dialogue):
+            tagged = event.fork()
+            tagged.text = tag_text(event.text, i + 1)
+            events.append(tagged)
+        doc.events = events
+        return doc
+
+    def jobs(self):
+        """ Get the ``(time in ms, codes of the active events)`` to render. """
+        jobs = []
+        for segment in self.doc.segments():
+            start = _ms(segment.start)
+            end = _ms(segment.end)
+            codes = tuple(self._codes[event] for event in segment.events)
+
+            n = 1 if segment.static else max(self.samples, 1)
+            for k in range(n):
+                jobs.append((start + (end - start) * (2 * k + 1) // (2 * n),
+                             codes))
+        return jobs
+
+    def scan_jobs(self, renderer, track, jobs):
+        """ Render the given jobs, returning the problems found as ``(kind,
+        time in ms, codes, rects)`` tuples.
+        """
+        found = []
+        for now, codes in jobs:
+            images = renderer.render_frame(track, timedelta(milliseconds=now))
+
+            # images in any other color come from color changes tag_text
+            # missed, and cannot be told apart.
+            active = set(codes)
+            boxes = dict((code, box) for code, box in
+                         event_boxes(images, self.include_shadow).items()
+                         if code in active)
+
+            overflows, overlaps = check_boxes(boxes, self.safe_area,
+                                              self.min_overlap)
+            for code in overflows:
+                found.append((OVERFLOW, now, (code,), (boxes[code],)))
+            for pair in overlaps:
+                found.append((OVERLAP, now, pair,
+                              tuple(boxes[code] for code in pair)))
+
+        return found
+
+    def run(self, workers=1, **fonts):
+        """ Scan the whole document and return the ``Issue`` objects found,
+        in time order, each problem reported at the first time it was seen.
+        Keyword arguments go to ``Renderer.set_fonts``; fonts embedded in
+        the document are used too.
+
+        With more than one worker, the renderer is set up once and then
+        forked into a pool of workers that split the jobs between them,
+        which needs ``os.fork``.
+        """
+        from . import forkserver
+        from .renderer import Context
+
+        # the fonts embedded in the script are what it is meant to be
+        # measured with.
+        ctx = Context()
+        ctx.add_fonts(self.doc)
+        ctx, renderer = forkserver.warm_renderer(self.size, ctx, **fonts)
+        track = ctx.track_from_document(self.tagged_document())
+        jobs = self.jobs()
+
+        if workers <= 1 or len(jobs) <= 1:
+            found = self.scan_jobs(renderer, track, jobs)
+        else:
+            global _worker_state
+            _worker_state = (self, renderer, track)
+            try:
+                pool = multiprocessing.get_context("fork").Pool(workers)
+                try:
+                    chunks = [jobs[i::workers * 4]
+                              for i in range(workers * 4)]
+                    found = [issue
+                             for part in pool.map(_scan_worker, chunks)
+                             for issue in part]
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                _worker_state = None
+
+        return self.issues(found)
+
+    def issues(self, found):
+        """ Turn the tuples from ``scan_jobs`` into ``Issue`` objects,
+        keeping the first report of every problem.
+        """
+        seen = set()
+        issues = []
+
+        for kind, now, codes, rects in sorted(found):
+            if (kind, codes) in seen:
+                continue
+            seen.add((kind, codes))
+
+            issues.append(Issue(kind, timedelta(milliseconds=now),
+                                tuple(self._dialogue[code - 1]
+                                      for code in codes),
+                                rects))
+
+        issues.sort(key=lambda issue: issue.time)
+        return issues
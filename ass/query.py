@@ -0,0 +1,245 @@
+""" Indexes for querying the events of a document.
+
+The indexes are built lazily, the first time a query needs them, and are
+then kept up to date as events are added, removed or have their fields set.
+"""
+
+import re
+
+# override blocks and the escapes that stand for whitespace.
+_TAGS_RE = re.compile(r"\{[^}]*\}")
+_ESCAPES_RE = re.compile(r"\\[Nnh]")
+_WORD_RE = re.compile(r"\w+", re.U)
+
+
+def plain_text(text):
+    """ Get the lowercased text of an event with its override blocks and
+    line breaks stripped, as used for text search.
+    """
+    return _ESCAPES_RE.sub(" ", _TAGS_RE.sub("", text)).lower()
+
+
+def _trigrams(s):
+    return set(s[i:i + 3] for i in range(len(s) - 2))
+
+
+def _as_values(v):
+    if isinstance(v, (list, tuple, set, frozenset)):
+        return v
+    return (v,)
+
+
+class EventIndex(object):
+    """ Hash indexes over a list of events, by type, style, actor name, layer
+    and effect, plus an optional inverted index over their plain text.
+    """
+
+    FIELDS = {
+        "style": "Style",
+        "name": "Name",
+        "layer": "Layer",
+        "effect": "Effect"
+    }
+
+    def __init__(self, events):
+        self._events = events
+
+        for event in events:
+            event.__dict__.setdefault("_observers", []).append(self)
+
+        # field name -> value -> {event: None}, in event order. the type
+        # index is keyed by None, as it is not a field.
+        self._fields = {}
+
+        self._plain = None
+        self._words = None
+        self._trigrams = None
+
+        # whether the indexes are still in the same order as the events,
+        # and if not, the positions of the events to sort results by.
+        self._ordered = True
+        self._positions = None
+
+    def detach(self):
+        """ Stop tracking the events. """
+        for event in self._events:
+            self._unobserve(event)
+
+    def _unobserve(self, event):
+        observers = event.__dict__.get("_observers")
+        if observers and self in observers:
+            observers.remove(self)
+
+    @staticmethod
+    def _key(event, field):
+        if field is None:
+            return event.TYPE
+        return event.fields.get(field)
+
+    def _field_index(self, field):
+        try:
+            return self._fields[field]
+        except KeyError:
+            pass
+
+        index = {}
+        for event in self._events:
+            index.setdefault(self._key(event, field), {})[event] = None
+        self._fields[field] = index
+        return index
+
+    def _build_text_index(self):
+        self._plain = {}
+        self._words = {}
+        self._trigrams = {}
+        for event in self._events:
+            self._index_text(event, event.text)
+
+    def _index_text(self, event, text):
+        plain = plain_text(text)
+        self._plain[event] = plain
+
+        for word in set(_WORD_RE.findall(plain)):
+            self._words.setdefault(word, {})[event] = None
+
+        for trigram in _trigrams(plain):
+            self._trigrams.setdefault(trigram, {})[event] = None
+
+    def _unindex_text(self, event):
+        plain = self._plain.pop(event)
+
+        for word in set(_WORD_RE.findall(plain)):
+            self._discard(self._words, word, event)
+
+        for trigram in _trigrams(plain):
+            self._discard(self._trigrams, trigram, event)
+
+    @staticmethod
+    def _discard(index, key, event):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(event, None)
+            if not bucket:
+                del index[key]
+
+    def added(self, events, ordered=True):
+        """ Called when events are added to the list. """
+        if not ordered:
+            self._ordered = False
+        self._positions = None
+
+        for event in events:
+            event.__dict__.setdefault("_observers", []).append(self)
+
+            for field, index in self._fields.items():
+                index.setdefault(self._key(event, field), {})[event] = None
+
+            if self._plain is not None:
+                self._index_text(event, event.text)
+
+    def removed(self, events):
+        """ Called when events are removed from the list. """
+        self._positions = None
+
+        for event in events:
+            self._unobserve(event)
+
+            for field, index in self._fields.items():
+                self._discard(index, self._key(event, field), event)
+
+            if self._plain is not None and event in self._plain:
+                self._unindex_text(event)
+
+    def reordered(self):
+        """ Called when the events are moved around in the list. """
+        self._ordered = False
+        self._positions = None
+
+    def field_changed(self, event, field, old, new):
+        """ Called when a field of one of the events is set. """
+        index = self._fields.get(field)
+        if index is not None and old != new:
+            self._discard(index, old, event)
+            index.setdefault(new, {})[event] = None
+            self._ordered = False
+
+        if field == "Text" and self._plain is not None:
+            self._unindex_text(event)
+            self._index_text(event, new)
+            self._ordered = False
+
+    def _text_candidates(self, text):
+        text = text.lower()
+        if self._plain is None:
+            self._build_text_index()
+
+        if len(text) < 3:
+            return [event for event, plain in self._plain.items()
+                    if text in plain]
+
+        buckets = sorted((self._trigrams.get(trigram, {})
+                          for trigram in _trigrams(text)), key=len)
+        return [event for event in buckets[0]
+                if text in self._plain[event] and
+                all(event in bucket for bucket in buckets[1:])]
+
+    def _word_candidates(self, word):
+        if self._plain is None:
+            self._build_text_index()
+        return self._words.get(word.lower(), {})
+
+    def select(self, type=None, text=None, word=None, **kwargs):
+        """ Find the events matching all the given criteria; see
+        ``Document.select``.
+        """
+        # (events, whether they are in the same order as the event list)
+        candidates = []
+
+        for key, v in kwargs.items():
+            if v is None:
+                continue
+            if key not in EventIndex.FIELDS:
+                raise TypeError("cannot select by " + key)
+
+            index = self._field_index(EventIndex.FIELDS[key])
+            candidates.append(self._union(index, _as_values(v)))
+
+        if type is not None:
+            index = self._field_index(None)
+            candidates.append(self._union(index, [
+                t if isinstance(t, str) else t.TYPE for t in _as_values(type)
+            ]))
+
+        if text is not None:
+            candidates.append((self._text_candidates(text), self._ordered))
+
+        if word is not None:
+            candidates.append((self._word_candidates(word), self._ordered))
+
+        if not candidates:
+            return list(self._events)
+
+        candidates.sort(key=lambda c: len(c[0]))
+        first, ordered = candidates[0]
+        rest = [c if isinstance(c, dict) else dict.fromkeys(c)
+                for c, _ in candidates[1:]]
+
+        results = [event for event in first
+                   if all(event in c for c in rest)]
+
+        if not ordered and len(results) > 1:
+            if self._positions is None:
+                self._positions = dict((event, i)
+                                       for i, event in enumerate(self._events))
+            results.sort(key=self._positions.__getitem__)
+
+        return results
+
+    def _union(self, index, values):
+        if len(values) == 1:
+            return (index.get(next(iter(values)), {}), self._ordered)
+
+        union = {}
+        for v in values:
+            union.update(index.get(v, {}))
+        return (union, False)
@@ -0,0 +1,223 @@
+""" Bulk conversion of events to and from NumPy structured arrays, and a
+columnar file format for them, for analysing large numbers of events
+without going through event objects.
+
+This needs NumPy, which is not otherwise required by python-ass.
+"""
+
+from datetime import timedelta
+
+import numpy as np
+
+from . import document
+
+EVENT_CLASSES = (document.Dialogue, document.Comment, document.Picture,
+                 document.Sound, document.Movie, document.Command)
+
+_TYPE_IDS = dict((cls.TYPE, i) for i, cls in enumerate(EVENT_CLASSES))
+
+# times are in milliseconds. style, name and effect are ids into the string
+# table of the records.
+DTYPE = np.dtype([
+    ("type", np.uint8),
+    ("layer", np.int32),
+    ("start", np.int64),
+    ("end", np.int64),
+    ("style", np.int32),
+    ("name", np.int32),
+    ("margin_l", np.int32),
+    ("margin_r", np.int32),
+    ("margin_v", np.int32),
+    ("effect", np.int32),
+    ("text", object)
+])
+
+FORMAT_VERSION = 1
+
+# the columns that index into the string table.
+STRING_COLUMNS = ("style", "name", "effect")
+
+
+def _field(name):
+    return document._Event._field_mappings[name]
+
+
+def _ms(td):
+    return (td.days * 86400 + td.seconds) * 1000 + td.microseconds // 1000
+
+
+class EventRecords(object):
+    """ Events as a structured array of ``DTYPE`` (or a subset of its
+    fields, if loaded with ``columns``), along with the string table that
+    the ``style``, ``name`` and ``effect`` columns index into.
+    """
+
+    def __init__(self, records, strings):
+        self.records = records
+        self.strings = strings
+        self._string_ids = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def string_id(self, s):
+        """ Get the id of a string in the string table, or -1 if it is not
+        in it, e.g. for ``records["style"] == table.string_id("Default")``.
+        """
+        if self._string_ids is None:
+            self._string_ids = dict((v, i) for i, v in enumerate(self.strings))
+        return self._string_ids.get(s, -1)
+
+
+def to_records(events):
+    """ Convert a list of events to ``EventRecords``. """
+    events = list(events)
+    fields = [event.fields for event in events]
+
+    strings = {}
+
+    def column(name, convert=None):
+        default = _field(name).default
+        values = [f.get(name, default) for f in fields]
+        if convert is not None:
+            values = [convert(v) for v in values]
+        return values
+
+    def intern(v):
+        try:
+            return strings[v]
+        except KeyError:
+            i = strings[v] = len(strings)
+            return i
+
+    records = np.empty(len(events), DTYPE)
+    records["type"] = [_TYPE_IDS[event.TYPE] for event in events]
+    records["layer"] = column("Layer")
+    records["start"] = column("Start", _ms)
+    records["end"] = column("End", _ms)
+    records["style"] = column("Style", intern)
+    records["name"] = column("Name", intern)
+    records["margin_l"] = column("MarginL")
+    records["margin_r"] = column("MarginR")
+    records["margin_v"] = column("MarginV")
+    records["effect"] = column("Effect", intern)
+    records["text"] = column("Text")
+
+    return EventRecords(records, list(strings))
+
+
+def from_records(table):
+    """ Convert ``EventRecords`` with all of the fields of ``DTYPE`` back to
+    a list of events.
+    """
+    records = table.records
+    strings = table.strings
+
+    defaults = dict((f.name, f.default)
+                    for f in document._Event._field_defs)
+
+    times = {}
+
+    def time(ms):
+        try:
+            return times[ms]
+        except KeyError:
+            td = times[ms] = timedelta(milliseconds=ms)
+            return td
+
+    columns = [
+        ("Layer", records["layer"].tolist()),
+        ("Start", [time(ms) for ms in records["start"].tolist()]),
+        ("End", [time(ms) for ms in records["end"].tolist()]),
+        ("Style", [strings[i] for i in records["style"].tolist()]),
+        ("Name", [strings[i] for i in records["name"].tolist()]),
+        ("MarginL", records["margin_l"].tolist()),
+        ("MarginR", records["margin_r"].tolist()),
+        ("MarginV", records["margin_v"].tolist()),
+        ("Effect", [strings[i] for i in records["effect"].tolist()]),
+        ("Text", records["text"].tolist())
+    ]
+    names = [name for name, _ in columns]
+
+    events = []
+    for type_id, values in zip(records["type"].tolist(),
+                               zip(*[values for _, values in columns])):
+        cls = EVENT_CLASSES[type_id]
+
+        # skip __init__, which would go through every field's descriptor.
+        event = cls.__new__(cls)
+        event.fields = dict(defaults)
+        event.fields.update(zip(names, values))
+        events.append(event)
+
+    return events
+
+
+def _pack_strings(strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), np.uint8), offsets
+
+
+def _unpack_strings(data, offsets):
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [data[a:b].decode("utf-8") for a, b in zip(offsets, offsets[1:])]
+
+
+def save(f, table, compress=True):
+    """ Save ``EventRecords`` to a file (a path or a binary file object),
+    one array per column plus the string table, in NumPy's ``.npz``
+    format. The text column is stored as one UTF-8 blob with offsets.
+    """
+    arrays = {"version": np.array(FORMAT_VERSION),
+              "count": np.array(len(table.records))}
+
+    for name in DTYPE.names:
+        if name == "text":
+            arrays["text_data"], arrays["text_offsets"] = \
+                _pack_strings(table.records["text"].tolist())
+        else:
+            arrays[name] = table.records[name]
+
+    arrays["string_data"], arrays["string_offsets"] = \
+        _pack_strings(table.strings)
+
+    (np.savez_compressed if compress else np.savez)(f, **arrays)
+
+
+def load(f, columns=None):
+    """ Load ``EventRecords`` saved with ``save``. ``columns`` can be a list
+    of the fields of ``DTYPE`` to load, in which case the records only have
+    those fields; only the columns asked for are read and decompressed, and
+    the string table is left empty unless one of ``STRING_COLUMNS`` is.
+    """
+    with np.load(f, allow_pickle=False) as npz:
+        if int(npz["version"]) != FORMAT_VERSION:
+            raise ValueError("unsupported records version: {}".format(
+                int(npz["version"])))
+
+        if columns is None:
+            columns = DTYPE.names
+        for name in columns:
+            if name not in DTYPE.names:
+                raise ValueError("unknown column: " + name)
+
+        dtype = np.dtype([(name, DTYPE.fields[name][0]) for name in columns])
+        n = int(npz["count"])
+        records = np.empty(n, dtype)
+
+        for name in columns:
+            if name == "text":
+                records["text"] = _unpack_strings(npz["text_data"],
+                                                  npz["text_offsets"])
+            else:
+                records[name] = npz[name]
+
+        strings = []
+        if any(name in STRING_COLUMNS for name in columns):
+            strings = _unpack_strings(npz["string_data"],
+                                      npz["string_offsets"])
+
+    return EventRecords(records, strings)
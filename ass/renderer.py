@@ -1,22 +1,70 @@
+import bisect
+import copy
 import ctypes
 import ctypes.util
+import io
+import time
 
 from datetime import timedelta
 
+from . import timeline, ycbcr
+from .stats import RenderStats
+
 _libass = ctypes.cdll.LoadLibrary(ctypes.util.find_library("ass"))
 _libc = ctypes.cdll.LoadLibrary(ctypes.util.find_library("c"))
 
 class ImageSequence(object):
-    def __init__(self, renderer, head_ptr):
+    """ The images of a rendered frame. They point into memory that libass
+    reuses on the renderer's next ``render_frame``, after which iterating
+    over them raises; ``copy`` them into a ``framepool.FramePool`` to keep
+    them for longer. Used as a context manager, the sequence is closed at
+    the end of the block.
+    """
+
+    # how the frame differs from the previously rendered one, as reported by
+    # libass.
+    CHANGE_NONE = 0
+    CHANGE_POSITIONS = 1
+    CHANGE_CONTENT = 2
+
+    def __init__(self, renderer, head_ptr, changed=CHANGE_CONTENT):
         self.renderer = renderer
         self.head_ptr = head_ptr
+        self.changed = changed
+        self._frame_id = renderer._frame_id
+        self._closed = False
+
+    @property
+    def valid(self):
+        """ Whether the images can still be used. """
+        return not self._closed and \
+            self._frame_id == self.renderer._frame_id
 
     def __iter__(self):
+        if not self.valid:
+            raise RuntimeError("images used after their frame was closed or "
+                               "rendered over")
+
         cur = self.head_ptr
         while cur:
             yield cur.contents
             cur = cur.contents.next_ptr
 
+    def close(self):
+        self._closed = True
+
+    def copy(self, pool):
+        """ Copy the images into a frame from a ``framepool.FramePool``,
+        which stays valid until it is released.
+        """
+        return pool.copy(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 
 class Image(ctypes.Structure):
     TYPE_CHARACTER = 0
@@ -125,6 +173,18 @@ class Context(ctypes.Structure):
             ctypes.byref(self),
             ptr)
 
+    def add_font(self, name, data):
+        """ Register a font from memory, e.g. one embedded in a script. This
+        must happen before ``Renderer.set_fonts``.
+        """
+        _libass.ass_add_font(ctypes.byref(self), name.encode("utf-8"), data,
+                             len(data))
+
+    def add_fonts(self, doc):
+        """ Register all the fonts embedded in a document. """
+        for font in doc.fonts:
+            self.add_font(font.name, font.data)
+
     def make_renderer(self):
         """ Make a renderer instance for rendering tracks. """
         renderer = _libass.ass_renderer_init(ctypes.byref(self)).contents
@@ -132,9 +192,36 @@ class Context(ctypes.Structure):
         return renderer
 
     def parse_to_track(self, data, codepage="UTF-8"):
-        """ Parse ASS data to a track. """
-        return _libass.ass_read_memory(ctypes.byref(self), data, len(data),
-                                       codepage.encode("utf-8")).contents
+        """ Parse ASS data to a track. If ``codepage`` is None, the data is
+        taken to be UTF-8 as is, without going through iconv.
+        """
+        track = _libass.ass_read_memory(
+            ctypes.byref(self), data, len(data),
+            codepage.encode("utf-8") if codepage is not None else None
+        ).contents
+        track._after_init(self)
+        track._libass_owned = True
+        return track
+
+    def track_from_document(self, doc, method="populate"):
+        """ Convert a document to a track, either with ``Track.populate``
+        (``"populate"``) or by dumping it to a buffer and having libass parse
+        that (``"parse"``).
+
+        Parsing is done in C, while populate avoids the round trip through
+        text and gives a track that can be updated with ``Track.sync``.
+        ``track_benchmark.py`` measures which is faster for documents of a
+        given size.
+        """
+        if method == "parse":
+            return self.parse_to_track(doc.dump_bytes(), codepage=None)
+
+        if method == "populate":
+            track = self.make_track()
+            track.populate(doc)
+            return track
+
+        raise ValueError("unknown method: {!r}".format(method))
 
     def make_track(self):
         track = _libass.ass_new_track(ctypes.byref(self)).contents
@@ -156,6 +243,9 @@ class Renderer(ctypes.Structure):
         self._fonts_set = False
         self._internal_fields = {}
 
+        # bumped on every render_frame, invalidating the previous images.
+        self._frame_id = 0
+
         self.frame_size = (640, 480)
         self.storage_size = (640, 480)
         self.margins = (0, 0, 0, 0)
@@ -164,6 +254,8 @@ class Renderer(ctypes.Structure):
         self.line_spacing = 0
         self.pixel_aspect = 1.0
 
+        self.stats = None
+
     def __del__(self):
         _libass.ass_renderer_done(ctypes.byref(self))
 
@@ -220,9 +312,11 @@ class Renderer(ctypes.Structure):
         if default_family is not None:
             default_family = default_family.encode("utf-8")
 
+        if fontconfig_config is not None:
+            fontconfig_config = fontconfig_config.encode("utf-8")
+
         _libass.ass_set_fonts(ctypes.byref(self), default_font, default_family,
-                              fc, fontconfig_config.encode("utf-8") or "",
-                              update_fontconfig)
+                              fc, fontconfig_config, update_fontconfig)
         self._fonts_set = True
 
     def update_fonts(self):
@@ -230,11 +324,28 @@ class Renderer(ctypes.Structure):
             raise RuntimeError("set_fonts before updating them")
         _libass.ass_fonts_update(ctypes.byref(self))
 
-    set_cache_limits = _make_libass_setter("ass_set_cache_limits", [
+    _set_cache_limits = _make_libass_setter("ass_set_cache_limits", [
         ctypes.c_int,
         ctypes.c_int
     ])
 
+    def set_cache_limits(self, limits):
+        """ Set the maximum number of cached glyphs and the maximum size of
+        the bitmap cache in MB, as a tuple. Zero means the libass default.
+        """
+        self._set_cache_limits(limits)
+        if self.stats is not None:
+            self.stats.cache_limits = tuple(limits)
+
+    def enable_stats(self):
+        """ Start collecting rendering statistics into ``self.stats``. """
+        self.stats = RenderStats()
+        self.stats.cache_limits = self._internal_fields.get(
+            "ass_set_cache_limits")
+        return self.stats
+
+    def disable_stats(self):
+        self.stats = None
 
     @staticmethod
     def timedelta_to_ms(td):
@@ -243,11 +354,57 @@ class Renderer(ctypes.Structure):
     def render_frame(self, track, now):
         if not self._fonts_set:
             raise RuntimeError("set_fonts before rendering")
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        changed = ctypes.c_int()
+        self._frame_id += 1
         head = _libass.ass_render_frame(ctypes.byref(self),
                                         ctypes.byref(track),
                                         Renderer.timedelta_to_ms(now),
-                                        ctypes.POINTER(ctypes.c_int)())
-        return ImageSequence(self, head)
+                                        ctypes.byref(changed))
+        images = ImageSequence(self, head, changed.value)
+
+        if stats is not None:
+            stats.record(time.perf_counter() - start, changed.value, images)
+
+        return images
+
+    def render_frames(self, track, times):
+        """ Render a track at each of the given times, yielding ``(now,
+        images)`` pairs. Within a static segment of the track (see
+        ``Track.segments``), the track is only rendered once and the same
+        images are yielded again, reported as unchanged.
+
+        The renderer and track must not be changed while iterating.
+        """
+        segments = track.segments()
+        starts = [segment.start for segment in segments]
+
+        images = None
+        last_key = None
+
+        for now in times:
+            now_ms = Renderer.timedelta_to_ms(now)
+
+            i = bisect.bisect_right(starts, now_ms) - 1
+            if i >= 0 and now_ms < segments[i].end:
+                key = i
+                static = segments[i].static
+            else:
+                # nothing is on screen outside of the segments.
+                key = (i,)
+                static = True
+
+            if static and key == last_key:
+                yield now, ImageSequence(self, images.head_ptr,
+                                         ImageSequence.CHANGE_NONE)
+                continue
+
+            images = self.render_frame(track, now)
+            last_key = key
+            yield now, images
 
     def set_all_sizes(self, size):
         self.frame_size = size
@@ -296,6 +453,37 @@ class Style(ctypes.Structure):
     def _after_init(self, track):
         self._track = track
 
+    @staticmethod
+    def _values_from(style):
+        """ Build the field values of a libass style from a document style, in
+        ``_fields_`` order.
+        """
+        return (
+            style.name.encode("utf-8"),
+            style.fontname.encode("utf-8"),
+            style.fontsize,
+            style.primary_color.to_int(),
+            style.secondary_color.to_int(),
+            style.outline_color.to_int(),
+            style.back_color.to_int(),
+            style.bold,
+            style.italic,
+            style.underline,
+            style.strike_out,
+            style.scale_x / 100.0,
+            style.scale_y / 100.0,
+            style.spacing,
+            style.angle,
+            style.border_style,
+            style.outline,
+            style.shadow,
+            Style.numpad_align(style.alignment),
+            style.margin_l,
+            style.margin_r,
+            style.margin_v,
+            style.encoding
+        )
+
     def populate(self, style):
         self.name = style.name.encode("utf-8")
         self.fontname = style.fontname.encode("utf-8")
@@ -371,6 +559,32 @@ class Event(ctypes.Structure):
 
         raise ValueError("style not found")
 
+    @staticmethod
+    def _key_from(event, style_ids):
+        """ Build the field values of a libass event from a document event, in
+        ``_fields_`` order but without ``read_order``, which depends on the
+        position of the event in the track.
+        """
+        start_ms = Renderer.timedelta_to_ms(event.start)
+
+        try:
+            style_id = style_ids[event.style]
+        except KeyError:
+            raise ValueError("style not found")
+
+        return (
+            start_ms,
+            Renderer.timedelta_to_ms(event.end) - start_ms,
+            event.layer,
+            style_id,
+            event.name.encode("utf-8"),
+            event.margin_l,
+            event.margin_r,
+            event.margin_v,
+            event.effect.encode("utf-8"),
+            event.text.encode("utf-8")
+        )
+
     def populate(self, event):
         self.start = event.start
         self.duration = event.end - event.start
@@ -389,6 +603,18 @@ class Track(ctypes.Structure):
     TYPE_ASS = 1
     TYPE_SSA = 2
 
+    YCBCR_DEFAULT = ycbcr.MATRIX_DEFAULT
+    YCBCR_UNKNOWN = ycbcr.MATRIX_UNKNOWN
+    YCBCR_NONE = ycbcr.MATRIX_NONE
+    YCBCR_BT601_TV = ycbcr.MATRIX_BT601_TV
+    YCBCR_BT601_PC = ycbcr.MATRIX_BT601_PC
+    YCBCR_BT709_TV = ycbcr.MATRIX_BT709_TV
+    YCBCR_BT709_PC = ycbcr.MATRIX_BT709_PC
+    YCBCR_SMPTE240M_TV = ycbcr.MATRIX_SMPTE240M_TV
+    YCBCR_SMPTE240M_PC = ycbcr.MATRIX_SMPTE240M_PC
+    YCBCR_FCC_TV = ycbcr.MATRIX_FCC_TV
+    YCBCR_FCC_PC = ycbcr.MATRIX_FCC_PC
+
     _fields_ = [
         ("n_styles", ctypes.c_int),
         ("max_styles", ctypes.c_int),
@@ -416,6 +642,19 @@ class Track(ctypes.Structure):
     def _after_init(self, ctx):
         self._ctx = ctx
 
+        # the field values we last wrote with populate/sync. these also keep
+        # the strings the libass structures point to alive.
+        self._style_values = []
+        self._event_keys = []
+
+        # set if the track was parsed by libass or has been fed through the
+        # streaming API, in which case libass owns (and frees) its strings,
+        # or once populate/sync has written strings that Python owns. the
+        # two cannot be mixed in one track.
+        self._libass_owned = False
+        self._populated = False
+        self._next_read_order = 0
+
     @property
     def styles(self):
         if self.n_styles == 0:
@@ -441,15 +680,64 @@ class Track(ctypes.Structure):
         return event
 
     def __del__(self):
-        # XXX: we can't use ass_free_track because it assumes we've allocated
-        #      our strings in the heap (wat), so we just free them with libc.
-        _libc.free(self.styles_arr)
-        _libc.free(self.events_arr)
-        _libc.free(ctypes.byref(self))
+        if not self.__dict__.get("_libass_owned", False):
+            # the strings of populated styles and events and the format lines
+            # belong to Python, so hide them from ass_free_track, which then
+            # only frees what libass allocated itself (the arrays, the parser
+            # state and the track).
+            self._free_render_priv(0, self.n_events)
+            self.n_styles = 0
+            self.n_events = 0
+            self.style_format = None
+            self.event_format = None
+
+        _libass.ass_free_track(ctypes.byref(self))
+
+    def _reserve(self, arr_name, max_name, struct, n):
+        """ Grow one of the libass arrays to hold at least ``n`` items, so that
+        they can be filled without going through ``ass_alloc_*``.
+        """
+        if getattr(self, max_name) >= n:
+            return
+
+        ptr = _libc.realloc(getattr(self, arr_name), n * ctypes.sizeof(struct))
+        if not ptr:
+            raise MemoryError("could not grow track array")
+
+        setattr(self, arr_name, ctypes.cast(ptr, ctypes.POINTER(struct)))
+        setattr(self, max_name, n)
 
-    def populate(self, doc):
-        """ Convert an ASS document to a track. """
-        self.type = Track.TYPE_ASS
+    @staticmethod
+    def _write_array(ptr, struct, offset, values):
+        """ Write a batch of structures into a libass array in one go. """
+        if not values:
+            return
+
+        arr = (struct * len(values))(*values)
+        ctypes.memmove(ctypes.cast(ptr, ctypes.c_void_p).value +
+                       offset * ctypes.sizeof(struct),
+                       arr, ctypes.sizeof(arr))
+
+    def _free_render_priv(self, start, stop):
+        """ Free the state libass attached to populated events in the given
+        range while rendering them (their collision boxes), before the events
+        are overwritten or dropped. ``ass_free_event`` would do this, but it
+        would also free the strings of the event, which belong to Python.
+        """
+        events = self.events
+        for i in range(start, min(stop, self.n_events)):
+            if events[i].render_priv:
+                _libc.free(events[i].render_priv)
+                events[i].render_priv = None
+
+    def _write_events(self, offset, keys):
+        Track._write_array(self.events_arr, Event, offset, [
+            key[:2] + (offset + i,) + key[2:]
+            for i, key in enumerate(keys)
+        ])
+
+    def _populate_header(self, doc):
+        self.track_type = Track.TYPE_ASS
 
         self.play_res_x = doc.play_res_x
         self.play_res_y = doc.play_res_y
@@ -460,16 +748,223 @@ class Track(ctypes.Structure):
         self.style_format = ", ".join(doc.styles_field_order).encode("utf-8")
         self.event_format = ", ".join(doc.events_field_order).encode("utf-8")
 
-        for d_style in doc.styles:
-            style = self.make_style()
-            style.populate(d_style)
+    def _populate_styles(self, doc):
+        """ Write the styles of a document if they differ from what the track
+        currently holds, and return the style name to style ID mapping.
+        """
+        style_values = [Style._values_from(style) for style in doc.styles]
+
+        if style_values != self._style_values:
+            self._reserve("styles_arr", "max_styles", Style, len(style_values))
+            Track._write_array(self.styles_arr, Style, 0, style_values)
+            self.n_styles = len(style_values)
+            self._style_values = style_values
+
+        style_ids = {}
+        for i, style in enumerate(doc.styles):
+            style_ids.setdefault(style.name, i)
+        return style_ids
+
+    @staticmethod
+    def _event_keys_from(doc, style_ids):
+        return [Event._key_from(event, style_ids)
+                for event in doc.events
+                if event.TYPE == "Dialogue"]
+
+    def _check_not_libass_owned(self):
+        if self._libass_owned:
+            raise RuntimeError("cannot populate a track that was parsed or "
+                               "streamed into by libass")
 
-        for d_event in doc.events:
-            if d_event.TYPE != "Dialogue":
+    def populate(self, doc):
+        """ Convert an ASS document to a track.
+
+        Any styles and events already in the track are replaced. The libass
+        arrays are sized once up front and filled in bulk.
+        """
+        self._check_not_libass_owned()
+        self._populated = True
+        self._populate_header(doc)
+
+        self._style_values = []
+        style_ids = self._populate_styles(doc)
+
+        keys = Track._event_keys_from(doc, style_ids)
+        self._free_render_priv(0, self.n_events)
+        self._reserve("events_arr", "max_events", Event, len(keys))
+        self._write_events(0, keys)
+        self.n_events = len(keys)
+        self._event_keys = keys
+
+    def sync(self, doc):
+        """ Update a track previously filled with ``populate`` to match an
+        edited version of the document.
+
+        Only the run of events between the unchanged head and tail of the
+        event list is rewritten; the tail is moved in place if the number of
+        events changed. Returns a ``(removed, added)`` tuple of how many
+        events were dropped from and written to the track.
+        """
+        self._check_not_libass_owned()
+        self._populated = True
+        self._populate_header(doc)
+        style_ids = self._populate_styles(doc)
+
+        old = self._event_keys
+        new = Track._event_keys_from(doc, style_ids)
+        n_old = len(old)
+        n_new = len(new)
+
+        limit = min(n_old, n_new)
+
+        head = 0
+        while head < limit and old[head] == new[head]:
+            head += 1
+
+        tail = 0
+        while tail < limit - head and old[n_old - tail - 1] == new[n_new - tail - 1]:
+            tail += 1
+
+        # the unchanged events keep pointing at the old strings, so keep those
+        # alive instead of the equal ones we just built.
+        new[:head] = old[:head]
+        new[n_new - tail:] = old[n_old - tail:]
+
+        # the rewritten events start with a NULL render_priv, which libass
+        # allocates again on the next render: the collision state it holds
+        # belongs to the old events, so it is freed rather than carried over.
+        self._free_render_priv(head, n_old - tail)
+
+        self._reserve("events_arr", "max_events", Event, n_new)
+
+        if tail and n_old != n_new:
+            size = ctypes.sizeof(Event)
+            base = ctypes.cast(self.events_arr, ctypes.c_void_p).value
+            ctypes.memmove(base + (n_new - tail) * size,
+                           base + (n_old - tail) * size,
+                           tail * size)
+
+        self._write_events(head, new[head:n_new - tail])
+        self.n_events = n_new
+        self._event_keys = new
+
+        if tail and n_old != n_new:
+            events = self.events
+            for i in range(n_new - tail, n_new):
+                events[i].read_order = i
+
+        return (n_old - head - tail, n_new - head - tail)
+
+    # the fields of a Matroska ASS packet, which ass_process_chunk expects,
+    # minus the leading ReadOrder.
+    CHUNK_FIELD_ORDER = ("Layer", "Style", "Name", "MarginL", "MarginR",
+                         "MarginV", "Effect", "Text")
+
+    def _start_streaming(self):
+        if self._populated:
+            raise RuntimeError("cannot stream into a populated track")
+        self._libass_owned = True
+
+    def process_codec_private(self, data):
+        """ Feed the header of a script (script info, styles and the events
+        format line, e.g. from a Matroska CodecPrivate) to the track, ahead of
+        streaming its events in with ``process_chunk``.
+        """
+        self._start_streaming()
+        _libass.ass_process_codec_private(ctypes.byref(self), data, len(data))
+
+    def process_header(self, doc):
+        """ Feed the header of a document to the track, like
+        ``process_codec_private``.
+        """
+        header = copy.copy(doc)
+        header.events = []
+
+        f = io.StringIO()
+        header.dump_file(f)
+        self.process_codec_private(f.getvalue().encode("utf-8"))
+
+    def process_chunk(self, data, start, duration):
+        """ Add a single event in Matroska packet format (``ReadOrder, Layer,
+        Style, Name, MarginL, MarginR, MarginV, Effect, Text``) to the track.
+        Events with a ReadOrder that has already been seen are dropped by
+        libass.
+        """
+        self._start_streaming()
+        _libass.ass_process_chunk(ctypes.byref(self), data, len(data),
+                                  Renderer.timedelta_to_ms(start),
+                                  Renderer.timedelta_to_ms(duration))
+
+    def process_data(self, data):
+        """ Add complete script lines (e.g. ``Dialogue: ...``) to the track. """
+        self._start_streaming()
+        _libass.ass_process_data(ctypes.byref(self), data, len(data))
+
+    def process_event(self, event):
+        """ Add a document event to the track as it arrives. Like
+        ``populate``, only dialogue events are added.
+        """
+        if event.TYPE != "Dialogue":
+            return
+
+        read_order = self._next_read_order
+        self._next_read_order += 1
+
+        data = str(read_order) + "," + event.dump(Track.CHUNK_FIELD_ORDER)
+        self.process_chunk(data.encode("utf-8"), event.start,
+                           event.end - event.start)
+
+    def prune_events(self, before):
+        """ Drop the streamed events that end at or before the given time, so
+        that a long-running stream keeps a bounded number of events around.
+        Returns the number of events dropped.
+        """
+        if not self._libass_owned:
+            raise RuntimeError("can only prune parsed or streamed events")
+
+        deadline = Renderer.timedelta_to_ms(before)
+        n = self.n_events
+        if not n:
+            return 0
+
+        events = self.events
+        size = ctypes.sizeof(Event)
+        base = ctypes.cast(self.events_arr, ctypes.c_void_p).value
+
+        kept = 0
+        for i in range(n):
+            event = events[i]
+            if event.start_ms + event.duration_ms <= deadline:
+                _libass.ass_free_event(ctypes.byref(self), i)
                 continue
-            event = self.make_event()
-            event.populate(d_event)
 
+            if kept != i:
+                ctypes.memmove(base + kept * size, base + i * size, size)
+            kept += 1
+
+        self.n_events = kept
+        return n - kept
+
+    def segments(self):
+        """ Split the events of the track into segments between event
+        boundaries, like ``Document.segments``, with times in milliseconds.
+        """
+        return timeline.segments(
+            (event.start_ms, event.start_ms + event.duration_ms,
+             timeline.is_animated(
+                 (event.text or b"").decode("utf-8", "replace"),
+                 (event.effect or b"").decode("utf-8", "replace")),
+             event)
+            for event in self.events)
+
+    def flush_events(self):
+        """ Drop all streamed events, e.g. after seeking. """
+        if not self._libass_owned:
+            raise RuntimeError("can only flush parsed or streamed events")
+        _libass.ass_flush_events(ctypes.byref(self))
+
+_libc.realloc.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.realloc.restype = ctypes.c_void_p
 
 _libc.free.argtypes = [ctypes.c_void_p]
 
@@ -515,8 +1010,41 @@ _libass.ass_read_memory.argtypes = [
 ]
 _libass.ass_read_memory.restype = ctypes.POINTER(Track)
 
+_libass.ass_free_track.argtypes = [ctypes.POINTER(Track)]
+
 _libass.ass_alloc_style.argtypes = [ctypes.POINTER(Track)]
 _libass.ass_alloc_style.restype = ctypes.c_int
 
 _libass.ass_alloc_event.argtypes = [ctypes.POINTER(Track)]
 _libass.ass_alloc_event.restype = ctypes.c_int
+
+_libass.ass_process_codec_private.argtypes = [
+    ctypes.POINTER(Track),
+    ctypes.c_char_p,
+    ctypes.c_int
+]
+
+_libass.ass_process_chunk.argtypes = [
+    ctypes.POINTER(Track),
+    ctypes.c_char_p,
+    ctypes.c_int,
+    ctypes.c_longlong,
+    ctypes.c_longlong
+]
+
+_libass.ass_process_data.argtypes = [
+    ctypes.POINTER(Track),
+    ctypes.c_char_p,
+    ctypes.c_int
+]
+
+_libass.ass_flush_events.argtypes = [ctypes.POINTER(Track)]
+
+_libass.ass_free_event.argtypes = [ctypes.POINTER(Track), ctypes.c_int]
+
+_libass.ass_add_font.argtypes = [
+    ctypes.POINTER(Context),
+    ctypes.c_char_p,
+    ctypes.c_char_p,
+    ctypes.c_int
+]
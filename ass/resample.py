@@ -0,0 +1,170 @@
+""" Resampling of a script to a different resolution (PlayResX/PlayResY),
+rescaling styles, event margins and positional override tags.
+"""
+
+import re
+
+# splits text into override blocks and the text between them.
+_BLOCK_RE = re.compile(r"(\{[^}]*\})")
+
+_TAG_RE = re.compile(r"\\(pos|move|org|i?clip)\(([^)]*)\)|"
+                     r"\\(fsp|fs|xbord|ybord|bord|xshad|yshad|shad|blur|p)"
+                     r"(-?(?:\d+\.?\d*|\.\d+))")
+
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?|-?\.\d+")
+_DRAWING_ARG_RE = re.compile(r"[a-zA-Z]")
+
+# per (rx, ry, scale_borders) caches of resampled texts.
+_caches = {}
+_CACHE_SIZE = 65536
+
+
+def _num(v):
+    if v == int(v):
+        return str(int(v))
+    return ("%.3f" % v).rstrip("0").rstrip(".")
+
+
+class _Resampler(object):
+    def __init__(self, rx, ry, scale_borders):
+        self.rx = rx
+        self.ry = ry
+        self.border = ry if scale_borders else 1.0
+
+        self.scales = {
+            "fs": ry,
+            "fsp": rx,
+            "bord": self.border,
+            "xbord": rx if scale_borders else 1.0,
+            "ybord": self.border,
+            "shad": self.border,
+            "xshad": rx if scale_borders else 1.0,
+            "yshad": self.border,
+            "blur": self.border
+        }
+
+    def drawing(self, s):
+        """ Scale the alternating x and y coordinates of drawing commands. """
+        axis = [0]
+
+        def scale(m):
+            r = self.rx if axis[0] % 2 == 0 else self.ry
+            axis[0] += 1
+            return _num(float(m.group(0)) * r)
+
+        return _NUMBER_RE.sub(scale, s)
+
+    def _points(self, args, n):
+        values = args.split(",")
+        for i in range(min(n, len(values))):
+            r = self.rx if i % 2 == 0 else self.ry
+            try:
+                values[i] = _num(float(values[i]) * r)
+            except ValueError:
+                # leave malformed arguments as they are, like libass would
+                # ignore the tag.
+                pass
+        return ",".join(values)
+
+    def tag(self, m):
+        name, args = m.group(1), m.group(2)
+
+        if name is not None:
+            if name in ("pos", "org"):
+                return "\\" + name + "(" + self._points(args, 2) + ")"
+
+            if name == "move":
+                return "\\move(" + self._points(args, 4) + ")"
+
+            # \clip and \iclip take either a rectangle or a drawing.
+            if _DRAWING_ARG_RE.search(args):
+                return "\\" + name + "(" + self.drawing_arg(args) + ")"
+            return "\\" + name + "(" + self._points(args, 4) + ")"
+
+        name, value = m.group(3), m.group(4)
+        if name == "p":
+            self.drawing_mode = float(value) > 0
+            return m.group(0)
+
+        return "\\" + name + _num(float(value) * self.scales[name])
+
+    def drawing_arg(self, args):
+        # an optional scale argument comes before the drawing.
+        scale, sep, drawing = args.partition(",")
+        if not sep:
+            return self.drawing(args)
+        return scale + "," + self.drawing(drawing)
+
+    def text(self, text):
+        self.drawing_mode = False
+        parts = _BLOCK_RE.split(text)
+
+        for i, part in enumerate(parts):
+            if i % 2:
+                parts[i] = _TAG_RE.sub(self.tag, part)
+            elif self.drawing_mode and part:
+                parts[i] = self.drawing(part)
+
+        return "".join(parts)
+
+
+def resample(doc, x, y):
+    """ Resample a document to a new script resolution in place. """
+    rx = x / float(doc.play_res_x)
+    ry = y / float(doc.play_res_y)
+    scale_borders = str(doc.scaled_border_and_shadow).lower() == "yes"
+
+    resampler = _Resampler(rx, ry, scale_borders)
+    border = resampler.border
+    aspect = rx / ry
+
+    # styles, a column at a time.
+    styles = doc.styles
+    columns = [
+        ("fontsize", ry, float),
+        ("spacing", rx, float),
+        ("outline", border, float),
+        ("shadow", border, float),
+        ("margin_l", rx, lambda v: int(round(v))),
+        ("margin_r", rx, lambda v: int(round(v))),
+        ("margin_v", ry, lambda v: int(round(v)))
+    ]
+    if abs(aspect - 1) > 1e-9:
+        columns.append(("scale_x", aspect, float))
+
+    for attr, ratio, convert in columns:
+        if ratio == 1:
+            continue
+        values = [getattr(style, attr) * ratio for style in styles]
+        for style, v in zip(styles, values):
+            setattr(style, attr, convert(v))
+
+    # events: margins, which override the style's if non-zero, and tags.
+    key = (rx, ry, scale_borders)
+    cache = _caches.get(key)
+    if cache is None:
+        if len(_caches) > 16:
+            _caches.clear()
+        cache = _caches[key] = {}
+
+    for event in doc.events:
+        for attr, ratio in (("margin_l", rx), ("margin_r", rx),
+                            ("margin_v", ry)):
+            v = getattr(event, attr)
+            if v:
+                setattr(event, attr, int(round(v * ratio)))
+
+        text = event.text
+        try:
+            resampled = cache[text]
+        except KeyError:
+            if len(cache) >= _CACHE_SIZE:
+                cache.clear()
+            resampled = cache[text] = resampler.text(text) \
+                if "{" in text else text
+
+        if resampled != text:
+            event.text = resampled
+
+    doc.play_res_x = x
+    doc.play_res_y = y
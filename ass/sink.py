@@ -0,0 +1,149 @@
+""" Streaming of composited frames to an encoder, e.g. over a pipe to
+``ffmpeg -f rawvideo``.
+"""
+
+import os
+import queue
+import threading
+import time
+
+
+class FrameSink(object):
+    """ Writes composited frames to a file object or file descriptor.
+
+    Frames are composited into one of two reusable buffers while a background
+    thread writes out the other one, so rendering and compositing the next
+    frame overlaps with writing the previous one. If the writer falls behind,
+    ``write_frame`` blocks until a buffer is free; the time spent waiting is
+    reported as ``backpressure_time`` in ``stats``.
+    """
+
+    def __init__(self, f, compositor, buffers=2):
+        self.compositor = compositor
+
+        if isinstance(f, int):
+            self._write = self._make_fd_writer(f)
+            self._flush = None
+        else:
+            self._write = f.write
+            self._flush = getattr(f, "flush", None)
+
+        self._free = queue.Queue()
+        self._full = queue.Queue()
+        for _ in range(buffers):
+            self._free.put(compositor.make_buffer())
+
+        self._error = None
+        self._closed = False
+
+        self.frames = 0
+        self.bytes_written = 0
+        self.composite_time = 0.0
+        self.write_time = 0.0
+        self.backpressure_time = 0.0
+        self._started = time.perf_counter()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _make_fd_writer(fd):
+        def write(data):
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        return write
+
+    def _run(self):
+        while True:
+            buf = self._full.get()
+            if buf is None:
+                break
+
+            if self._error is None:
+                start = time.perf_counter()
+                try:
+                    self._write(memoryview(buf).cast("B"))
+                except Exception as e:
+                    self._error = e
+                else:
+                    self.write_time += time.perf_counter() - start
+                    self.bytes_written += buf.nbytes
+
+            self._free.put(buf)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise IOError("frame sink writer failed: " + str(self._error))
+
+    def write_frame(self, images):
+        """ Composite the images of a rendered frame and queue the result for
+        writing. The images are no longer needed once this returns, so it is
+        safe to render the next frame.
+        """
+        if self._closed:
+            raise ValueError("write to closed frame sink")
+        self._check_error()
+
+        start = time.perf_counter()
+        buf = self._free.get()
+        self.backpressure_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            self.compositor.composite(images, buf)
+        except Exception:
+            self._free.put(buf)
+            raise
+        self.composite_time += time.perf_counter() - start
+
+        self._full.put(buf)
+        self.frames += 1
+
+    def render(self, renderer, track, times):
+        """ Render a track at each of the given times and write the frames. """
+        for now in times:
+            self.write_frame(renderer.render_frame(track, now))
+
+    def close(self):
+        """ Wait for all queued frames to be written. """
+        if self._closed:
+            return
+        self._closed = True
+
+        self._full.put(None)
+        self._thread.join()
+
+        if self._flush is not None and self._error is None:
+            self._flush()
+        self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+
+        # a write error must not replace the exception that ended the block.
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        """ Get the sink's counters as a dict. """
+        elapsed = time.perf_counter() - self._started
+        return {
+            "frames": self.frames,
+            "bytes_written": self.bytes_written,
+            "composite_time": self.composite_time,
+            "write_time": self.write_time,
+            "backpressure_time": self.backpressure_time,
+            "pending": self._full.qsize(),
+            "elapsed": elapsed,
+            "fps": self.frames / elapsed if elapsed else 0.0,
+            "bytes_per_second": self.bytes_written / elapsed if elapsed else 0.0
+        }
@@ -0,0 +1,99 @@
+""" Collection of rendering statistics, for tuning e.g. the renderer's cache
+limits.
+"""
+
+import bisect
+
+
+class RenderStats(object):
+    """ Per-frame rendering statistics: render latency, images and pixels by
+    image type, libass' change detection outcomes and bitmap memory per
+    frame.
+
+    libass does not report how full its caches are, so cache pressure is
+    estimated by comparing the bitmap bytes of the largest frame against
+    the configured bitmap cache limit.
+    """
+
+    # upper bounds of the latency histogram buckets, in milliseconds. frames
+    # slower than the last one go in an extra overflow bucket.
+    LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    TYPE_NAMES = ("character", "outline", "shadow")
+    CHANGE_NAMES = ("none", "positions", "content")
+
+    def __init__(self):
+        self.cache_limits = None
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.render_time = 0.0
+        self.max_render_time = 0.0
+        self.latency_histogram = [0] * (len(self.LATENCY_BUCKETS_MS) + 1)
+
+        self.images = [0] * len(self.TYPE_NAMES)
+        self.pixels = [0] * len(self.TYPE_NAMES)
+        self.max_images = 0
+
+        self.bitmap_bytes = 0
+        self.max_bitmap_bytes = 0
+
+        self.changes = [0] * len(self.CHANGE_NAMES)
+
+    def record(self, elapsed, changed, images):
+        """ Record a rendered frame, given its render time in seconds, the
+        change detection result and its images.
+        """
+        self.frames += 1
+        self.render_time += elapsed
+        self.max_render_time = max(self.max_render_time, elapsed)
+        self.latency_histogram[bisect.bisect_left(self.LATENCY_BUCKETS_MS,
+                                                  elapsed * 1000)] += 1
+
+        if 0 <= changed < len(self.changes):
+            self.changes[changed] += 1
+
+        n = 0
+        frame_bytes = 0
+        for img in images:
+            n += 1
+            if 0 <= img.type < len(self.images):
+                self.images[img.type] += 1
+                self.pixels[img.type] += img.w * img.h
+            frame_bytes += img.stride * img.h
+
+        self.max_images = max(self.max_images, n)
+        self.bitmap_bytes += frame_bytes
+        self.max_bitmap_bytes = max(self.max_bitmap_bytes, frame_bytes)
+
+    def as_dict(self):
+        """ Export the statistics as a flat-ish dict of plain values. """
+        frames = self.frames or 1
+
+        cache_pressure = None
+        if self.cache_limits is not None and self.cache_limits[1] > 0:
+            cache_pressure = self.max_bitmap_bytes / \
+                float(self.cache_limits[1] * 1024 * 1024)
+
+        return {
+            "frames": self.frames,
+            "render_time": self.render_time,
+            "mean_render_time": self.render_time / frames,
+            "max_render_time": self.max_render_time,
+            "latency_histogram_ms": dict(
+                zip([str(b) for b in self.LATENCY_BUCKETS_MS] + ["inf"],
+                    self.latency_histogram)),
+            "images": dict(zip(self.TYPE_NAMES, self.images)),
+            "pixels": dict(zip(self.TYPE_NAMES, self.pixels)),
+            "mean_images_per_frame": sum(self.images) / float(frames),
+            "max_images_per_frame": self.max_images,
+            "mean_bitmap_bytes_per_frame": self.bitmap_bytes / float(frames),
+            "max_bitmap_bytes_per_frame": self.max_bitmap_bytes,
+            "changes": dict(zip(self.CHANGE_NAMES, self.changes)),
+            "cache_limits": {
+                "glyph_max": self.cache_limits[0],
+                "bitmap_max_size_mb": self.cache_limits[1]
+            } if self.cache_limits is not None else None,
+            "cache_pressure": cache_pressure
+        }
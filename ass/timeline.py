@@ -0,0 +1,74 @@
+""" Splitting of a script's timeline into segments between event boundaries,
+and detection of the segments whose rendered output cannot change.
+"""
+
+import collections
+import re
+
+
+class Segment(collections.namedtuple("Segment",
+                                     ["start", "end", "events", "static"])):
+    """ A span of time ``[start, end)`` during which the same events are
+    active. If ``static`` is true, none of them animate, so a frame rendered
+    anywhere in the segment is valid for all of it.
+    """
+    __slots__ = ()
+
+
+# override tags that make an event change over its lifetime: transforms,
+# movement, fades and karaoke.
+_ANIMATED_TAG_RE = re.compile(r"\\(?:t\s*\(|move\s*\(|fade?\s*\(|[kK][fo]?\s*\d)")
+
+_animated_cache = {}
+_ANIMATED_CACHE_SIZE = 65536
+
+
+def is_animated(text, effect=""):
+    """ Check whether an event with the given text and effect animates. Any
+    effect (``Banner``, ``Scroll up`` and the like) counts as animating.
+    """
+    if effect:
+        return True
+
+    try:
+        return _animated_cache[text]
+    except KeyError:
+        pass
+
+    if len(_animated_cache) >= _ANIMATED_CACHE_SIZE:
+        _animated_cache.clear()
+
+    animated = _ANIMATED_TAG_RE.search(text) is not None
+    _animated_cache[text] = animated
+    return animated
+
+
+def segments(items):
+    """ Split a timeline into segments. ``items`` is an iterable of ``(start,
+    end, animated, event)`` tuples, with any orderable time type; the events
+    of each segment are kept in the order they were given in. Times before
+    the first segment and after the last one have no active events.
+    """
+    items = [item for item in items if item[1] > item[0]]
+
+    boundaries = sorted(set(item[0] for item in items) |
+                        set(item[1] for item in items))
+    by_start = sorted(range(len(items)), key=lambda i: items[i][0])
+
+    out = []
+    active = set()
+    j = 0
+
+    for start, end in zip(boundaries, boundaries[1:]):
+        active = set(i for i in active if items[i][1] > start)
+
+        while j < len(by_start) and items[by_start[j]][0] <= start:
+            active.add(by_start[j])
+            j += 1
+
+        indices = sorted(active)
+        out.append(Segment(start, end,
+                           [items[i][3] for i in indices],
+                           not any(items[i][2] for i in indices)))
+
+    return out
@@ -0,0 +1,50 @@
+""" The YCbCr matrices libass scripts can ask for, and conversion of colors
+to them. Unlike ``compositor``, this does not need NumPy.
+"""
+
+# libass' YCbCr matrix values (``Track.ycbcr_matrix``), mapped to the luma
+# coefficients (kr, kb) and whether the matrix uses the full 0-255 range.
+MATRIX_DEFAULT = 0
+MATRIX_UNKNOWN = 1
+MATRIX_NONE = 2
+MATRIX_BT601_TV = 3
+MATRIX_BT601_PC = 4
+MATRIX_BT709_TV = 5
+MATRIX_BT709_PC = 6
+MATRIX_SMPTE240M_TV = 7
+MATRIX_SMPTE240M_PC = 8
+MATRIX_FCC_TV = 9
+MATRIX_FCC_PC = 10
+
+MATRICES = {
+    MATRIX_BT601_TV: (0.299, 0.114, False),
+    MATRIX_BT601_PC: (0.299, 0.114, True),
+    MATRIX_BT709_TV: (0.2126, 0.0722, False),
+    MATRIX_BT709_PC: (0.2126, 0.0722, True),
+    MATRIX_SMPTE240M_TV: (0.212, 0.087, False),
+    MATRIX_SMPTE240M_PC: (0.212, 0.087, True),
+    MATRIX_FCC_TV: (0.3, 0.11, False),
+    MATRIX_FCC_PC: (0.3, 0.11, True)
+}
+
+
+def rgb_to_yuv(r, g, b, matrix):
+    """ Convert an 8-bit RGB color to 8-bit YCbCr with one of the
+    ``MATRIX_*`` matrices.
+    """
+    kr, kb, full_range = MATRICES[matrix]
+
+    r /= 255.0
+    g /= 255.0
+    b /= 255.0
+
+    y = kr * r + (1 - kr - kb) * g + kb * b
+    u = (b - y) / (2 * (1 - kb))
+    v = (r - y) / (2 * (1 - kr))
+
+    if full_range:
+        y, u, v = y * 255, 128 + u * 255, 128 + v * 255
+    else:
+        y, u, v = 16 + y * 219, 128 + u * 224, 128 + v * 224
+
+    return tuple(min(max(int(round(c)), 0), 255) for c in (y, u, v))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+""" Measure the throughput of the streaming converters in ass.convert, in
+megabytes of input per second.
+
+    python convert_benchmark.py [events]
+"""
+
+from ass import convert
+import io
+import sys
+import time
+
+
+def make_ass(n):
+    f = io.StringIO()
+    convert.write_ass((
+        convert.document.Dialogue(
+            start=convert.timedelta(seconds=i),
+            end=convert.timedelta(seconds=i + 2),
+            text="{\\i1}line %d{\\i0} of the\\Nbenchmark {\\b1}script{\\b0}" %
+                 (i % 5000)
+        ) for i in range(n)), f)
+    return f.getvalue()
+
+
+def measure(name, src, convert_file):
+    start = time.perf_counter()
+    convert_file(io.StringIO(src), io.StringIO())
+    elapsed = time.perf_counter() - start
+
+    mb = len(src.encode("utf-8")) / 1e6
+    print("{:>10} {:>8.1f} MB {:>8.2f} s {:>8.1f} MB/s".format(
+        name, mb, elapsed, mb / elapsed))
+
+
+def main(n):
+    src = make_ass(n)
+
+    srt = io.StringIO()
+    convert.ass_to_srt(io.StringIO(src), srt)
+    vtt = io.StringIO()
+    convert.ass_to_vtt(io.StringIO(src), vtt)
+
+    measure("ass->srt", src, convert.ass_to_srt)
+    measure("ass->vtt", src, convert.ass_to_vtt)
+    measure("srt->ass", srt.getvalue(), convert.srt_to_ass)
+    measure("vtt->ass", vtt.getvalue(), convert.vtt_to_ass)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
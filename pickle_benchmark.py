@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+""" Compare ways of getting a document into another process: pickling it
+(which goes through ass.packed), pickling its plain state as before,
+parsing its text again, and attaching to it in shared memory.
+
+    python pickle_benchmark.py [events]
+"""
+
+from ass import document
+import pickle
+import sys
+import time
+
+
+def make_document(n):
+    doc = document.Document()
+    doc.styles.append(document.Style())
+    doc.events.extend(
+        document.Dialogue(
+            start=document.timedelta(seconds=i),
+            end=document.timedelta(seconds=i + 2),
+            text="{\\i1}line %d{\\i0} of the\\Nbenchmark" % (i % 5000)
+        ) for i in range(n))
+    return doc
+
+
+def measure(name, f):
+    start = time.perf_counter()
+    size = f()
+    elapsed = time.perf_counter() - start
+    print("{:>18} {:>10.4f} s {:>10.1f} MB".format(name, elapsed,
+                                                 size / 1e6))
+
+
+def main(n):
+    doc = make_document(n)
+
+    packed = pickle.dumps(doc)
+    plain = pickle.dumps(doc.__getstate__())
+    text = doc.dumps()
+
+    measure("pickle dumps", lambda: len(pickle.dumps(doc)))
+    measure("pickle loads", lambda: pickle.loads(packed) and len(packed))
+    measure("plain dumps", lambda: len(pickle.dumps(doc.__getstate__())))
+    measure("plain loads", lambda: pickle.loads(plain) and len(plain))
+    measure("parse", lambda: document.Document.parse_string(text) and
+            len(text))
+
+    with doc.share() as shared:
+        def attach():
+            attached = shared.attach(shared.name)
+            attached.packed.column("events", "Start")
+            attached.close()
+            return 0
+
+        measure("shared attach", attach)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
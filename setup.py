@@ -19,4 +19,5 @@ setup(
     'Topic :: Software Development :: Libraries',
     'Topic :: Text Processing :: Markup'],
     install_requires = ['setuptools'],
+    extras_require = {'numpy': ['numpy']},
     zip_safe=True)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import ass
+import ctypes
+import os
 import unittest
 
 try:
@@ -8,6 +10,37 @@ try:
 except:
     from io import StringIO
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the renderer needs libass, which may not be installed. CI sets
+# ASS_REQUIRE_LIBASS so that its tests fail rather than being skipped there.
+renderer = getattr(ass, "renderer", None)
+if renderer is None and os.environ.get("ASS_REQUIRE_LIBASS"):
+    raise RuntimeError("ASS_REQUIRE_LIBASS is set but libass could not be "
+                       "loaded")
+
+class BitmapImage(object):
+    """ Stands in for a rendered ``ass.renderer.Image``. """
+
+    type = 0
+
+    def __init__(self, w, h, bitmap, color, dst_x, dst_y):
+        self.w = w
+        self.h = h
+        self.stride = w
+        self._buf = ctypes.create_string_buffer(bitmap, len(bitmap))
+        self.bitmap = ctypes.cast(self._buf, ctypes.POINTER(ctypes.c_char))
+        self.color = color
+        self.dst_x = dst_x
+        self.dst_y = dst_y
+
+    @property
+    def rgba(self):
+        return tuple(self.color >> shift & 0xff for shift in (24, 16, 8, 0))
+
 class TestEverything(unittest.TestCase):
     def test_parse_dump(self):
         with open("test.ass", "r") as f:
@@ -19,5 +52,1057 @@ class TestEverything(unittest.TestCase):
 
         self.assertEqual(out.getvalue().strip(), contents.strip())
 
+    def test_dumps(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        out = StringIO()
+        doc.dump_file(out)
+        self.assertEqual(doc.dumps(), out.getvalue())
+        self.assertEqual(doc.dump_bytes(), out.getvalue().encode("utf-8"))
+
+        # values not of their field's type are dumped like before.
+        event = doc.events[0]
+        event.layer = True
+        event.margin_l = None
+        event.margin_r = 2.5
+        self.assertEqual(event.dump().split(",")[:7],
+                         ["-1", "0:00:00.00", "0:00:05.00", "Default", "",
+                          "", "2.5"])
+
+def track_events(track):
+    """ The fields of the events of a track, with style names for ids. """
+    return [(e.start_ms, e.duration_ms, e.layer,
+             track.styles[e.style_id].name, e.name, e.margin_l, e.margin_r,
+             e.margin_v, e.effect, e.text)
+            for e in track.events]
+
+def track_styles(track):
+    """ The main fields of the styles of a track, by name. libass may add
+    a default style of its own ahead of the script's when parsing.
+    """
+    return dict((s.name, (s.fontname, s.fontsize, s.primary_color,
+                          s.outline_color, s.scale_x, s.alignment,
+                          s.margin_l, s.margin_v))
+                for s in track.styles)
+
+@unittest.skipUnless(renderer, "requires libass")
+class TestTrack(unittest.TestCase):
+    def parsed(self, ctx, doc):
+        return ctx.parse_to_track(doc.dump_bytes())
+
+    def render(self, ctx, track, *seconds):
+        """ Render a track at the given times, so that libass attaches its
+        state to the events. Returns the number of images of each frame.
+        """
+        from datetime import timedelta
+
+        r = ctx.make_renderer()
+        r.set_fonts()
+        r.set_all_sizes((640, 480))
+        counts = []
+        for s in seconds:
+            with r.render_frame(track, timedelta(seconds=s)) as images:
+                counts.append(len(list(images)))
+        return counts
+
+    def test_populate(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        ctx = renderer.Context()
+        track = ctx.make_track()
+        track.populate(doc)
+        parsed = self.parsed(ctx, doc)
+
+        self.assertEqual(track_events(track), track_events(parsed))
+        styles = track_styles(parsed)
+        for name, values in track_styles(track).items():
+            self.assertEqual(values, styles[name])
+
+    def test_sync(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        ctx = renderer.Context()
+        track = ctx.make_track()
+        track.populate(doc)
+        self.render(ctx, track, 1)
+
+        # the rendered events' state is freed as they are overwritten.
+        doc.events[1].text = "edited"
+        del doc.events[2]
+        self.assertEqual(track.sync(doc), (2, 1))
+        self.assertEqual(track_events(track),
+                         track_events(self.parsed(ctx, doc)))
+        self.render(ctx, track, 1)
+
+        # the whole list moves up to make room.
+        doc.events.insert(0, ass.document.Dialogue(text="inserted"))
+        self.assertEqual(track.sync(doc), (0, 1))
+        self.assertEqual(track_events(track),
+                         track_events(self.parsed(ctx, doc)))
+        self.render(ctx, track, 1)
+
+        track.populate(doc)
+        self.render(ctx, track, 1)
+
+        fresh = ctx.make_track()
+        fresh.populate(doc)
+        self.assertEqual([e.read_order for e in track.events],
+                         [e.read_order for e in fresh.events])
+
+        self.assertEqual(track.sync(doc), (0, 0))
+
+    def test_stream(self):
+        from datetime import timedelta
+
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+        for i, event in enumerate(doc.events):
+            event.start = timedelta(seconds=i)
+            event.end = timedelta(seconds=i + 1)
+
+        ctx = renderer.Context()
+        track = ctx.make_track()
+        track.process_header(doc)
+        for event in doc.events:
+            track.process_event(event)
+
+        expected = track_events(self.parsed(ctx, doc))
+        self.assertEqual(track_events(track), expected)
+        self.render(ctx, track, 0.5, 1.5, 2.5)
+
+        # events are only dropped once they have ended, and the rest move
+        # down intact, in order.
+        self.assertEqual(track.prune_events(timedelta(seconds=2.5)), 2)
+        self.assertEqual(track.n_events, len(doc.events) - 2)
+        self.assertEqual(track_events(track), expected[2:])
+        self.assertEqual(track.prune_events(timedelta(seconds=2.5)), 0)
+        self.render(ctx, track, 2.5, 3.5)
+
+        # the array takes new events after the kept ones.
+        late = ass.document.Dialogue(start=timedelta(seconds=10),
+                                     end=timedelta(seconds=11),
+                                     style="Default", text="late")
+        track.process_event(late)
+        self.assertEqual(track.n_events, len(doc.events) - 1)
+        self.assertEqual(track_events(track)[:-1], expected[2:])
+        self.assertEqual(track.events[-1].text, b"late")
+        self.render(ctx, track, 3.5, 10.5)
+
+        # pruning everything, then flushing an empty track, is fine too.
+        self.assertEqual(track.prune_events(timedelta(seconds=20)),
+                         len(doc.events) - 1)
+        self.assertEqual(track.n_events, 0)
+        self.assertEqual(self.render(ctx, track, 10.5), [0])
+
+        track.process_event(late)
+        track.flush_events()
+        self.assertEqual(track.n_events, 0)
+        del track
+
+    def test_ownership(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+        doc.events = []
+
+        ctx = renderer.Context()
+
+        # even without events, the format lines and styles of a populated
+        # track belong to Python, which libass must not free.
+        track = ctx.make_track()
+        track.populate(doc)
+        with self.assertRaises(RuntimeError):
+            track.process_header(doc)
+        with self.assertRaises(RuntimeError):
+            track.process_data(b"Dialogue: 0,0:00:00.00,0:00:01.00,"
+                               b"Default,,0,0,0,,x")
+        del track
+
+        streamed = ctx.make_track()
+        streamed.process_header(doc)
+        with self.assertRaises(RuntimeError):
+            streamed.populate(doc)
+        del streamed
+
+    def test_track_from_document(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        ctx = renderer.Context()
+        parsed = ctx.track_from_document(doc, "parse")
+        populated = ctx.track_from_document(doc, "populate")
+        self.assertEqual(track_events(parsed), track_events(populated))
+
+        with self.assertRaises(RuntimeError):
+            parsed.sync(doc)
+        self.assertEqual(populated.sync(doc), (0, 0))
+
+        with self.assertRaises(ValueError):
+            ctx.track_from_document(doc, "copy")
+
+class TestSelect(unittest.TestCase):
+    def test_select(self):
+        doc = ass.document.Document()
+        a = ass.document.Dialogue(style="Default", name="Alice",
+                                  text="{\\i1}Hello\\Nthere")
+        b = ass.document.Dialogue(style="Sign", layer=1, text="Exit")
+        c = ass.document.Comment(style="Default", name="Alice",
+                                 text="hello world")
+        doc.events.extend([a, b, c])
+
+        self.assertEqual(doc.select(style="Default"), [a, c])
+        self.assertEqual(doc.select(style="Default", type="Dialogue"), [a])
+        self.assertEqual(doc.select(type=ass.document.Comment), [c])
+        self.assertEqual(doc.select(layer=[0, 1], name="Alice"), [a, c])
+        self.assertEqual(doc.select(text="hello"), [a, c])
+        self.assertEqual(doc.select(text="o t"), [a])
+        self.assertEqual(doc.select(word="EXIT"), [b])
+
+        # the indexes follow changes to the events.
+        b.style = "Default"
+        b.text = "hello again"
+        self.assertEqual(doc.select(style="Default"), [a, b, c])
+        self.assertEqual(doc.select(word="hello"), [a, b, c])
+
+        d = ass.document.Dialogue(style="Sign")
+        doc.events.insert(0, d)
+        del doc.events[1]
+        self.assertEqual(doc.select(style=["Sign", "Default"]), [d, b, c])
+        self.assertEqual(doc.select(name="Alice"), [c])
+
+        doc.events = [a]
+        self.assertEqual(doc.select(style="Default"), [a])
+
+class TestFork(unittest.TestCase):
+    def test_copy_on_write(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        fork = doc.fork()
+        self.assertIs(fork.events[0].fields, doc.events[0].fields)
+
+        fork.events[0].text = "changed"
+        fork.styles[0].fontsize = 40
+        fork.play_res_x = 1280
+        del fork.events[1]
+
+        self.assertNotEqual(doc.events[0].text, "changed")
+        self.assertEqual(doc.styles[0].fontsize, 20)
+        self.assertEqual(doc.play_res_x, 500)
+        self.assertEqual(len(doc.events), len(fork.events) + 1)
+        self.assertIs(fork.events[1].fields, doc.events[2].fields)
+
+        # writes to the original do not leak into the fork either.
+        doc.events[2].text = "original"
+        self.assertNotEqual(fork.events[1].text, "original")
+
+        # the last line sharing a dict writes to it without copying.
+        fields = doc.events[0].fields
+        doc.events[0].text = "last"
+        self.assertIs(doc.events[0].fields, fields)
+
+    def test_embedded_files(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+        doc.fonts.append(ass.document.EmbeddedFile("a.ttf", data=b"abc"))
+        doc.raw_sections.append(ass.document.RawSection("Extra", "a: 1"))
+
+        fork = doc.fork()
+        fork.fonts[0].data = b"def"
+        fork.raw_sections[0].text = "a: 2"
+
+        self.assertEqual(doc.fonts[0].data, b"abc")
+        self.assertEqual(doc.raw_sections[0].text, "a: 1")
+        self.assertEqual(fork.fonts[0].data, b"def")
+
+class TestPacked(unittest.TestCase):
+    def test_pickle(self):
+        import copy
+        import pickle
+
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        odd = ass.document.Dialogue(text="odd")
+        odd.fields["Extra"] = 1
+        doc.events.insert(1, odd)
+        doc.events[2].margin_r = 2.5
+        doc.styles.append(ass.document.Style(name="Int", fontsize=30))
+
+        loaded = pickle.loads(pickle.dumps(doc))
+        self.assertEqual(loaded.dumps(), doc.dumps())
+        self.assertEqual(loaded.events[1].fields["Extra"], 1)
+        self.assertIs(loaded.styles[1].fontsize.__class__, int)
+        self.assertIs(loaded.styles[0].fontsize.__class__, float)
+        self.assertEqual(loaded.events[0].start, doc.events[0].start)
+        self.assertEqual(loaded.styles[0].primary_color.to_int(),
+                         doc.styles[0].primary_color.to_int())
+        self.assertEqual(loaded.select(text="odd"), [loaded.events[1]])
+
+        # copies are still shallow, and deep copies keep their memo.
+        self.assertIs(copy.copy(doc).events[0], doc.events[0])
+        copied, event = copy.deepcopy((doc, doc.events[0]))
+        self.assertIs(copied.events[0], event)
+        self.assertIsNot(event, doc.events[0])
+        self.assertEqual(copied.dumps(), doc.dumps())
+
+        # default styles fit the packed columns.
+        from ass import packed
+        _, odd = packed._columns([ass.document.Style()],
+                                 (ass.document.Style,),
+                                 ass.document.Style._field_defs)
+        self.assertEqual(odd, [])
+
+    def test_shared_memory(self):
+        from ass.packed import SharedDocument
+
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        with doc.share() as shared:
+            attached = SharedDocument.attach(shared.name)
+            try:
+                packed = attached.packed
+                self.assertEqual(packed.n_events, len(doc.events))
+                self.assertEqual(packed.column("events", "End")[0],
+                                 5000000)
+                self.assertEqual(
+                    packed.string(packed.column("events", "Text")[0]),
+                    doc.events[0].text)
+                self.assertEqual(attached.document().dumps(), doc.dumps())
+            finally:
+                attached.close()
+
+class TestReparse(unittest.TestCase):
+    def test_reparse(self):
+        with open("test.ass", "r") as f:
+            contents = f.read()
+
+        self.assertNotIn("_source", ass.parse(StringIO(contents))
+                         .events[0].__dict__)
+
+        doc = ass.parse(StringIO(contents), track_source=True)
+        doc.select(style="Default")
+        events = list(doc.events)
+        style = doc.styles[0]
+
+        line = events[1].dump_with_type(doc.events_field_order)
+        edited = line.replace("a line", "an edited line")
+        contents = contents.replace(line, edited).replace("PlayResX: 500",
+                                                          "PlayResX: 600")
+
+        changes = doc.reparse_string(contents)
+        self.assertEqual(changes.fields, set(["PlayResX"]))
+        self.assertEqual(changes.events_removed, [events[1]])
+        self.assertEqual(len(changes.events_added), 1)
+        self.assertFalse(changes.styles_added or changes.styles_removed)
+        self.assertFalse(changes.events_reordered)
+
+        self.assertIs(doc.styles[0], style)
+        self.assertIs(doc.events[0], events[0])
+        self.assertIs(doc.events[2], events[2])
+        self.assertEqual(doc.events[1].dump_with_type(doc.events_field_order),
+                         edited)
+        self.assertEqual(doc.play_res_x, 600)
+        self.assertEqual(doc.select(text="edited"), [doc.events[1]])
+
+        self.assertFalse(doc.reparse_string(contents))
+
+        # lines set since they were parsed are parsed again.
+        doc.events[0].layer = 5
+        changes = doc.reparse_string(contents)
+        self.assertEqual(len(changes.events_added), 1)
+        self.assertEqual(doc.events[0].layer, 0)
+
+class TestResample(unittest.TestCase):
+    def test_resample(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        doc.play_res_y = 250
+        style = doc.styles[0]
+        style.fontsize, style.outline, style.margin_l = 20, 2, 10
+
+        event = doc.events[0]
+        event.margin_v = 5
+        event.text = r"{\pos(100,50)\fs10\fscx120\bord1.5}a" \
+                     r"{\clip(m 0 0 l 10 10)\p1}m 0 0 l 5 5{\p0}b"
+        doc.events[1].text = event.text
+
+        doc.resample(1000, 500)
+
+        self.assertEqual((doc.play_res_x, doc.play_res_y), (1000, 500))
+        self.assertEqual(style.fontsize, 40)
+        self.assertEqual(style.outline, 4)
+        self.assertEqual(style.margin_l, 20)
+        self.assertEqual(style.scale_x, 100)
+        self.assertEqual(event.margin_v, 10)
+        self.assertEqual(event.text,
+                         r"{\pos(200,100)\fs20\fscx120\bord3}a"
+                         r"{\clip(m 0 0 l 20 20)\p1}m 0 0 l 10 10{\p0}b")
+        self.assertEqual(doc.events[1].text, event.text)
+
+class TestRawSections(unittest.TestCase):
+    def test_passthrough(self):
+        with open("test.ass", "r") as f:
+            contents = f.read()
+
+        garbage = "[Aegisub Project Garbage]\nLast Style Storage: Default\n" \
+                  "Video File: ?dummy:23.976000:40000:1920:1080:47:163:254:\n\n"
+        extradata = "[Aegisub Extradata]\n" + \
+                    "Data: 1,foo,e#1:2;3\n" * 3 + "\n"
+
+        i = contents.index("[V4+ Styles]")
+        contents = contents[:i] + garbage + contents[i:].strip() + "\n\n" + \
+            extradata
+
+        doc = ass.parse(StringIO(contents))
+        self.assertEqual([s.name for s in doc.raw_sections],
+                         ["Aegisub Project Garbage", "Aegisub Extradata"])
+        self.assertEqual(doc.fields["PlayResX"], 500)
+
+        out = StringIO()
+        doc.dump_file(out)
+        self.assertEqual(out.getvalue(), contents)
+
+    def test_crlf(self):
+        with open("test.ass", "r") as f:
+            contents = f.read().replace("\n", "\r\n")
+        garbage = "[Aegisub Project Garbage]\r\nActive Line: 2\r\n" \
+                  "Video Zoom Percent: 1\r\n\r\n"
+
+        doc = ass.parse(StringIO(contents + garbage))
+        self.assertEqual(doc.raw_sections[0].text,
+                         "Active Line: 2\r\nVideo Zoom Percent: 1")
+
+        out = StringIO()
+        doc.dump_file(out)
+        self.assertTrue(out.getvalue().endswith("\n" + garbage))
+
+class TestEmbeddedFiles(unittest.TestCase):
+    def test_roundtrip(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        data = bytes(bytearray(range(256))) * 3 + b"x"
+        doc.fonts.append(ass.document.EmbeddedFile("test_0.ttf", data=data))
+        doc.graphics.append(ass.document.EmbeddedFile("a.png", data=b"ab"))
+
+        out = StringIO()
+        doc.dump_file(out)
+        lines = out.getvalue().split("\n")
+        self.assertEqual(lines[lines.index("[Fonts]") + 1],
+                         "fontname: test_0.ttf")
+        font_lines = lines[lines.index("[Fonts]") + 2:lines.index("[Graphics]")]
+        self.assertEqual([len(line) for line in font_lines],
+                         [80] * 12 + [66, 0])
+
+        doc2 = ass.parse(StringIO(out.getvalue()))
+        self.assertEqual([f.name for f in doc2.fonts], ["test_0.ttf"])
+        self.assertEqual(doc2.fonts[0].data, data)
+        self.assertEqual(doc2.graphics[0].data, b"ab")
+        self.assertEqual(len(doc2.events), len(doc.events))
+
+    def test_header_like_lines(self):
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        # a font whose second uuencoded line looks like a section header.
+        encoded = "!" * 80 + "\n[" + "A" * 78 + "]"
+        data = ass.document.EmbeddedFile("a.ttf", encoded=encoded).data
+        doc.fonts.append(ass.document.EmbeddedFile("a.ttf", data=data))
+
+        out = StringIO()
+        doc.dump_file(out)
+        self.assertIn("\n[" + "A" * 78 + "]\n", out.getvalue())
+
+        doc2 = ass.parse(StringIO(out.getvalue()))
+        self.assertEqual(doc2.fonts[0].data, data)
+        self.assertEqual(doc2.raw_sections, [])
+        self.assertEqual(len(doc2.events), len(doc.events))
+
+        with self.assertRaises(ValueError):
+            ass.document.EmbeddedFile("b.ttf", encoded="abcd").data
+
+class TestConvert(unittest.TestCase):
+    def test_ass_to_srt_and_back(self):
+        from ass import convert
+
+        with open("test.ass", "r") as f:
+            contents = f.read()
+        contents += "Dialogue: 0,0:00:01.00,1:02:03.45,Default,,0,0,0,," \
+                    "{\\i1}a {\\b1}b{\\i0} c\\Nd & e{\\p1}m 0 0 l 1 1\n"
+
+        srt = StringIO()
+        self.assertEqual(convert.ass_to_srt(StringIO(contents), srt), 6)
+        self.assertTrue(srt.getvalue().endswith(
+            "6\n00:00:01,000 --> 01:02:03,450\n"
+            "<i>a <b>b</b></i><b> c\nd & e</b>\n\n"))
+
+        vtt = StringIO()
+        convert.ass_to_vtt(StringIO(contents), vtt)
+        self.assertTrue(vtt.getvalue().startswith("WEBVTT\n\n00:00:00.000"))
+        self.assertIn("d &amp; e", vtt.getvalue())
+
+        out = StringIO()
+        self.assertEqual(convert.vtt_to_ass(StringIO(vtt.getvalue()), out), 6)
+        doc = ass.parse(StringIO(out.getvalue()))
+        self.assertEqual(doc.events[5].end.total_seconds(), 3723.45)
+        self.assertEqual(doc.events[5].text,
+                         "{\\i1}a {\\b1}b{\\b0}{\\i0}{\\b1} c\\Nd & e{\\b0}")
+        self.assertEqual(doc.events[1].text, "this is a line at \\an2")
+
+    def test_header_sections(self):
+        from ass import convert
+
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+        doc.raw_sections.append(ass.document.RawSection(
+            "Aegisub Project Garbage", "Active Line: 1",
+            ass.document.Document.SCRIPT_INFO_HEADER))
+        doc.raw_sections.append(ass.document.RawSection(
+            "Aegisub Extradata", "Data: 1,foo,e#1:2;3"))
+        doc.raw_sections.append(ass.document.RawSection(
+            "Notes", "", ass.document.Document.EVENTS_HEADER))
+
+        out = StringIO()
+        self.assertEqual(convert.write_ass(iter(doc.events), out, doc), 5)
+        self.assertEqual(out.getvalue(), doc.dumps())
+
+    def test_colors(self):
+        from ass import convert
+
+        text = "{\\c&H0000FF&}red {\\i1\\1c&HFF00&}green{\\clip(0,0,1,1)}" \
+               "{\\c} plain{\\i0}"
+        srt = convert._srt_text(text)
+        self.assertEqual(srt, '<font color="#FF0000">red <i></i></font><i>'
+                              '<font color="#00FF00">green</font> plain</i>')
+        self.assertEqual(convert._vtt_text(text), "red <i>green plain</i>")
+
+        self.assertEqual(convert._html_to_ass(srt),
+                         "{\\c&H0000FF&}red {\\i1}{\\i0}{\\c}{\\i1}"
+                         "{\\c&H00FF00&}green{\\c} plain{\\i0}")
+
+class TestTimeline(unittest.TestCase):
+    def test_segments(self):
+        from datetime import timedelta
+
+        doc = ass.document.Document()
+        a = ass.document.Dialogue(start=timedelta(seconds=1),
+                                  end=timedelta(seconds=3), text="a")
+        b = ass.document.Dialogue(start=timedelta(seconds=2),
+                                  end=timedelta(seconds=4),
+                                  text="{\\fad(100,100)}b")
+        c = ass.document.Comment(start=timedelta(0), end=timedelta(seconds=9))
+        d = ass.document.Dialogue(start=timedelta(seconds=5),
+                                  end=timedelta(seconds=6), text="d")
+        doc.events.extend([a, b, c, d])
+
+        self.assertEqual(
+            [(s.start.seconds, s.end.seconds, s.events, s.static)
+             for s in doc.segments()],
+            [(1, 2, [a], True), (2, 3, [a, b], False), (3, 4, [b], False),
+             (4, 5, [], True), (5, 6, [d], True)])
+
+class TestDirtyRegions(unittest.TestCase):
+    def test_merge_rects(self):
+        from ass.dirty import DirtyRegions, merge_rects
+
+        rects = merge_rects([(0, 0, 10, 10), (5, 5, 10, 10), (40, 0, 5, 5),
+                             (14, 14, 20, 1), (50, 50, 0, 3)])
+        self.assertEqual(rects, [(0, 0, 34, 15), (40, 0, 5, 5)])
+        self.assertEqual(DirtyRegions.union(rects), (0, 0, 45, 15))
+
+    def test_update(self):
+        from ass.dirty import DirtyRegions
+
+        a = BitmapImage(2, 2, b"\xff" * 4, 0, 1, 1)
+        b = BitmapImage(2, 2, b"\xff" * 4, 0, 10, 1)
+        b2 = BitmapImage(2, 2, b"\x80" * 4, 0, 10, 1)
+
+        dirty = DirtyRegions((20, 20))
+        self.assertEqual(dirty.update([a, b]), [(1, 1, 2, 2), (10, 1, 2, 2)])
+        self.assertEqual(dirty.update([a, b]), [])
+        self.assertEqual(dirty.update([a, b2]), [(10, 1, 2, 2)])
+        self.assertEqual(dirty.update([]), [(1, 1, 2, 2), (10, 1, 2, 2)])
+
+class TestAtlas(unittest.TestCase):
+    def test_dedup_and_pack(self):
+        from ass.atlas import AtlasExporter, write_png
+        from io import BytesIO
+
+        atlas = AtlasExporter(page_size=4, padding=1)
+        a = atlas.add_bitmap(2, 2, b"\x01\x02\x03\x04")
+        b = atlas.add_bitmap(1, 2, b"\x05\x06")
+
+        self.assertEqual(atlas.add_bitmap(2, 2, b"\x01\x02\x03\x04"), a)
+        self.assertEqual(atlas.sprites, [(0, 0, 0, 2, 2), (0, 3, 0, 1, 2)])
+        self.assertEqual(bytes(atlas.pages[0].data[:8]),
+                         b"\x01\x02\x00\x05\x03\x04\x00\x06")
+
+        atlas.add_bitmap(3, 3, b"\x07" * 9)
+        self.assertEqual(len(atlas.pages), 2)
+
+        out = BytesIO()
+        write_png(out, 4, 4, atlas.pages[0].data)
+        self.assertTrue(out.getvalue().startswith(b"\x89PNG\r\n\x1a\n"))
+
+class TestQC(unittest.TestCase):
+    def test_boxes(self):
+        from ass import qc
+
+        self.assertEqual(qc.tag_text("{\\3c&H0000FF&\\clip(0,0,1,1)}a", 0x0102)
+                         .count("\\clip(0,0,1,1)"), 1)
+        self.assertNotIn("0000FF", qc.tag_text("{\\3c&H0000FF&}a", 1))
+
+        images = [
+            BitmapImage(10, 10, b"\xff" * 100, 1 << 8, 0, 0),
+            BitmapImage(10, 10, b"\xff" * 100, 1 << 8, 5, 5),
+            BitmapImage(20, 5, b"\xff" * 100, 2 << 8, 12, 8),
+            BitmapImage(5, 5, b"\xff" * 25, 3 << 8, 100, 100)
+        ]
+        boxes = qc.event_boxes(images)
+        self.assertEqual(boxes, {1: (0, 0, 15, 15), 2: (12, 8, 20, 5),
+                                 3: (100, 100, 5, 5)})
+
+        overflows, overlaps = qc.check_boxes(boxes, (2, 2, 100, 100))
+        self.assertEqual(overflows, [1, 3])
+        self.assertEqual(overlaps, [(1, 2)])
+
+        overflows, overlaps = qc.check_boxes(boxes, (0, 0, 200, 200),
+                                             min_overlap=20)
+        self.assertEqual((overflows, overlaps), ([], []))
+
+    def test_jobs(self):
+        from ass import qc
+
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+        doc.events[1].text += "{\\move(0,0,10,10)}"
+
+        scanner = qc.Scanner(doc, (640, 480))
+        self.assertEqual(scanner.safe_area, (32, 24, 576, 432))
+        self.assertEqual(scanner.jobs(), [(833, (1, 2, 3, 4, 5)),
+                                          (2500, (1, 2, 3, 4, 5)),
+                                          (4166, (1, 2, 3, 4, 5))])
+
+        issues = scanner.issues([(qc.OVERLAP, 2500, (1, 3), ((0, 0, 1, 1),) * 2),
+                                 (qc.OVERLAP, 833, (1, 3), ((0, 0, 1, 1),) * 2)])
+        self.assertEqual(len(issues), 1)
+        self.assertEqual(issues[0].events, (doc.events[0], doc.events[2]))
+        self.assertEqual(issues[0].time.total_seconds(), 0.833)
+
+class TestFramePool(unittest.TestCase):
+    def test_copy_and_reuse(self):
+        from ass.framepool import BufferPool, FramePool
+
+        pool = FramePool(frames=1)
+        images = [BitmapImage(2, 2, b"abcd", 0x11223344, 5, 6),
+                  BitmapImage(3, 1, b"xyz", 0x55667788, 0, 0)]
+
+        with pool.copy(images) as frame:
+            copies = list(frame)
+            self.assertEqual(len(frame), 2)
+            self.assertEqual(ctypes.string_at(copies[0].bitmap, 4), b"abcd")
+            self.assertEqual(ctypes.string_at(copies[1].bitmap, 3), b"xyz")
+            self.assertEqual((copies[0].dst_x, copies[0].dst_y), (5, 6))
+            self.assertEqual(copies[1].rgba, (0x55, 0x66, 0x77, 0x88))
+
+        # the released frame and its image objects are reused.
+        with pool.copy(images[1:]) as again:
+            self.assertIs(again, frame)
+            self.assertIs(list(again)[0], copies[0])
+            self.assertEqual(ctypes.string_at(copies[0].bitmap, 3), b"xyz")
+        self.assertEqual(pool.allocated, 1)
+
+        # releasing twice does not put the frame in the pool twice.
+        again.release()
+        self.assertIsNot(pool.copy(images), pool.copy(images))
+        self.assertEqual(pool.allocated, 2)
+
+        # a frame that outgrows its data while copying keeps the images
+        # copied before it grew.
+        big = BitmapImage(100, 50, b"z" * 5000, 0, 0, 0)
+        with FramePool(frames=1).copy(images + [big]) as grown:
+            copies = list(grown)
+            self.assertEqual(ctypes.string_at(copies[0].bitmap, 4), b"abcd")
+            self.assertEqual(ctypes.string_at(copies[2].bitmap, 5000),
+                             b"z" * 5000)
+
+        buffers = BufferPool(bytearray, buffers=1)
+        with buffers.buffer() as buf:
+            with buffers.buffer() as other:
+                self.assertIsNot(buf, other)
+        with buffers.buffer() as reused:
+            self.assertTrue(reused is buf or reused is other)
+        self.assertEqual(buffers.allocated, 2)
+        with self.assertRaises(ValueError):
+            buffers.release(reused)
+
+class TestRenderStats(unittest.TestCase):
+    def test_record(self):
+        from ass.stats import RenderStats
+
+        stats = RenderStats()
+        stats.cache_limits = (0, 1)
+        stats.record(0.003, 2, [BitmapImage(4, 2, b"\0" * 8, 0, 0, 0)])
+        stats.record(0.0001, 0, [])
+
+        d = stats.as_dict()
+        self.assertEqual(d["frames"], 2)
+        self.assertEqual(d["latency_histogram_ms"]["0.5"], 1)
+        self.assertEqual(d["latency_histogram_ms"]["5"], 1)
+        self.assertEqual(d["images"], {"character": 1, "outline": 0,
+                                       "shadow": 0})
+        self.assertEqual(d["pixels"]["character"], 8)
+        self.assertEqual(d["changes"], {"none": 1, "positions": 0,
+                                        "content": 1})
+        self.assertEqual(d["cache_pressure"], 8 / (1024.0 * 1024))
+
+def fork_server_handler(state, request):
+    if "fail" in request:
+        raise ValueError(request["fail"])
+    if "unsendable" in request:
+        return {"sum": {state["base"]}}
+    return {"pid": os.getpid(), "sum": state["base"] + request["n"]}
+
+@unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+class TestForkServer(unittest.TestCase):
+    def test_jobs(self):
+        import tempfile
+        import threading
+        from ass.forkserver import ForkServer, submit
+
+        address = os.path.join(tempfile.mkdtemp(), "forkserver.sock")
+        server = ForkServer(address, fork_server_handler, {"base": 40})
+        requests = [{"n": 2}, {"fail": "nope"}, {"unsendable": True}]
+        responses = []
+
+        # the jobs are submitted from a thread so that the server, and so
+        # the fork, runs on the main thread.
+        def client():
+            for request in requests:
+                responses.append(submit(address, request, timeout=10))
+
+        thread = threading.Thread(target=client)
+        thread.start()
+
+        try:
+            for _ in requests:
+                self.assertTrue(server.serve_one(10))
+            thread.join(10)
+        finally:
+            server.close()
+
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(responses[0]["sum"], 42)
+        self.assertNotEqual(responses[0]["pid"], os.getpid())
+        self.assertEqual(responses[1], {"error": "ValueError: nope"})
+        self.assertTrue(responses[2]["error"].startswith("TypeError: "))
+
+class TestFrameServer(unittest.TestCase):
+    def test_coalescing(self):
+        import asyncio
+        import tempfile
+        import threading
+        from ass.frameserver import FrameClient, FrameServer, Overlay
+
+        class FakeFrameServer(FrameServer):
+            release = threading.Event()
+
+            def load_track(self, name):
+                self.path(name)
+                return name.upper()
+
+            def render(self, track, ms):
+                self.release.wait(10)
+                if ms < 0:
+                    raise ValueError("negative time")
+                return Overlay(1, 2, 1, 1, track[:1].encode("ascii") * 4)
+
+        async def run():
+            server = FakeFrameServer(tempfile.gettempdir(), max_frames=2)
+            await server.start()
+            loop = asyncio.get_running_loop()
+
+            def fetch(name, ms):
+                with FrameClient(server.address, timeout=10) as client:
+                    return client.frame(name, ms)
+
+            try:
+                waiting = [loop.run_in_executor(None, fetch, "a.ass", 100)
+                           for _ in range(4)]
+                for _ in range(1000):
+                    if server.coalesced == 3:
+                        break
+                    await asyncio.sleep(0.01)
+                server.release.set()
+
+                overlays = await asyncio.gather(*waiting)
+                self.assertEqual(set(overlays), {(1, 2, 1, 1, b"AAAA")})
+                self.assertEqual(server.renders, 1)
+
+                await loop.run_in_executor(None, fetch, "a.ass", 100)
+                self.assertEqual(server.frame_hits, 1)
+
+                await loop.run_in_executor(None, fetch, "b.ass", 100)
+                await loop.run_in_executor(None, fetch, "b.ass", 200)
+                self.assertNotIn(("a.ass", 100), server._frames)
+                self.assertEqual(server.stats()["track_loads"], 2)
+
+                with self.assertRaisesRegex(RuntimeError, "negative time"):
+                    await loop.run_in_executor(None, fetch, "a.ass", -1)
+                with self.assertRaisesRegex(RuntimeError, "outside of root"):
+                    await loop.run_in_executor(None, fetch, "../a.ass", 0)
+            finally:
+                await server.close()
+
+        asyncio.run(run())
+
+    def test_load_track(self):
+        from ass.frameserver import FrameServer
+
+        # stands in for the libass context, handing back the document.
+        class DocumentContext(object):
+            def track_from_document(self, doc):
+                return doc
+
+        server = FrameServer(os.getcwd())
+        server._ctx = DocumentContext()
+        try:
+            doc = server.load_track("test.ass")
+        finally:
+            server._executor.shutdown()
+        self.assertEqual(len(doc.events), 5)
+
+    @unittest.skipUnless(renderer, "requires libass")
+    def test_load_track_libass(self):
+        from ass.frameserver import FrameServer
+
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+
+        server = FrameServer(os.getcwd())
+        try:
+            track = server.load_track("test.ass")
+        finally:
+            server._executor.shutdown()
+        self.assertEqual(track_events(track),
+                         track_events(renderer.Context().track_from_document(
+                             doc)))
+
+@unittest.skipUnless(numpy, "requires numpy")
+class TestFrameSink(unittest.TestCase):
+    def test_write_to_pipe(self):
+        from ass.compositor import Compositor
+        from ass.sink import FrameSink
+
+        r, w = os.pipe()
+        compositor = Compositor((4, 2), "bgra")
+
+        with FrameSink(w, compositor) as sink:
+            for _ in range(3):
+                sink.write_frame([])
+        os.close(w)
+
+        with os.fdopen(r, "rb") as f:
+            data = f.read()
+
+        self.assertEqual(data, b"\0" * (3 * compositor.frame_bytes))
+        self.assertEqual(sink.stats()["frames"], 3)
+        self.assertEqual(sink.stats()["bytes_written"], len(data))
+
+@unittest.skipUnless(numpy, "requires numpy")
+class TestCompositor(unittest.TestCase):
+    def test_yuv_clear(self):
+        from ass.compositor import YUVCompositor
+        from ass.ycbcr import MATRIX_BT709_PC, rgb_to_yuv
+
+        self.assertEqual(rgb_to_yuv(255, 255, 255, MATRIX_BT709_PC),
+                         (255, 128, 128))
+
+        compositor = YUVCompositor((5, 3), "nv12", MATRIX_BT709_PC)
+        y, uv = compositor.planes(compositor.make_buffer())
+
+        self.assertEqual(y.shape, (3, 5))
+        self.assertEqual(uv.shape, (2, 3, 2))
+        self.assertTrue((y == 0).all())
+        self.assertTrue((uv == 128).all())
+
+    def test_yuv_chroma(self):
+        from ass.compositor import YUVCompositor
+        from ass.ycbcr import MATRIX_BT709_PC, rgb_to_yuv
+
+        compositor = YUVCompositor((4, 2), "yuv420p", MATRIX_BT709_PC)
+        buf = compositor.make_buffer()
+        y, u, v = compositor.planes(buf)
+
+        # red over one pixel of the first 2x2 block and two of the second.
+        compositor.blend(BitmapImage(3, 1, b"\xff" * 3, 0xff000000, 1, 0),
+                         (y, u, v))
+        red_y, red_u, red_v = rgb_to_yuv(255, 0, 0, MATRIX_BT709_PC)
+
+        def blended(value, alpha):
+            return (128 * (255 - alpha) + value * alpha + 127) // 255
+
+        self.assertEqual(list(y[0]), [0, red_y, red_y, red_y])
+        self.assertEqual(list(y[1]), [0, 0, 0, 0])
+        self.assertEqual(list(u[0]), [blended(red_u, 64),
+                                      blended(red_u, 128)])
+        self.assertEqual(list(v[0]), [blended(red_v, 64),
+                                      blended(red_v, 128)])
+
+    def test_blend(self):
+        from ass.compositor import Compositor
+
+        compositor = Compositor((4, 2), "bgra")
+        buf = compositor.make_buffer()
+
+        # an opaque color, with a fully and a half covered pixel.
+        compositor.composite([BitmapImage(2, 1, b"\xff\x80", 0x11223300,
+                                          1, 0)], buf)
+        self.assertEqual(tuple(buf[0, 1]), (0x33, 0x22, 0x11, 255))
+        self.assertEqual(tuple(buf[0, 2]), (0x33, 0x22, 0x11, 128))
+        self.assertEqual(buf[0, 0, 3], 0)
+        self.assertEqual(buf[1, 1, 3], 0)
+
+        # half transparent white over the opaque pixel, clipped off-frame.
+        compositor.blend(BitmapImage(2, 2, b"\xff" * 4, 0xffffff80, 0, -1),
+                         buf)
+        self.assertEqual(tuple(buf[0, 1]), (152, 144, 135, 255))
+        self.assertEqual(tuple(buf[0, 0]), (255, 255, 255, 127))
+        self.assertEqual(buf[1, 0, 3], 0)
+
+def decode_pgs_rle(data, w):
+    rows, row, i = [], [], 0
+    while i < len(data):
+        b = data[i]
+        i += 1
+        if b:
+            row.append(b)
+            continue
+
+        flags = data[i]
+        i += 1
+        if not flags:
+            rows.append(row)
+            row = []
+            continue
+
+        length = flags & 0x3f
+        if flags & 0x40:
+            length = (length << 8) | data[i]
+            i += 1
+
+        color = 0
+        if flags & 0x80:
+            color = data[i]
+            i += 1
+
+        row.extend([color] * length)
+    return rows
+
+@unittest.skipUnless(numpy, "requires numpy")
+class TestRecords(unittest.TestCase):
+    def test_roundtrip(self):
+        import io
+        from ass import records
+
+        with open("test.ass", "r") as f:
+            doc = ass.parse(f)
+        doc.events[1].name = "actor"
+        doc.events.append(ass.document.Comment(text="note"))
+
+        table = doc.to_records()
+        self.assertEqual(len(table), len(doc.events))
+        self.assertEqual(table.records["end"][0], 5000)
+        self.assertEqual(int((table.records["style"] ==
+                              table.string_id("Default")).sum()), 6)
+        self.assertEqual(table.string_id("missing"), -1)
+
+        f = io.BytesIO()
+        records.save(f, table)
+
+        f.seek(0)
+        times = records.load(f, ["start", "end"])
+        self.assertEqual(times.records.dtype.names, ("start", "end"))
+        self.assertEqual(len(times), len(doc.events))
+        self.assertEqual(times.strings, [])
+
+        f.seek(0)
+        styles = records.load(f, ["style"])
+        self.assertEqual(styles.strings, table.strings)
+
+        f.seek(0)
+        loaded = ass.document.Document.from_records(records.load(f))
+        self.assertEqual([e.dump_with_type() for e in loaded.events],
+                         [e.dump_with_type() for e in doc.events])
+
+@unittest.skipUnless(numpy, "requires numpy")
+class TestPGS(unittest.TestCase):
+    def test_rle_roundtrip(self):
+        from ass.pgs import rle_encode
+
+        indices = numpy.zeros((3, 200), numpy.uint8)
+        indices[0, 5] = 1
+        indices[0, 6:8] = 2
+        indices[0, 8:20] = 3
+        indices[1, 10:150] = 4
+        indices[2, :] = 5
+
+        rows = decode_pgs_rle(bytearray(rle_encode(indices)), 200)
+        self.assertEqual(rows, indices.tolist())
+
+    def test_stream(self):
+        from ass.pgs import PGSEncoder, read_segments, SEGMENT_PCS, \
+                            SEGMENT_ODS, SEGMENT_END
+        from io import BytesIO
+
+        out = BytesIO()
+        encoder = PGSEncoder(out, (64, 48))
+        img = BitmapImage(6, 3, b"\xff" * 18, 0xffffff00, 7, 6)
+
+        encoder.add_frame(10, [img])
+        encoder.add_frame(20, [img])
+        encoder.close(1000)
+
+        segments = list(read_segments(BytesIO(out.getvalue())))
+        types = [segment_type for _, _, segment_type, _ in segments]
+
+        self.assertEqual(types.count(SEGMENT_PCS), 2)
+        self.assertEqual(types.count(SEGMENT_END), 2)
+        self.assertEqual(segments[0][0], 900)
+        self.assertEqual(segments[-1][0], 90000)
+
+        self.assertEqual(encoder.display_sets, 2)
+
+        ods = [payload for _, _, segment_type, payload in segments
+               if segment_type == SEGMENT_ODS][0]
+        rows = decode_pgs_rle(bytearray(ods[11:]), 8)
+        self.assertEqual(rows, [[1] * 6 + [0] * 2] * 3 + [[0] * 8] * 5)
+
+    def test_window_cleared(self):
+        from ass.pgs import PGSEncoder, read_segments, SEGMENT_ODS
+        from io import BytesIO
+
+        out = BytesIO()
+        encoder = PGSEncoder(out, (64, 48))
+
+        # the second window overlaps the first image where its own bitmap
+        # is blank, which must not show what was drawn there before.
+        encoder.add_frame(10, [BitmapImage(6, 3, b"\xff" * 18, 0xffffff00,
+                                           7, 6)])
+        encoder.add_frame(20, [BitmapImage(6, 3, b"\x00" * 6 + b"\xff" * 12,
+                                           0xffffff00, 10, 8)])
+
+        ods = [payload for _, _, segment_type, payload
+               in read_segments(BytesIO(out.getvalue()))
+               if segment_type == SEGMENT_ODS][1]
+        rows = decode_pgs_rle(bytearray(ods[11:]), 8)
+        self.assertEqual(rows, [[0] * 8] + [[1] * 6 + [0] * 2] * 2 +
+                         [[0] * 8] * 5)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+""" Compare the two ways of converting a document to a track: Track.populate
+and parsing a dump of the document with libass (Context.track_from_document
+with method="parse"), over a range of document sizes.
+
+    python track_benchmark.py [sizes...]
+"""
+
+import ass
+from datetime import timedelta
+import sys
+import time
+
+SIZES = [10, 100, 500, 1000, 5000, 20000, 100000]
+
+
+def make_document(n):
+    doc = ass.document.Document()
+    doc.styles.append(ass.document.Style(name="Default"))
+
+    for i in range(n):
+        doc.events.append(ass.document.Dialogue(
+            start=timedelta(seconds=i),
+            end=timedelta(seconds=i + 2),
+            style="Default",
+            text="{\\an8}line %d of the benchmark document" % i
+        ))
+
+    return doc
+
+
+def best_of(f, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        track = f()
+        elapsed = time.perf_counter() - start
+        del track
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(sizes):
+    ctx = ass.renderer.Context()
+
+    print("{:>8} {:>12} {:>12}  faster".format("events", "populate ms",
+                                               "parse ms"))
+    for n in sizes:
+        doc = make_document(n)
+        populate = best_of(lambda: ctx.track_from_document(doc, "populate"))
+        parse = best_of(lambda: ctx.track_from_document(doc, "parse"))
+
+        print("{:>8} {:>12.3f} {:>12.3f}  {}".format(
+            n, populate * 1000, parse * 1000,
+            "populate" if populate < parse else "parse"))
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or SIZES)